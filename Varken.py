@@ -1,43 +1,46 @@
+import signal
 import platform
 import schedule
-import distro
 from time import sleep
-from queue import Queue
 from sys import version
-from threading import Thread
+from threading import Event
 from os import environ as env
 from os import access, R_OK, getenv
-from os.path import isdir, abspath, dirname, join
+from os.path import isdir, abspath, dirname, join, getmtime
 from argparse import ArgumentParser, RawTextHelpFormatter
 from logging import getLogger, StreamHandler, Formatter, DEBUG
 
 
 # Needed to check version of python
 from varken import structures  # noqa
-from varken.ombi import OmbiAPI
-from varken.overseerr import OverseerrAPI
-from varken.unifi import UniFiAPI
 from varken import VERSION, BRANCH, BUILD_DATE
-from varken.sonarr import SonarrAPI
-from varken.radarr import RadarrAPI
-from varken.lidarr import LidarrAPI
 from varken.iniparser import INIParser
-from varken.dbmanager import DBManager
-from varken.influxdb2manager import InfluxDB2Manager
-from varken.helpers import GeoIPHandler
-from varken.tautulli import TautulliAPI
-from varken.sickchill import SickChillAPI
+from varken.helpers import Governor, CircuitBreaker
+from varken.scheduler import JobManager, thread
+from varken.profiler import JobProfiler
 from varken.varkenlogger import VarkenLogger
-from varken.prometheus import PrometheusExporter
 from varken.noopmanager import NoopDBManager
 
 
-PLATFORM_LINUX_DISTRO = ' '.join(distro.id() + distro.version() + distro.name())
+# Sink and listener settings are only read at startup
+RESTART_SETTINGS = ['influx_enabled', 'influx2_enabled', 'influx_server', 'prometheus_enabled', 'prometheus_addr',
+                    'prometheus_port', 'listener_enabled', 'listener_addr', 'listener_port', 'listener_token']
 
 
-def thread(job, **kwargs):
-    worker = Thread(target=job, kwargs=dict(**kwargs))
-    worker.start()
+def linux_distro():
+    """Describe the distribution from os-release, falling back to the distro package on older systems"""
+    if platform.system() != 'Linux':
+        return ''
+    try:
+        release = platform.freedesktop_os_release()
+        return ' '.join(filter(None, [release.get('ID'), release.get('VERSION_ID'), release.get('NAME')]))
+    except (AttributeError, OSError):
+        pass
+    try:
+        import distro
+    except ImportError:
+        return ''
+    return ' '.join(filter(None, [distro.id(), distro.version(), distro.name()]))
 
 
 if __name__ == "__main__":
@@ -48,6 +51,9 @@ if __name__ == "__main__":
     parser.add_argument("-d", "--data-folder", help='Define an alternate data folder location')
     parser.add_argument("-D", "--debug", action='store_true', help='Use to enable DEBUG logging. (Depreciated)')
     parser.add_argument("-ND", "--no_debug", action='store_true', help='Use to disable DEBUG logging')
+    parser.add_argument("-T", "--trace", action='store_true', help='Use to enable TRACE logging of full payloads')
+    parser.add_argument("-P", "--profile", action='store_true',
+                        help='Profile scheduled jobs and write the profiles to DATA_FOLDER/profiles')
 
     opts = parser.parse_args()
 
@@ -81,12 +87,17 @@ if __name__ == "__main__":
     elif opts.no_debug:
         opts.debug = False
 
+    # Set Trace to True if TRACE env is set
+    if getenv('TRACE') in enable_opts:
+        opts.trace = True
+
     # Initiate the logger
-    vl = VarkenLogger(data_folder=DATA_FOLDER, debug=opts.debug)
+    vl = VarkenLogger(data_folder=DATA_FOLDER, debug=opts.debug, trace=opts.trace)
     vl.logger.info('Starting Varken...')
 
     vl.logger.info('Data folder is "%s"', DATA_FOLDER)
 
+    PLATFORM_LINUX_DISTRO = linux_distro()
     vl.logger.info(u"%s %s (%s%s)", platform.system(), platform.release(), platform.version(),
                    ' - ' + PLATFORM_LINUX_DISTRO if PLATFORM_LINUX_DISTRO else '')
 
@@ -96,8 +107,10 @@ if __name__ == "__main__":
 
     CONFIG = INIParser(DATA_FOLDER)
 
+    # Sinks and the listener are imported on demand so a minimal configuration does not pay for their dependencies
     PROMETHEUS_EXPORTER = None
     if CONFIG.prometheus_enabled:
+        from varken.prometheus import PrometheusExporter
         PROMETHEUS_EXPORTER = PrometheusExporter(addr=CONFIG.prometheus_addr, port=CONFIG.prometheus_port)
         if not PROMETHEUS_EXPORTER.enabled:
             PROMETHEUS_EXPORTER = None
@@ -108,103 +121,41 @@ if __name__ == "__main__":
     elif CONFIG.influx2_enabled:
         # Use INFLUX version 2
         vl.logger.info('Using INFLUXDBv2')
+        from varken.influxdb2manager import InfluxDB2Manager
         DBMANAGER = InfluxDB2Manager(CONFIG.influx_server, prometheus_exporter=PROMETHEUS_EXPORTER)
     else:
         vl.logger.info('Using INFLUXDB')
+        from varken.dbmanager import DBManager
         DBMANAGER = DBManager(CONFIG.influx_server, prometheus_exporter=PROMETHEUS_EXPORTER)
 
-    QUEUE = Queue()
-
-    if CONFIG.sonarr_enabled:
-        for server in CONFIG.sonarr_servers:
-            SONARR = SonarrAPI(server, DBMANAGER)
-            if server.queue:
-                at_time = schedule.every(server.queue_run_seconds).seconds
-                at_time.do(thread, SONARR.get_queue).tag("sonarr-{}-get_queue".format(server.id))
-            if server.missing_days > 0:
-                at_time = schedule.every(server.missing_days_run_seconds).seconds
-                at_time.do(thread, SONARR.get_calendar, query="Missing").tag("sonarr-{}-get_missing".format(server.id))
-            if server.future_days > 0:
-                at_time = schedule.every(server.future_days_run_seconds).seconds
-                at_time.do(thread, SONARR.get_calendar, query="Future").tag("sonarr-{}-get_future".format(server.id))
-
-    if CONFIG.tautulli_enabled:
-        GEOIPHANDLER = None
-        if any(server.get_activity for server in CONFIG.tautulli_servers):
-            GEOIPHANDLER = GeoIPHandler(DATA_FOLDER, CONFIG.tautulli_servers[0].maxmind_license_key)
-        if GEOIPHANDLER:
-            schedule.every(12).to(24).hours.do(thread, GEOIPHANDLER.update)
-        for server in CONFIG.tautulli_servers:
-            TAUTULLI = TautulliAPI(server, DBMANAGER, GEOIPHANDLER)
-            if server.get_activity:
-                at_time = schedule.every(server.get_activity_run_seconds).seconds
-                at_time.do(thread, TAUTULLI.get_activity).tag("tautulli-{}-get_activity".format(server.id))
-            if server.get_stats:
-                at_time = schedule.every(server.get_stats_run_seconds).seconds
-                at_time.do(thread, TAUTULLI.get_stats).tag("tautulli-{}-get_stats".format(server.id))
-
-    if CONFIG.radarr_enabled:
-        for server in CONFIG.radarr_servers:
-            RADARR = RadarrAPI(server, DBMANAGER)
-            if server.get_missing:
-                at_time = schedule.every(server.get_missing_run_seconds).seconds
-                at_time.do(thread, RADARR.get_missing).tag("radarr-{}-get_missing".format(server.id))
-            if server.queue:
-                at_time = schedule.every(server.queue_run_seconds).seconds
-                at_time.do(thread, RADARR.get_queue).tag("radarr-{}-get_queue".format(server.id))
-
-    if CONFIG.lidarr_enabled:
-        for server in CONFIG.lidarr_servers:
-            LIDARR = LidarrAPI(server, DBMANAGER)
-            if server.queue:
-                at_time = schedule.every(server.queue_run_seconds).seconds
-                at_time.do(thread, LIDARR.get_queue).tag("lidarr-{}-get_queue".format(server.id))
-            if server.missing_days > 0:
-                at_time = schedule.every(server.missing_days_run_seconds).seconds
-                at_time.do(thread, LIDARR.get_calendar, query="Missing").tag(
-                    "lidarr-{}-get_missing".format(server.id))
-            if server.future_days > 0:
-                at_time = schedule.every(server.future_days_run_seconds).seconds
-                at_time.do(thread, LIDARR.get_calendar, query="Future").tag("lidarr-{}-get_future".format(
-                    server.id))
-
-    if CONFIG.ombi_enabled:
-        for server in CONFIG.ombi_servers:
-            OMBI = OmbiAPI(server, DBMANAGER)
-            if server.request_type_counts:
-                at_time = schedule.every(server.request_type_run_seconds).seconds
-                at_time.do(thread, OMBI.get_request_counts).tag("ombi-{}-get_request_counts".format(server.id))
-            if server.request_total_counts:
-                at_time = schedule.every(server.request_total_run_seconds).seconds
-                at_time.do(thread, OMBI.get_all_requests).tag("ombi-{}-get_all_requests".format(server.id))
-            if server.issue_status_counts:
-                at_time = schedule.every(server.issue_status_run_seconds).seconds
-                at_time.do(thread, OMBI.get_issue_counts).tag("ombi-{}-get_issue_counts".format(server.id))
-
-    if CONFIG.overseerr_enabled:
-        for server in CONFIG.overseerr_servers:
-            OVERSEER = OverseerrAPI(server, DBMANAGER)
-            if server.get_request_total_counts:
-                at_time = schedule.every(server.request_total_run_seconds).seconds
-                at_time.do(thread, OVERSEER.get_request_counts).tag("overseerr-{}-get_request_counts"
-                                                                    .format(server.id))
-            if server.num_latest_requests_to_fetch > 0:
-                at_time = schedule.every(server.num_latest_requests_seconds).seconds
-                at_time.do(thread, OVERSEER.get_latest_requests).tag("overseerr-{}-get_latest_requests"
-                                                                     .format(server.id))
-
-    if CONFIG.sickchill_enabled:
-        for server in CONFIG.sickchill_servers:
-            SICKCHILL = SickChillAPI(server, DBMANAGER)
-            if server.get_missing:
-                at_time = schedule.every(server.get_missing_run_seconds).seconds
-                at_time.do(thread, SICKCHILL.get_missing).tag("sickchill-{}-get_missing".format(server.id))
-
-    if CONFIG.unifi_enabled:
-        for server in CONFIG.unifi_servers:
-            UNIFI = UniFiAPI(server, DBMANAGER)
-            at_time = schedule.every(server.get_usg_stats_run_seconds).seconds
-            at_time.do(thread, UNIFI.get_usg_stats).tag("unifi-{}-get_usg_stats".format(server.id))
+    LISTENER = None
+    if CONFIG.listener_enabled:
+        from varken.listener import HTTPListener
+        LISTENER = HTTPListener(addr=CONFIG.listener_addr, port=CONFIG.listener_port, token=CONFIG.listener_token)
+        if not LISTENER.enabled:
+            LISTENER = None
+
+    # Profiling can also be toggled at runtime through the listener
+    PROFILER = JobProfiler(DATA_FOLDER, active=opts.profile)
+    schedule.every(JobProfiler.interval).seconds.do(thread, PROFILER.write).tag("varken-profiler")
+    if LISTENER and CONFIG.listener_token:
+        LISTENER.register('GET', '/admin/profile', PROFILER.status)
+        LISTENER.register('POST', '/admin/profile', PROFILER.toggle)
+    elif LISTENER:
+        vl.logger.info('Set a listener token to enable the /admin routes of the listener')
+
+    JOBS = JobManager(DBMANAGER, DATA_FOLDER, listener=LISTENER, profiler=PROFILER)
+    JOBS.apply(CONFIG)
+    if LISTENER:
+        LISTENER.register('GET', '/status', JOBS.report)
+        LISTENER.register('GET', '/status.txt', JOBS.report_text)
+
+    # Report throttled wait time of rate limited upstreams and the state of every circuit breaker
+    schedule.every(60).seconds.do(thread, Governor.write_stats, dbmanager=DBMANAGER).tag("varken-governor_stats")
+    schedule.every(60).seconds.do(thread, CircuitBreaker.write_stats, dbmanager=DBMANAGER).tag("varken-breaker_stats")
+
+    # Summarise the warnings and errors the log rate limit suppressed
+    schedule.every(vl.rate_limit.interval).seconds.do(thread, vl.rate_limit.summary).tag("varken-log_summary")
 
     # Run all on startup
     SERVICES_ENABLED = [CONFIG.ombi_enabled, CONFIG.radarr_enabled, CONFIG.tautulli_enabled, CONFIG.unifi_enabled,
@@ -216,6 +167,42 @@ if __name__ == "__main__":
 
     schedule.run_all()
 
+    # Reload varken.ini when it changes or on SIGHUP
+    RELOAD = Event()
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, lambda signum, frame: RELOAD.set())
+    CONFIG_PATH = join(DATA_FOLDER, 'varken.ini')
+    CONFIG_MTIME = getmtime(CONFIG_PATH)
+
     while schedule.jobs:
         schedule.run_pending()
         sleep(1)
+
+        try:
+            mtime = getmtime(CONFIG_PATH)
+        except OSError:
+            mtime = CONFIG_MTIME
+        if mtime != CONFIG_MTIME or RELOAD.is_set():
+            CONFIG_MTIME = mtime
+            RELOAD.clear()
+            vl.logger.info('Reloading %s', CONFIG_PATH)
+            # A reload must never take down the running configuration, whatever is wrong with the new one
+            try:
+                NEW_CONFIG = INIParser(DATA_FOLDER)
+            except SystemExit:
+                vl.logger.error('Invalid varken.ini. Keeping the running configuration')
+                continue
+            except Exception as e:
+                vl.logger.error('Could not parse varken.ini. Keeping the running configuration. Error: %s', e)
+                continue
+            # Rectifying the ini rewrites it
+            CONFIG_MTIME = getmtime(CONFIG_PATH)
+            for setting in RESTART_SETTINGS:
+                if getattr(NEW_CONFIG, setting, None) != getattr(CONFIG, setting, None):
+                    vl.logger.warning('Changing %s requires a restart of Varken', setting)
+            try:
+                for group in JOBS.apply(NEW_CONFIG):
+                    JOBS.run_group(group)
+            except Exception as e:
+                vl.logger.error('Could not apply the reloaded varken.ini. Error: %s', e)
+            CONFIG = NEW_CONFIG
@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+"""
+Startup and steady-state benchmark suite. Every collector method and DB manager write path runs against local
+stand-in servers that serve the recorded fixtures at tiny, typical and huge library sizes, each benchmark in a fresh
+interpreter. Reports cold and steady-state latency, throughput, allocations and peak RSS, and on request compares them
+with a baseline saved earlier. Baselines are only comparable on the machine that recorded them, so none is committed.
+"""
+import sys
+from json import load, dump
+from time import perf_counter
+from statistics import median
+from tempfile import TemporaryDirectory
+from argparse import ArgumentParser
+from multiprocessing import get_context
+from os.path import abspath, dirname, join, exists
+
+REPO_ROOT = abspath(join(dirname(__file__), '..'))
+sys.path.insert(0, REPO_ROOT)
+
+from standin import StandInProcess, StandInClient  # noqa: E402
+from influx_standin import influx_routes, InfluxStandInClient  # noqa: E402
+from benchmark_fixtures import Library, SIZES, CALENDAR_DAYS  # noqa: E402
+
+BASELINE = join(dirname(abspath(__file__)), 'benchmark_baseline.json')
+
+# Metrics compared against the baseline, and the absolute change below which a difference is noise. A regression
+# also has to exceed the relative --tolerance
+COMPARED = {'median_ms': 1.0, 'alloc_peak_kib': 64, 'rss_peak_mib': 2}
+
+
+class CountingDBManager(object):
+    def __init__(self):
+        self.points = 0
+        self.writes = 0
+
+    def write_points(self, data):
+        self.points += len(data)
+        self.writes += 1
+
+
+def sonarr(url, dbmanager, data_folder):
+    from varken.sonarr import SonarrAPI
+    from varken.structures import SonarrServer
+    return SonarrAPI(SonarrServer(id=1, url=url, api_key='benchmark', queue=True, missing_days=CALENDAR_DAYS,
+                                  future_days=CALENDAR_DAYS), dbmanager)
+
+
+def radarr(url, dbmanager, data_folder):
+    from varken.radarr import RadarrAPI
+    from varken.structures import RadarrServer
+    return RadarrAPI(RadarrServer(id=1, url=url, api_key='benchmark', queue=True, get_missing=True), dbmanager)
+
+
+def lidarr(url, dbmanager, data_folder):
+    from varken.lidarr import LidarrAPI
+    from varken.structures import SonarrServer
+    return LidarrAPI(SonarrServer(id=1, url=url, api_key='benchmark', queue=True, missing_days=CALENDAR_DAYS,
+                                  future_days=CALENDAR_DAYS), dbmanager)
+
+
+def tautulli(url, dbmanager, data_folder):
+    from varken.tautulli import TautulliAPI
+    from varken.structures import TautulliServer
+    return TautulliAPI(TautulliServer(id=1, url=url, api_key='benchmark', get_activity=True, get_stats=True),
+                       dbmanager, None)
+
+
+def ombi(url, dbmanager, data_folder):
+    from varken.ombi import OmbiAPI
+    from varken.structures import OmbiServer
+    return OmbiAPI(OmbiServer(id=1, url=url, api_key='benchmark', request_type_counts=True,
+                              request_total_counts=True, issue_status_counts=True), dbmanager)
+
+
+def overseerr(url, dbmanager, data_folder, latest=10):
+    from varken.overseerr import OverseerrAPI
+    from varken.structures import OverseerrServer
+    return OverseerrAPI(OverseerrServer(id=1, url=url, api_key='benchmark', get_request_total_counts=True,
+                                        num_latest_requests_to_fetch=latest), dbmanager)
+
+
+def sickchill(url, dbmanager, data_folder):
+    from varken.sickchill import SickChillAPI
+    from varken.structures import SickChillServer
+    return SickChillAPI(SickChillServer(id=1, url=url, api_key='benchmark', get_missing=True), dbmanager)
+
+
+def unifi(url, dbmanager, data_folder, site_stats=False):
+    from varken.unifi import UniFiAPI
+    from varken.structures import UniFiServer
+    return UniFiAPI(UniFiServer(id=1, url=url, site='Default', usg_name='gateway', get_site_stats=site_stats),
+                    dbmanager, data_folder)
+
+
+def influxdb(url, prometheus_exporter=None):
+    from varken.dbmanager import DBManager
+    from varken.structures import InfluxServer
+    host, port = url.rsplit(':', 1)
+    return DBManager(InfluxServer(url=host.split('//')[-1], port=int(port)), prometheus_exporter=prometheus_exporter)
+
+
+def influxdb2(url, prometheus_exporter=None):
+    from varken.influxdb2manager import InfluxDB2Manager
+    from varken.structures import Influx2Server
+    return InfluxDB2Manager(Influx2Server(url=url), prometheus_exporter=prometheus_exporter)
+
+
+def prometheus(url, prometheus_exporter=None):
+    from varken.prometheus import PrometheusExporter
+    from varken.noopmanager import NoopDBManager
+    return NoopDBManager(prometheus_exporter=PrometheusExporter(addr='127.0.0.1', port=0))
+
+
+def refresh_calendar(collector):
+    # The Missing and Future jobs share one calendar fetch. Drop it so every iteration polls once
+    collector.calendar_cache.clear()
+    collector.get_calendar('Missing')
+    collector.get_calendar('Future')
+
+
+# name: (upstream, collector factory, call). DB managers take the points of the library size instead
+COLLECTORS = {
+    'sonarr.get_queue': ('sonarr', sonarr, lambda c: c.get_queue()),
+    'sonarr.get_queue_incremental': ('sonarr', sonarr, lambda c: c.get_queue_incremental()),
+    'sonarr.get_calendar': ('sonarr', sonarr, refresh_calendar),
+    'radarr.get_queue': ('radarr', radarr, lambda c: c.get_queue()),
+    'radarr.get_missing': ('radarr', radarr, lambda c: c.get_missing()),
+    'lidarr.get_queue': ('lidarr', lidarr, lambda c: c.get_queue()),
+    'lidarr.get_calendar': ('lidarr', lidarr, refresh_calendar),
+    'tautulli.get_activity': ('tautulli', tautulli, lambda c: c.get_activity()),
+    'tautulli.get_stats': ('tautulli', tautulli, lambda c: c.get_stats()),
+    'ombi.get_request_counts': ('ombi', ombi, lambda c: c.get_request_counts()),
+    'ombi.get_all_requests': ('ombi', ombi, lambda c: c.get_all_requests()),
+    'ombi.get_issue_counts': ('ombi', ombi, lambda c: c.get_issue_counts()),
+    'overseerr.get_request_counts': ('overseerr', overseerr, lambda c: c.get_request_counts()),
+    'overseerr.get_latest_requests': ('overseerr', overseerr, lambda c: c.get_latest_requests()),
+    'sickchill.get_missing': ('sickchill', sickchill, lambda c: c.get_missing()),
+    'unifi.get_usg_stats': ('unifi', unifi, lambda c: c.get_usg_stats()),
+    'unifi.get_site_stats': ('unifi', lambda *args: unifi(*args, site_stats=True), lambda c: c.get_site_stats())
+}
+SINKS = {
+    'influxdb.write_points': influxdb,
+    'influxdb2.write_points': influxdb2,
+    'prometheus.observe_points': prometheus
+}
+
+
+def upstream_routes(name, size, sink_options=None):
+    """Route table of the stand-in for a benchmark. Runs in the stand-in's interpreter"""
+    if name in COLLECTORS:
+        return Library(size).routes(COLLECTORS[name][0])
+    return influx_routes('v2.7.4' if name.startswith('influxdb2') else '1.8.10', seed=0, **(sink_options or {}))
+
+
+def run_benchmark(name, size, iterations, url):
+    """Run one benchmark in this interpreter against the stand-in server at url and return its measurements"""
+    from tracemalloc import start, stop, get_traced_memory
+    from resource import getrusage, RUSAGE_SELF
+
+    server = StandInClient(url) if name in COLLECTORS else InfluxStandInClient(url)
+    with TemporaryDirectory() as data_folder:
+        if name in COLLECTORS:
+            service, factory, call = COLLECTORS[name]
+            counter = CountingDBManager()
+            if service == 'overseerr':
+                target = factory(server.url, counter, data_folder, latest=SIZES[size]['latest'])
+            else:
+                target = factory(server.url, counter, data_folder)
+
+            def measured():
+                call(target)
+        else:
+            target = SINKS[name](server.url)
+            payload = Library(size).points()
+            counter = CountingDBManager()
+
+            def measured():
+                target.write_points(payload)
+                counter.write_points(payload)
+
+        start_time = perf_counter()
+        measured()
+        cold = perf_counter() - start_time
+
+        server.reset_stats()
+        points_before = counter.points
+        timings = []
+        for _ in range(iterations):
+            start_time = perf_counter()
+            measured()
+            timings.append(perf_counter() - start_time)
+        served = server.stats()
+        points = counter.points - points_before
+        # Sinks are credited with the points the stand-in accepted, so failed writes do not count as throughput
+        accepted = server.influx_stats() if name in SINKS and name != 'prometheus.observe_points' else None
+        if accepted is not None:
+            points = accepted['points']
+
+        start()
+        measured()
+        alloc_peak = get_traced_memory()[1]
+        stop()
+
+    timings.sort()
+    total = sum(timings)
+    results = {
+        'cold_ms': cold * 1000,
+        'median_ms': median(timings) * 1000,
+        'p95_ms': timings[min(len(timings) - 1, int(len(timings) * 0.95))] * 1000,
+        'points_per_run': points / iterations,
+        'points_per_s': points / total if total else 0,
+        'requests_per_s': served['requests'] / total if total else 0,
+        'mib_per_s': served['bytes_out'] / total / 1048576 if total else 0,
+        'alloc_peak_kib': alloc_peak / 1024,
+        'rss_peak_mib': getrusage(RUSAGE_SELF).ru_maxrss / 1024
+    }
+    if accepted is not None:
+        results['failed_writes'] = accepted['failed']
+    return results
+
+
+def run_startup(runs):
+    from benchmark_startup import write_config, measure
+
+    with TemporaryDirectory() as folder:
+        write_config(folder, 'sonarr')
+        results = [measure(folder, eager=False) for _ in range(runs)]
+    timings = sorted(result['seconds'] * 1000 for result in results)
+    return {
+        'cold_ms': timings[-1],
+        'median_ms': median(timings),
+        'p95_ms': timings[-1],
+        'rss_peak_mib': median(result['max_rss_kb'] for result in results) / 1024
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Return (key, metric, baseline, current) for every metric that regressed beyond tolerance"""
+    regressions = []
+    for key, metrics in results.items():
+        for metric, noise in COMPARED.items():
+            before, after = baseline.get(key, {}).get(metric), metrics.get(metric)
+            if before is None or after is None:
+                continue
+            if after - before > noise and after > before * (1 + tolerance):
+                regressions.append((key, metric, before, after))
+    return regressions
+
+
+def print_table(results, baseline):
+    columns = ['cold_ms', 'median_ms', 'p95_ms', 'points_per_s', 'requests_per_s', 'alloc_peak_kib', 'rss_peak_mib']
+    print(f'{"benchmark":<42}' + ''.join(f'{column:>15}' for column in columns) + f'{"vs baseline":>13}')
+    for key, metrics in results.items():
+        before = baseline.get(key, {}).get('median_ms')
+        delta = f'{(metrics["median_ms"] / before - 1) * 100:+.0f}%' if before else '-'
+        print(f'{key:<42}' + ''.join(f'{metrics.get(column, 0):>15.1f}' for column in columns) + f'{delta:>13}')
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(prog='benchmark', description='Varken collector and write path benchmarks')
+    parser.add_argument("-s", "--size", action='append', choices=list(SIZES), help='Library size. Repeatable')
+    parser.add_argument("-k", "--filter", default='', help='Only run benchmarks whose name contains this')
+    parser.add_argument("-n", "--iterations", default=10, type=int, help='Steady-state runs per benchmark')
+    parser.add_argument("-b", "--baseline", help='Baseline file to compare with. Nothing is compared without it')
+    parser.add_argument("-t", "--tolerance", default=0.5, type=float, help='Allowed regression ratio')
+    parser.add_argument("--save-baseline", action='store_true',
+                        help=f'Store the results as the new baseline, in --baseline or {BASELINE}')
+    parser.add_argument("--sink-latency", default=0, type=float, help='Seconds the InfluxDB stand-in adds per request')
+    parser.add_argument("--sink-error-rate", default=0, type=float, help='Share of writes the InfluxDB stand-in fails')
+    opts = parser.parse_args()
+
+    if opts.baseline and not opts.save_baseline and not exists(opts.baseline):
+        print(f'Baseline {opts.baseline} does not exist. Record one with --save-baseline')
+        exit(2)
+
+    sizes = opts.size or list(SIZES)
+    names = [name for name in list(COLLECTORS) + list(SINKS) if opts.filter in name]
+    results = {}
+    sink_options = {'latency': opts.sink_latency, 'error_rate': opts.sink_error_rate}
+
+    if opts.filter in 'startup':
+        results['startup'] = run_startup(max(3, opts.iterations // 2))
+
+    # A fresh interpreter per benchmark keeps the peak RSS and the caches of one benchmark out of the next
+    context = get_context('spawn')
+    for size in sizes:
+        for name in names:
+            with StandInProcess(upstream_routes, name, size, sink_options) as server, context.Pool(1) as pool:
+                results[f'{name}[{size}]'] = pool.apply(run_benchmark, (name, size, opts.iterations, server.url))
+
+    baseline = {}
+    baseline_path = opts.baseline or BASELINE
+    if exists(baseline_path) and (opts.baseline or opts.save_baseline):
+        with open(baseline_path) as baseline_file:
+            baseline = load(baseline_file)
+
+    print_table(results, baseline if opts.baseline else {})
+
+    if opts.save_baseline:
+        baseline.update(results)
+        with open(baseline_path, 'w') as baseline_file:
+            dump(baseline, baseline_file, indent=2, sort_keys=True)
+        print(f'Baseline written to {baseline_path}')
+    elif opts.baseline:
+        regressions = compare(results, baseline, opts.tolerance)
+        for key, metric, before, after in regressions:
+            print(f'REGRESSION {key} {metric}: {before:.1f} -> {after:.1f}')
+        exit(1 if regressions else 0)
@@ -0,0 +1,288 @@
+"""
+Size-scalable upstream fixtures for the benchmarks. Every endpoint is generated from one recorded record in
+benchmark_fixtures.json, cloned with fresh ids, titles and dates until it reaches the size of a tiny, typical or
+huge library. Replies are encoded once so the stand-in servers do not weigh on the collector timings.
+"""
+from copy import deepcopy
+from json import load, dumps
+from os.path import dirname, join
+from datetime import date, datetime, timedelta, timezone
+
+with open(join(dirname(__file__), 'benchmark_fixtures.json')) as fixtures_file:
+    RECORDED = load(fixtures_file)
+
+# Item counts per library size
+SIZES = {
+    'tiny': {'queue': 5, 'library': 25, 'calendar': 14, 'history': 5, 'streams': 1, 'libraries': 3, 'requests': 10,
+             'latest': 10, 'missing': 10, 'devices': 3, 'clients': 10, 'points': 10},
+    'typical': {'queue': 40, 'library': 800, 'calendar': 120, 'history': 50, 'streams': 8, 'libraries': 6,
+                'requests': 250, 'latest': 50, 'missing': 150, 'devices': 15, 'clients': 120, 'points': 500},
+    'huge': {'queue': 1500, 'library': 15000, 'calendar': 1500, 'history': 1000, 'streams': 60, 'libraries': 20,
+             'requests': 4000, 'latest': 250, 'missing': 3000, 'devices': 150, 'clients': 2000, 'points': 10000}
+}
+
+# Days of calendar before and after today. The benchmark servers use the same window
+CALENDAR_DAYS = 7
+
+
+def clone(template, **changes):
+    record = deepcopy(template)
+    record.update(changes)
+    return record
+
+
+def encode(reply):
+    return dumps(reply).encode()
+
+
+def paged(records):
+    """Serve records as an *arr paging envelope, encoding each requested page once"""
+    pages = {}
+
+    def route(method, path, query, body):
+        page, size = int(query.get('page', 1)), int(query.get('pageSize', 10))
+        if (page, size) not in pages:
+            pages[(page, size)] = encode({'page': page, 'pageSize': size, 'sortKey': 'timeleft',
+                                          'sortDirection': 'ascending', 'totalRecords': len(records),
+                                          'records': records[(page - 1) * size:page * size]})
+        return pages[(page, size)]
+    return route
+
+
+def by_id(records, key='id', envelope=None):
+    """Serve /endpoint/<id> from records, optionally wrapped by envelope(record)"""
+    encoded = {str(record[key]): encode(envelope(record) if envelope else record) for record in records}
+
+    def route(method, path, query, body):
+        reply = encoded.get(path.rsplit('/', 1)[-1])
+        return reply if reply is not None else (404, {'message': 'NotFound'})
+    return route
+
+
+def mac(vendor, index):
+    return f'{vendor}:{index // 65536 % 256:02x}:{index // 256 % 256:02x}:{index % 256:02x}'
+
+
+def iso(moment):
+    return moment.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+class Library(object):
+    """
+    The upstream libraries of one size. routes(service) returns the route table of a StandInServer for it
+    """
+    def __init__(self, size):
+        self.size = size
+        self.counts = SIZES[size]
+        self.now = datetime.now(timezone.utc).replace(microsecond=0)
+
+    def routes(self, service):
+        return getattr(self, f'{service}_routes')()
+
+    def calendar_day(self, index):
+        return self.now + timedelta(days=index % (2 * CALENDAR_DAYS + 1) - CALENDAR_DAYS)
+
+    def arr_queue(self, template, library, metadata_id, item_id):
+        records = []
+        for i in range(self.counts['queue']):
+            record = clone(template, id=i + 1, downloadId=f'{template["downloadId"][:-4]}{i:04}',
+                           title=f'{template["title"]}.{i}')
+            record[metadata_id] = i % library + 1
+            record[item_id] = i + 1
+            records.append(record)
+        return records
+
+    def arr_history(self, template, metadata_id, item_id):
+        records = []
+        for i in range(self.counts['history']):
+            record = clone(template, id=i + 1, date=iso(self.now - timedelta(minutes=i)),
+                           downloadId=f'HIST{i:06}', eventType='grabbed' if i % 2 else 'downloadFolderImported')
+            record[metadata_id] = i % self.counts['library'] + 1
+            record[item_id] = i + 1
+            records.append(record)
+        return records
+
+    def sonarr_routes(self):
+        recorded = RECORDED['sonarr']
+        series = [clone(recorded['series'], id=i + 1, title=f'{recorded["series"]["title"]} {i + 1}',
+                        titleSlug=f'{recorded["series"]["titleSlug"]}-{i + 1}', tvdbId=100000 + i)
+                  for i in range(self.counts['library'])]
+        queue = self.arr_queue(recorded['queue'], len(series), 'seriesId', 'episodeId')
+        for i, record in enumerate(queue):
+            record['episode'] = clone(record['episode'], id=i + 1, seriesId=record['seriesId'], episodeNumber=i + 1)
+        calendar = []
+        for i in range(self.counts['calendar']):
+            aired = self.calendar_day(i)
+            calendar.append(clone(recorded['calendar'], id=i + 1, seriesId=i % len(series) + 1,
+                                  episodeNumber=i % 24 + 1, seasonNumber=i // 24 + 1, airDate=str(aired.date()),
+                                  airDateUtc=iso(aired), hasFile=i % 3 == 0))
+        history = self.arr_history(recorded['history'], 'seriesId', 'episodeId')
+        return {
+            '/api/v3/queue': paged(queue),
+            '/api/v3/series': encode(series),
+            '/api/v3/series/*': by_id(series),
+            '/api/v3/calendar': encode(calendar),
+            '/api/v3/history/since': encode(history)
+        }
+
+    def radarr_routes(self):
+        recorded = RECORDED['radarr']
+        movies = [clone(recorded['movie'], id=i + 1, title=f'{recorded["movie"]["title"]} {i + 1}',
+                        tmdbId=1000 + i, titleSlug=str(1000 + i), hasFile=i >= self.counts['missing'],
+                        isAvailable=i % 4 != 0)
+                  for i in range(self.counts['library'])]
+        queue = self.arr_queue(recorded['queue'], len(movies), 'movieId', 'movieId')
+        history = self.arr_history(RECORDED['sonarr']['history'], 'movieId', 'movieId')
+        return {
+            '/api/v3/queue': paged(queue),
+            '/api/v3/movie': encode(movies),
+            '/api/v3/movie/*': by_id(movies),
+            '/api/v3/wanted/missing': paged([movie for movie in movies if not movie['hasFile']]),
+            '/api/v3/history/since': encode(history)
+        }
+
+    def lidarr_routes(self):
+        recorded = RECORDED['lidarr']
+        artists = [clone(recorded['artist'], id=i + 1, artistName=f'{recorded["artist"]["artistName"]} {i + 1}')
+                   for i in range(max(1, self.counts['library'] // 10))]
+        queue = self.arr_queue(recorded['queue'], len(artists), 'artistId', 'albumId')
+        albums = []
+        for i in range(self.counts['calendar']):
+            album = clone(recorded['album'], id=i + 1, artistId=i % len(artists) + 1,
+                          title=f'{recorded["album"]["title"]} {i + 1}', releaseDate=iso(self.calendar_day(i)))
+            album['statistics'] = clone(album['statistics'], percentOfTracks=100.0 if i % 3 == 0 else 50.0)
+            albums.append(album)
+        return {
+            '/api/v1/queue': paged(queue),
+            '/api/v1/artist': encode(artists),
+            '/api/v1/artist/*': by_id(artists),
+            '/api/v1/calendar': encode(albums),
+            '/api/v1/history/since': encode([])
+        }
+
+    def tautulli_routes(self):
+        recorded = RECORDED['tautulli']
+        sessions = [clone(recorded['session'], session_key=str(i + 1), session_id=f'session{i:06}',
+                          username=f'user{i % 25}', friendly_name=f'User {i % 25}',
+                          ip_address=f'10.0.{i // 250}.{i % 250}',
+                          transcode_decision='transcode' if i % 3 == 0 else 'direct play')
+                    for i in range(self.counts['streams'])]
+        activity = clone(recorded['activity'], sessions=sessions, stream_count=str(len(sessions)))
+        libraries = [clone(recorded['library'], section_id=str(i + 1), section_name=f'Library {i + 1}',
+                           section_type=('movie', 'show', 'artist')[i % 3])
+                     for i in range(self.counts['libraries'])]
+        commands = {
+            'get_activity': encode({'response': {'result': 'success', 'message': None, 'data': activity}}),
+            'get_libraries': encode({'response': {'result': 'success', 'message': None, 'data': libraries}})
+        }
+
+        def api(method, path, query, body):
+            return commands.get(query.get('cmd'), (400, {'response': {'result': 'error'}}))
+        return {'/api/v2': api}
+
+    def ombi_routes(self):
+        recorded = RECORDED['ombi']
+        requests = self.counts['requests']
+        movies = [clone(recorded['movie'], id=i + 1, theMovieDbId=1000 + i, title=f'{recorded["movie"]["title"]} {i}',
+                        approved=i % 3 != 0, available=i % 2 == 0, denied=i % 17 == 0)
+                  for i in range(requests - requests // 3)]
+        shows = [clone(recorded['tv'], id=i + 1, tvDbId=100000 + i, title=f'{recorded["tv"]["title"]} {i}')
+                 for i in range(requests // 3)]
+        return {
+            '/api/v1/Request/count': encode(recorded['request_counts']),
+            '/api/v1/Issues/count': encode(recorded['issue_counts']),
+            '/api/v1/Request/movie': encode(movies),
+            '/api/v1/Request/tv': encode(shows)
+        }
+
+    def overseerr_routes(self):
+        recorded = RECORDED['overseerr']
+        results = []
+        for i in range(self.counts['requests']):
+            media_type = 'tv' if i % 3 == 0 else 'movie'
+            result = clone(recorded['request'], id=i + 1, type=media_type)
+            result['media'] = clone(result['media'], id=i + 1, mediaType=media_type, tmdbId=1000 + i, status=i % 5 + 1)
+            results.append(result)
+        movies = [clone(recorded['movie'], id=r['media']['tmdbId'], title=f'Movie {i}')
+                  for i, r in enumerate(results) if r['type'] == 'movie']
+        shows = [clone(recorded['tv'], id=r['media']['tmdbId'], name=f'Show {i}')
+                 for i, r in enumerate(results) if r['type'] == 'tv']
+
+        def request(method, path, query, body):
+            take = int(query.get('take', 20))
+            return {'pageInfo': {'pages': 1, 'pageSize': take, 'results': len(results), 'page': 1},
+                    'results': results[:take]}
+        return {
+            '/api/v1/request/count': encode(recorded['request_counts']),
+            '/api/v1/request': request,
+            '/api/v1/movie/*': by_id(movies),
+            '/api/v1/tv/*': by_id(shows)
+        }
+
+    def sickchill_routes(self):
+        recorded = RECORDED['sickchill']
+        data = {'missed': [], 'today': [], 'soon': [], 'later': []}
+        for i in range(self.counts['missing']):
+            aired = date.today() + timedelta(days=i % 30 - 10)
+            data[list(data)[i % 4]].append(clone(recorded['show'], episode=i % 24 + 1, season=i // 24 + 1,
+                                                 indexerid=100000 + i % 50, show_name=f'Show {i % 50}',
+                                                 airdate=str(aired)))
+        return {'/api/*': encode({'data': data, 'message': '', 'result': 'success'})}
+
+    def unifi_routes(self):
+        recorded = RECORDED['unifi']
+        devices = [clone(recorded['usg'])]
+        for i in range(1, self.counts['devices']):
+            kind = 'ap' if i % 3 else 'switch'
+            devices.append(clone(recorded[kind], _id=f'dev{i:05}', mac=mac('f0:9f:c2', i),
+                                 name=f'{recorded[kind]["name"]}-{i}'))
+        aps = [device['mac'] for device in devices if device['type'] == 'uap'] or [None]
+        clients = [clone(recorded['client'], _id=f'sta{i:05}', mac=mac('3c:22:fb', i), ap_mac=aps[i % len(aps)],
+                         is_wired=i % 5 == 0, sw_mac=devices[-1]['mac'])
+                   for i in range(self.counts['clients'])]
+        basic = [{key: device[key] for key in ('mac', 'model', 'type', 'name', 'state', 'adopted')}
+                 for device in devices]
+        login_reply = (200, {'meta': {'rc': 'ok'}, 'data': []},
+                       {'Set-Cookie': 'unifises=benchmark; Path=/; HttpOnly', 'X-CSRF-Token': 'benchmark'})
+        return {
+            '/api/login': login_reply,
+            '/api/self/sites': encode({'meta': {'rc': 'ok'}, 'data': [recorded['site']]}),
+            '/api/s/default/stat/device-basic': encode({'meta': {'rc': 'ok'}, 'data': basic}),
+            '/api/s/default/stat/device': encode({'meta': {'rc': 'ok'}, 'data': devices}),
+            '/api/s/default/stat/device/*': by_id(devices[:1], key='mac',
+                                                  envelope=lambda device: {'meta': {'rc': 'ok'}, 'data': [device]}),
+            '/api/s/default/stat/sta': encode({'meta': {'rc': 'ok'}, 'data': clients})
+        }
+
+    def points(self):
+        """Influx points shaped like a Tautulli session payload"""
+        now = self.now.isoformat()
+        return [
+            {
+                "measurement": "Tautulli",
+                "tags": {
+                    "type": "Session",
+                    "session_id": f'session{i:06}',
+                    "friendly_name": f'User {i % 25}',
+                    "username": f'user{i % 25}',
+                    "title": f'Game of Thrones - Episode {i}',
+                    "product": "Plex for Android (TV)",
+                    "platform": "Android",
+                    "quality": "720p",
+                    "video_decision": "Direct Play",
+                    "transcode_decision": "direct play",
+                    "media_type": "Episode",
+                    "audio_codec": "AC3",
+                    "stream_audio_codec": "AC3",
+                    "location": "Local",
+                    "player_state": 0,
+                    "server": 1
+                },
+                "time": now,
+                "fields": {
+                    "hash": f'{i:032x}',
+                    "progress_percent": i % 100
+                }
+            }
+            for i in range(self.counts['points'])
+        ]
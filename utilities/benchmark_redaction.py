@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark of the log redaction in BlacklistFilter. Filters log records shaped like Varken's (short messages,
+connection errors carrying URLs and TRACE payload dumps) with a realistic set of blacklisted strings, comparing the
+compiled single-pass filter with the substring loop it replaced.
+"""
+import sys
+from timeit import repeat
+from logging import LogRecord, DEBUG, ERROR
+from argparse import ArgumentParser
+from os.path import abspath, dirname, join
+
+REPO_ROOT = abspath(join(dirname(__file__), '..'))
+sys.path.insert(0, REPO_ROOT)
+
+from varken.varkenlogger import BlacklistFilter, TRACE  # noqa: E402
+from benchmark_fixtures import Library  # noqa: E402
+
+
+class LoopBlacklistFilter(BlacklistFilter):
+    """The filter before the compiled pattern: a substring search and replace per string over msg and every arg"""
+    def filter(self, record):
+        for item in self.filtered_strings:
+            try:
+                if item in record.msg:
+                    record.msg = record.msg.replace(item, 8 * '*' + item[-5:])
+                if any(item in str(arg) for arg in record.args):
+                    record.args = tuple(arg.replace(item, 8 * '*' + item[-5:]) if isinstance(arg, str) else arg
+                                        for arg in record.args)
+            except TypeError:
+                pass
+        return True
+
+
+def secrets(servers):
+    """Blacklisted strings of a config with servers per service, including the derived domain and no-port ones"""
+    strings = []
+    for service in ('sonarr', 'radarr', 'lidarr', 'tautulli', 'ombi', 'overseerr', 'sickchill'):
+        for server_id in range(1, servers + 1):
+            url = f'{service}{server_id}.domain.tld:8989/{service}'
+            strings += [url, f'{server_id:02}{service}apikey0123456789abcdef']
+            strings += [url.split('/')[0], url.split(':')[0]]
+    return set(strings + ['influxdb.domain.tld', 'root', 'unifi-user', 'unifi-password'])
+
+
+def records(size):
+    payload = Library(size).points()
+    return {
+        'short': (DEBUG, 'Registered HTTP listener route %s %s', ('POST', '/webhook/sonarr/1')),
+        'error': (ERROR, 'Cannot resolve the url/ip/port. Check connectivity. Error: %s',
+                  (ConnectionError("HTTPConnectionPool(host='sonarr1.domain.tld', port=8989): Max retries exceeded "
+                                   "with url: /api/v3/queue?apikey=01sonarrapikey0123456789abcdef"),)),
+        'payload': (TRACE, 'Writing Data to InfluxDB %s', (payload,))
+    }
+
+
+def measure(filter_class, strings, record, number):
+    level, msg, args = record
+    blacklist = filter_class(strings)
+
+    def run():
+        blacklist.filter(LogRecord('varken', level, __file__, 0, msg, args, None))
+    return min(repeat(run, number=number, repeat=5)) / number
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(prog='benchmark_redaction', description='BlacklistFilter micro-benchmark')
+    parser.add_argument("-s", "--size", default='typical', choices=['tiny', 'typical', 'huge'],
+                        help='Library size of the payload dump')
+    parser.add_argument("--servers", default=2, type=int, help='Servers per service in the config')
+    parser.add_argument("-n", "--number", default=20, type=int, help='Records filtered per timing')
+    opts = parser.parse_args()
+
+    strings = secrets(opts.servers)
+    print(f'{len(strings)} blacklisted strings')
+    print(f'{"record":<10}{"loop us":>14}{"compiled us":>14}{"speedup":>10}')
+    for name, record in records(opts.size).items():
+        loop = measure(LoopBlacklistFilter, strings, record, opts.number)
+        compiled = measure(BlacklistFilter, strings, record, opts.number)
+        print(f'{name:<10}{loop * 1e6:>14.1f}{compiled * 1e6:>14.1f}{loop / compiled:>9.1f}x')
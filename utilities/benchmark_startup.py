@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Cold-start benchmark. Every run starts a fresh interpreter that imports Varken, parses a varken.ini with a single
+enabled service and builds its collectors, then reports the wall time, peak RSS and the modules it loaded.
+The eager mode imports every collector and sink up front, the way Varken started before the lazy service registry.
+"""
+import sys
+from re import sub
+from json import loads
+from shutil import copyfile
+from statistics import median
+from subprocess import run, PIPE
+from tempfile import TemporaryDirectory
+from argparse import ArgumentParser
+from os.path import abspath, dirname, join
+
+REPO_ROOT = abspath(join(dirname(__file__), '..'))
+sys.path.insert(0, REPO_ROOT)
+
+from varken.scheduler import SERVICES  # noqa: E402
+
+HEAVY_MODULES = ['geoip2', 'influxdb', 'influxdb_client', 'prometheus_client', 'distro']
+EAGER_IMPORTS = [entry_point.split(':')[0] for entry_point, _, _ in SERVICES.values()] + [
+    'varken.dbmanager', 'varken.influxdb2manager', 'varken.prometheus', 'varken.listener', 'distro']
+
+STARTUP = """
+import sys
+from json import dumps
+from time import perf_counter
+from resource import getrusage, RUSAGE_SELF
+from importlib import import_module
+start = perf_counter()
+sys.path.insert(0, {root!r})
+for module in {eager!r}:
+    try:
+        import_module(module)
+    except ImportError:
+        pass
+import Varken
+from varken.iniparser import INIParser
+from varken.scheduler import JobManager
+from varken.noopmanager import NoopDBManager
+jobs = JobManager(NoopDBManager(), {folder!r})
+jobs.apply(INIParser({folder!r}))
+print(dumps({{'seconds': perf_counter() - start, 'max_rss_kb': getrusage(RUSAGE_SELF).ru_maxrss,
+              'modules': sorted(m for m in sys.modules if m.split('.')[0] in {heavy!r})}}))
+"""
+
+
+def write_config(folder, service):
+    """Copy the example config with only one server of service enabled and InfluxDB disabled"""
+    example = join(REPO_ROOT, 'data', 'varken.example.ini')
+    copyfile(example, join(folder, 'varken.example.ini'))
+    with open(example) as f:
+        config = f.read()
+    config = sub(r'(?m)^(\w+)_server_ids = .*$', lambda m: f'{m.group(1)}_server_ids = '
+                 f'{"1" if m.group(1) == service else "false"}', config)
+    config = sub(r'\[influxdb\]\nenabled = true', '[influxdb]\nenabled = false', config)
+    with open(join(folder, 'varken.ini'), 'w') as f:
+        f.write(config)
+
+
+def measure(folder, eager):
+    code = STARTUP.format(root=REPO_ROOT, folder=folder, heavy=HEAVY_MODULES, eager=EAGER_IMPORTS if eager else [])
+    result = run([sys.executable, '-c', code], stdout=PIPE, stderr=PIPE, cwd=folder, universal_newlines=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    return loads(result.stdout.strip().splitlines()[-1])
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(prog='benchmark_startup', description='Varken cold-start benchmark')
+    parser.add_argument("-s", "--service", default='sonarr', choices=[s for s in SERVICES if s != 'tautulli'],
+                        help='Service enabled in the benchmark config')
+    parser.add_argument("-r", "--runs", default=5, type=int, help='Interpreter starts per mode')
+    opts = parser.parse_args()
+
+    with TemporaryDirectory() as folder:
+        write_config(folder, opts.service)
+        print(f'{"mode":<8}{"median s":>10}{"peak RSS MiB":>14}  heavy modules')
+        for mode in ('eager', 'lazy'):
+            runs = [measure(folder, mode == 'eager') for _ in range(opts.runs)]
+            seconds = median(r['seconds'] for r in runs)
+            rss = median(r['max_rss_kb'] for r in runs) / 1024
+            modules = sorted({m.split('.')[0] for m in runs[-1]['modules']})
+            print(f'{mode:<8}{seconds:>10.3f}{rss:>14.1f}  {", ".join(modules) or "-"}')
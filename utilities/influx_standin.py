@@ -0,0 +1,374 @@
+#!/usr/bin/env python3
+"""
+Local InfluxDB stand-in for exercising DBManager and InfluxDB2Manager without an InfluxDB. Speaks enough of the v1
+API (/ping, /query for databases and retention policies, /write) and the v2 API (/api/v2/write, buckets, orgs,
+signin) for both managers, and accounts for every point written. Latency, random or scripted failures and a
+points-per-second cap can be configured to look at the write path under failure and saturation.
+
+Run it standalone and point varken.ini at it:
+
+    python3 utilities/influx_standin.py --port 8086 --latency 0.05 --error-rate 0.1
+
+or check that DBManager and InfluxDB2Manager write, and drop, exactly what they are given:
+
+    python3 utilities/influx_standin.py --self-test
+"""
+import sys
+import re
+from datetime import datetime, timezone
+from os.path import abspath, dirname, join
+from gzip import decompress
+from json import loads, dumps
+from time import sleep, monotonic
+from random import Random
+from threading import Lock, Event
+from argparse import ArgumentParser
+from urllib.parse import parse_qsl
+from collections import Counter
+from urllib.request import urlopen, Request
+
+from standin import StandInServer, StandInClient, CONTROL
+
+# Quoted or bare identifiers of the InfluxQL statements the v1 client sends
+NAME = r'(?:"((?:[^"\\]|\\.)*)"|(\w+))'
+CREATE_DATABASE = re.compile(rf'CREATE\s+DATABASE\s+{NAME}', re.IGNORECASE)
+SHOW_POLICIES = re.compile(rf'SHOW\s+RETENTION\s+POLICIES(?:\s+ON\s+{NAME})?', re.IGNORECASE)
+CREATE_POLICY = re.compile(rf'CREATE\s+RETENTION\s+POLICY\s+{NAME}\s+ON\s+{NAME}\s+DURATION\s+(\S+)'
+                           rf'\s+REPLICATION\s+(\d+)(?:\s+SHARD\s+DURATION\s+(\S+))?(\s+DEFAULT)?', re.IGNORECASE)
+# Measurement of a line protocol line: everything up to the first unescaped comma or space
+MEASUREMENT = re.compile(r'^((?:[^\\, ]|\\.)+)')
+
+
+def name(match, group=1):
+    return match.group(group) if match.group(group) is not None else match.group(group + 1)
+
+
+def v1_results(*series, error=None):
+    result = {'statement_id': 0}
+    if series:
+        result['series'] = list(series)
+    if error:
+        result['error'] = error
+    return {'results': [result]}
+
+
+def v2_error(status, code, message, headers=None):
+    return status, {'code': code, 'message': message}, headers or {}
+
+
+class InfluxStandIn(object):
+    """
+    State and accounting of one stand-in InfluxDB. A version starting with 1 serves the v1 API plus the v2
+    compatibility write endpoint InfluxDB 1.8 has, anything else the v2 API. routes() is the route table of a
+    StandInServer.
+    """
+    def __init__(self, version='1.8.10', latency=0, jitter=0, error_rate=0, error_status=503,
+                 max_points_per_second=0, org='server', seed=None):
+        self.version = version
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.max_points_per_second = max_points_per_second
+        self.random = Random(seed)
+        self.lock = Lock()
+        self.scripted = []
+
+        self.orgs = {'1a2b3c4d5e6f7081': org}
+        self.databases = {}
+        self.buckets = {}
+        self.reset_stats()
+
+    @property
+    def v1(self):
+        return self.version.lstrip('v').startswith('1')
+
+    def fail_next(self, count, status=None):
+        """Fail the next count writes with status, or error_status"""
+        with self.lock:
+            self.scripted.extend([status or self.error_status] * count)
+
+    def reset_stats(self):
+        with self.lock:
+            self.writes = 0
+            self.points = 0
+            self.bytes = 0
+            self.failed = 0
+            self.throttled = 0
+            self.by_target = Counter()
+            self.by_measurement = Counter()
+            self.first_write = None
+            self.last_write = None
+            self.window = (0, 0)
+
+    def stats(self):
+        with self.lock:
+            elapsed = (self.last_write - self.first_write) if self.writes > 1 else 0
+            return {
+                'version': self.version,
+                'writes': self.writes,
+                'points': self.points,
+                'bytes': self.bytes,
+                'failed': self.failed,
+                'throttled': self.throttled,
+                'points_per_s': self.points / elapsed if elapsed else 0,
+                'by_target': dict(self.by_target),
+                'by_measurement': dict(self.by_measurement)
+            }
+
+    def routes(self):
+        routes = {
+            '/ping': self.ping,
+            '/health': self.health,
+            '/api/v2/write': self.write_v2,
+            '/api/v2/signin': self.signin,
+            '/api/v2/signout': self.signin
+        }
+        if self.v1:
+            routes.update({'/query': self.query, '/write': self.write_v1})
+        else:
+            routes.update({'/api/v2/buckets': self.buckets_v2, '/api/v2/orgs': self.orgs_v2})
+        routes = {path: self.delayed(route) for path, route in routes.items()}
+        routes.update({CONTROL + 'influx': lambda *args: self.stats(), CONTROL + 'influx/reset': self.control_reset})
+        return routes
+
+    def control_reset(self, method, path, query, body):
+        self.reset_stats()
+        return 204, None
+
+    def delayed(self, route):
+        def handler(method, path, query, body):
+            if self.latency or self.jitter:
+                sleep(self.latency + self.random.uniform(0, self.jitter))
+            return route(method, path, query, body)
+        return handler
+
+    def ping(self, method, path, query, body):
+        return 204, None, {'X-Influxdb-Version': self.version, 'X-Influxdb-Build': 'OSS'}
+
+    def health(self, method, path, query, body):
+        return {'name': 'influxdb', 'message': 'ready for queries and writes', 'status': 'pass',
+                'version': self.version}
+
+    # v1
+    def query(self, method, path, query, body):
+        if body and not query.get('q'):
+            query = dict(query, **dict(parse_qsl(body.decode())))
+        statement = query.get('q', '').strip().rstrip(';')
+
+        with self.lock:
+            if re.match(r'SHOW\s+DATABASES', statement, re.IGNORECASE):
+                return v1_results({'name': 'databases', 'columns': ['name'],
+                                   'values': [[database] for database in self.databases]})
+
+            match = CREATE_DATABASE.match(statement)
+            if match:
+                self.databases.setdefault(name(match), {'autogen': ('0s', '168h0m0s', 1, True)})
+                return v1_results()
+
+            match = SHOW_POLICIES.match(statement)
+            if match:
+                database = name(match) if match.lastindex else query.get('db')
+                if database not in self.databases:
+                    return v1_results(error=f'database not found: {database}')
+                policies = self.databases[database]
+                return v1_results({'columns': ['name', 'duration', 'shardGroupDuration', 'replicaN', 'default'],
+                                   'values': [[policy, *settings[:3], settings[3]]
+                                              for policy, settings in policies.items()]})
+
+            match = CREATE_POLICY.match(statement)
+            if match:
+                policy, database = name(match, 1), name(match, 3)
+                if database not in self.databases:
+                    return v1_results(error=f'database not found: {database}')
+                policies = self.databases[database]
+                if match.group(8):
+                    policies.update({key: settings[:3] + (False,) for key, settings in policies.items()})
+                policies[policy] = (match.group(5), match.group(7) or '1h0m0s', int(match.group(6)),
+                                    bool(match.group(8)))
+                return v1_results()
+
+        return 400, v1_results(error=f'statement not supported by the stand-in: {statement}')
+
+    def write_v1(self, method, path, query, body):
+        database, policy = query.get('db'), query.get('rp')
+        if database not in self.databases:
+            return 404, {'error': f'database not found: "{database}"'}
+        if policy and policy not in self.databases[database]:
+            return 500, {'error': f'retention policy not found: {policy}'}
+        return self.accept(f'{database}/{policy}' if policy else database, body, v1=True)
+
+    # v2
+    def write_v2(self, method, path, query, body):
+        bucket = query.get('bucket')
+        if self.v1:
+            # 1.8 maps bucket to database/retention policy
+            database, _, policy = (bucket or '').partition('/')
+            if database not in self.databases or (policy and policy not in self.databases[database]):
+                return v2_error(404, 'not found', f'database not found: "{database}"')
+        elif bucket not in self.buckets and bucket not in [b['id'] for b in self.buckets.values()]:
+            return v2_error(404, 'not found', f'bucket "{bucket}" not found')
+        return self.accept(bucket, body)
+
+    def buckets_v2(self, method, path, query, body):
+        with self.lock:
+            if method == 'POST':
+                request = loads(body)
+                if request.get('name') in self.buckets:
+                    return v2_error(422, 'conflict', f'bucket with name {request.get("name")} already exists')
+                bucket = {'id': f'{len(self.buckets) + 1:016x}', 'orgID': request.get('orgID'), 'type': 'user',
+                          'name': request.get('name'), 'retentionRules': request.get('retentionRules') or [],
+                          'createdAt': '2024-01-01T00:00:00Z', 'updatedAt': '2024-01-01T00:00:00Z',
+                          'links': {}, 'labels': []}
+                self.buckets[bucket['name']] = bucket
+                return 201, bucket
+
+            buckets = [bucket for bucket in self.buckets.values() if query.get('name') in (None, bucket['name'])]
+            return {'links': {'self': '/api/v2/buckets'}, 'buckets': buckets}
+
+    def orgs_v2(self, method, path, query, body):
+        wanted = query.get('org') or query.get('orgID')
+        orgs = [{'id': org_id, 'name': org, 'description': '', 'links': {}}
+                for org_id, org in self.orgs.items() if wanted in (None, org, org_id)]
+        return {'links': {'self': '/api/v2/orgs'}, 'orgs': orgs}
+
+    def signin(self, method, path, query, body):
+        return 204, None, {'Set-Cookie': 'influxdb-oss-session=standin; Path=/api/; HttpOnly'}
+
+    def accept(self, target, body, v1=False):
+        """Account for a line protocol body, or fail it as configured"""
+        now = monotonic()
+        lines = [line for line in self.decode(body).split('\n') if line.strip() and not line.startswith('#')]
+
+        with self.lock:
+            status = self.scripted.pop(0) if self.scripted else None
+            if status is None and self.error_rate and self.random.random() < self.error_rate:
+                status = self.error_status
+            if status is None and self.max_points_per_second:
+                second, used = self.window
+                if int(now) != second:
+                    second, used = int(now), 0
+                if used + len(lines) > self.max_points_per_second:
+                    self.throttled += 1
+                    status = 429
+                else:
+                    self.window = (second, used + len(lines))
+
+            if status is not None:
+                self.failed += 1
+                headers = {'Retry-After': '1'} if status in (429, 503) else {}
+                if v1:
+                    return status, {'error': 'injected failure'}, headers
+                return v2_error(status, 'too many requests' if status == 429 else 'internal error',
+                                'injected failure', headers)
+
+            self.writes += 1
+            self.points += len(lines)
+            self.bytes += len(body)
+            self.by_target[target] += len(lines)
+            for line in lines:
+                match = MEASUREMENT.match(line)
+                self.by_measurement[match.group(1) if match else ''] += 1
+            self.first_write = self.first_write or now
+            self.last_write = now
+        return 204, None
+
+    @staticmethod
+    def decode(body):
+        if body[:2] == b'\x1f\x8b':
+            body = decompress(body)
+        return body.decode('utf-8', errors='replace')
+
+
+def influx_routes(version='1.8.10', **options):
+    """Route table of a fresh stand-in, for StandInProcess"""
+    return InfluxStandIn(version, **options).routes()
+
+
+class InfluxStandInClient(StandInClient):
+    """Reads and resets the accounting of an InfluxStandIn running elsewhere"""
+    def reset_stats(self):
+        super().reset_stats()
+        urlopen(Request(self.url + CONTROL + 'influx/reset', method='POST')).read()
+
+    def influx_stats(self):
+        return loads(urlopen(self.url + CONTROL + 'influx').read())
+
+
+def self_test(batches=3, batch_size=50):
+    """
+    Write batches through DBManager against a 1.8 stand-in and InfluxDB2Manager against a 2.x one, then fail one
+    write. Returns the mismatches between what the managers were given and what the stand-in accounted for
+    """
+    sys.path.insert(0, abspath(join(dirname(__file__), '..')))
+    from varken.dbmanager import DBManager
+    from varken.influxdb2manager import InfluxDB2Manager
+    from varken.structures import InfluxServer, Influx2Server
+
+    managers = {
+        '1.8.10': lambda url: DBManager(InfluxServer(url=url.split('//')[-1].rsplit(':', 1)[0],
+                                                     port=int(url.rsplit(':', 1)[1]))),
+        'v2.7.4': lambda url: InfluxDB2Manager(Influx2Server(url=url))
+    }
+    now = datetime.now(timezone.utc).astimezone().isoformat()
+    points = [{'measurement': ('Sonarr', 'Tautulli')[index % 2], 'tags': {'type': 'SelfTest', 'server': 1},
+               'time': now, 'fields': {'hash': str(index)}} for index in range(batch_size)]
+    expected = {'Sonarr': batches * len(points[::2]), 'Tautulli': batches * len(points[1::2])}
+
+    failures = []
+    for version, manager in managers.items():
+        standin = InfluxStandIn(version, seed=0)
+        with StandInServer(standin.routes()) as server:
+            dbmanager = manager(server.url)
+            for _ in range(batches):
+                dbmanager.write_points(points)
+            stats = standin.stats()
+            if (stats['writes'], stats['points'], stats['failed']) != (batches, batches * batch_size, 0):
+                failures.append(f'{version}: {batches} writes of {batch_size} points accounted as {stats["writes"]} '
+                                f'writes of {stats["points"]} points, {stats["failed"]} failed')
+            if stats['by_measurement'] != expected:
+                failures.append(f'{version}: points per measurement {stats["by_measurement"]}, expected {expected}')
+
+            # A failed write is dropped, not retried or counted
+            standin.fail_next(1)
+            dbmanager.write_points(points)
+            stats = standin.stats()
+            if (stats['points'], stats['failed']) != (batches * batch_size, 1):
+                failures.append(f'{version}: a failed write left {stats["points"]} points and {stats["failed"]} '
+                                f'failures, expected {batches * batch_size} and 1')
+        print(f'InfluxDB {version}: {dumps(stats)}', file=sys.stderr)
+    return failures
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(prog='influx_standin', description='Local InfluxDB v1/v2 stand-in')
+    parser.add_argument("--addr", default='127.0.0.1', help='Address to listen on')
+    parser.add_argument("--port", default=8086, type=int, help='Port to listen on')
+    parser.add_argument("--version", default='1.8.10', help='InfluxDB version to report. 2.x serves the v2 API')
+    parser.add_argument("--latency", default=0, type=float, help='Seconds added to every request')
+    parser.add_argument("--jitter", default=0, type=float, help='Up to this many random seconds on top')
+    parser.add_argument("--error-rate", default=0, type=float, help='Share of writes that fail')
+    parser.add_argument("--error-status", default=503, type=int, help='Status of failed writes')
+    parser.add_argument("--max-points-per-second", default=0, type=int, help='Throttle writes above this with 429')
+    parser.add_argument("--report-seconds", default=10, type=int, help='Print the accounting this often')
+    parser.add_argument("--self-test", action='store_true',
+                        help='Check the accounting of DBManager and InfluxDB2Manager writes and exit')
+    opts = parser.parse_args()
+
+    if opts.self_test:
+        failures = self_test()
+        for failure in failures:
+            print(f'FAIL {failure}')
+        print('Self-test failed' if failures else 'Self-test passed')
+        exit(1 if failures else 0)
+
+    standin = InfluxStandIn(opts.version, latency=opts.latency, jitter=opts.jitter, error_rate=opts.error_rate,
+                            error_status=opts.error_status, max_points_per_second=opts.max_points_per_second)
+    server = StandInServer(standin.routes(), addr=opts.addr, port=opts.port)
+    print(f'InfluxDB {opts.version} stand-in listening on {server.url}', file=sys.stderr)
+    stop = Event()
+    try:
+        while not stop.wait(opts.report_seconds):
+            print(dumps(standin.stats()), flush=True)
+    except KeyboardInterrupt:
+        server.close()
@@ -0,0 +1,170 @@
+"""
+Local stand-in HTTP server for benchmarks. Serves a route table from a background thread and counts what it served.
+"""
+from json import dumps, loads
+from time import sleep
+from threading import Thread, Lock, Event
+from multiprocessing import get_context
+from urllib.request import urlopen, Request
+from urllib.parse import urlsplit, parse_qsl
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Control endpoints of a stand-in. They are not counted in its stats
+CONTROL = '/_standin/'
+
+
+class StandInServer(object):
+    """
+    Routes map a path to a reply, or to a callable(method, path, query, body) returning one. A path ending in '*'
+    matches every path starting with it. A reply is a JSON-able object, pre-encoded bytes, or a
+    (status, body[, headers]) tuple.
+    """
+    def __init__(self, routes=None, addr='127.0.0.1', port=0, latency=0):
+        self.routes = routes or {}
+        self.latency = latency
+        self.lock = Lock()
+        self.requests = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.httpd = ThreadingHTTPServer((addr, port), self._handler_class())
+        self.httpd.daemon_threads = True
+        self.url = f'http://{addr}:{self.httpd.server_address[1]}'
+        Thread(target=self.httpd.serve_forever, name='standin', daemon=True).start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def reset_stats(self):
+        with self.lock:
+            self.requests = self.bytes_in = self.bytes_out = 0
+
+    def stats(self):
+        with self.lock:
+            return {'requests': self.requests, 'bytes_in': self.bytes_in, 'bytes_out': self.bytes_out}
+
+    def resolve(self, path):
+        route = self.routes.get(path)
+        if route is None:
+            matches = [key for key in self.routes if key.endswith('*') and path.startswith(key[:-1])]
+            if matches:
+                route = self.routes[max(matches, key=len)]
+        return route
+
+    def reply(self, method, path, query, body):
+        if path == CONTROL + 'stats':
+            return 200, dumps(self.stats()).encode(), {}
+        if path == CONTROL + 'reset':
+            self.reset_stats()
+            return 204, b'', {}
+
+        route = self.resolve(path)
+        if route is None:
+            return 404, b'', {}
+        reply = route(method, path, query, body) if callable(route) else route
+
+        status, headers = 200, {}
+        if isinstance(reply, tuple):
+            status, reply, *extra = reply
+            headers = extra[0] if extra else {}
+        if reply is None:
+            content = b''
+        elif isinstance(reply, bytes):
+            content = reply
+        else:
+            content = dumps(reply).encode()
+        return status, content, headers
+
+    def _handler_class(self):
+        server = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Keep-alive replies are written in two sends. Without this every reply waits out a delayed ACK
+            disable_nagle_algorithm = True
+
+            def _respond(self, method):
+                url = urlsplit(self.path)
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                if server.latency:
+                    sleep(server.latency)
+
+                status, content, headers = server.reply(method, url.path, dict(parse_qsl(url.query)), body)
+                self.send_response(status)
+                self.send_header('Content-Type', headers.pop('Content-Type', 'application/json'))
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                if content and method != 'HEAD':
+                    self.wfile.write(content)
+
+                if url.path.startswith(CONTROL):
+                    return
+                with server.lock:
+                    server.requests += 1
+                    server.bytes_in += length
+                    server.bytes_out += len(content)
+
+            def do_GET(self):
+                self._respond('GET')
+
+            def do_HEAD(self):
+                self._respond('HEAD')
+
+            def do_POST(self):
+                self._respond('POST')
+
+            def log_message(self, format, *args):
+                pass
+
+        return _Handler
+
+
+def _serve(urls, routes_factory, args):
+    server = StandInServer(routes_factory(*args))
+    urls.put(server.url)
+    Event().wait()
+
+
+class StandInClient(object):
+    """Reads and resets the stats of a stand-in server running elsewhere"""
+    def __init__(self, url):
+        self.url = url
+
+    def reset_stats(self):
+        urlopen(Request(self.url + CONTROL + 'reset', method='POST')).read()
+
+    def stats(self):
+        return loads(urlopen(self.url + CONTROL + 'stats').read())
+
+
+class StandInProcess(StandInClient):
+    """
+    A StandInServer running in its own interpreter, so neither its fixtures nor its request handling weigh on the
+    memory and CPU of the code under test. routes_factory(*args) builds the route table in the child and must be
+    importable from it.
+    """
+    def __init__(self, routes_factory, *args):
+        context = get_context('spawn')
+        urls = context.Queue()
+        self.process = context.Process(target=_serve, args=(urls, routes_factory, args), daemon=True)
+        self.process.start()
+        super().__init__(urls.get(timeout=120))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.process.terminate()
+        self.process.join()
@@ -0,0 +1,280 @@
+from time import monotonic
+from abc import ABC, abstractmethod
+from typing import NamedTuple
+from logging import getLogger
+from threading import Lock
+from requests import Session, Request
+from datetime import datetime, timezone, date, timedelta
+
+from varken.helpers import (hashit, connection_handler, fetch_pages, protocol_from_client, QueueModel, TTLCache,
+                            MetadataCache, HistoryCursor, Governor, CircuitBreaker,
+                            HISTORY_DEQUEUE_EVENTS)
+
+
+class ArrSpec(NamedTuple):
+    """
+    Declarative description of an *arr service. queue_item is the queue record field that, together with the
+    downloadId, identifies one queue entry. metadata_id is the field joined against the metadata endpoint.
+    """
+    service: str = None
+    measurement: str = None
+    api: str = None
+    page_size: int = 250
+    queue_structure: type = None
+    queue_params: dict = None
+    queue_item: str = None
+    queue_metadata: bool = True
+    history_params: dict = None
+    metadata_endpoint: str = None
+    metadata_structure: type = None
+    metadata_id: str = None
+    calendar_structure: type = None
+    calendar_params: dict = None
+    calendar_field: str = None
+
+
+def protocol_id(protocol):
+    return 1 if str(protocol).upper() == 'USENET' else 0
+
+
+def local_date(timestamp):
+    """Local calendar date of an *arr UTC timestamp, date.min when it is not set"""
+    if not timestamp:
+        return date.min
+    return datetime.fromisoformat(timestamp.replace('Z', '+00:00')).astimezone().date()
+
+
+class ArrAPI(ABC):
+    """
+    Shared collector engine for the *arr services. Subclasses declare an ArrSpec and implement the entry hooks,
+    the engine does the paging, metadata joins, caching, webhook and history ingestion and the queue payload.
+    Queue entries are (tags, hash_key) tuples.
+    """
+    spec = ArrSpec()
+    calendar_ttl = 60
+    metadata_ttl = 3600
+
+    def __init__(self, server, dbmanager):
+        self.dbmanager = dbmanager
+        self.server = server
+        # Create session to reduce server web thread load
+        self.session = Session()
+        self.session.headers = {'X-Api-Key': self.server.api_key}
+        Governor.attach(self.session, self.name, self.server.limits)
+        CircuitBreaker.attach(self.session, self.name)
+        self.logger = getLogger()
+        self.queue_model = QueueModel()
+        self.queue_history = HistoryCursor()
+        self.calendar_cache = TTLCache(self.calendar_ttl)
+        self.calendar_lock = Lock()
+        self.metadata = None
+        if self.spec.metadata_endpoint:
+            # Metadata is joined locally so the calendar and queue can ask for slim payloads
+            self.metadata = MetadataCache(self.session, self.url(self.spec.metadata_endpoint), self.server.verify_ssl,
+                                          self.spec.metadata_structure, ttl=self.metadata_ttl,
+                                          max_workers=self.server.page_concurrency)
+
+    def __repr__(self):
+        return f"<{self.spec.service}-{self.server.id}>"
+
+    @property
+    def name(self):
+        return f'{self.spec.service}-{self.server.id}'
+
+    def url(self, endpoint):
+        return self.server.url + self.spec.api + endpoint
+
+    def get(self, endpoint, params=None):
+        start = monotonic()
+        req = self.session.prepare_request(Request('GET', self.url(endpoint), params=params))
+        get = connection_handler(self.session, req, self.server.verify_ssl)
+        if get is not False:
+            self.logger.debug('Fetched %s from %s in %.3fs', endpoint, self.name, monotonic() - start)
+        return get
+
+    def get_pages(self, endpoint, params=None):
+        start = monotonic()
+        get = fetch_pages(self.session, self.url(endpoint), params or {}, self.server.verify_ssl,
+                          page_size=self.spec.page_size, max_workers=self.server.page_concurrency)
+        if get is not False:
+            self.logger.debug('Fetched %s records from %s of %s in %.3fs', len(get), endpoint, self.name,
+                              monotonic() - start)
+        return get
+
+    def build(self, structure, records):
+        items = []
+        for record in records:
+            try:
+                items.append(structure(**record))
+            except TypeError as e:
+                self.logger.error('TypeError has occurred : %s while creating %s structure. Data attempted is: %s',
+                                  e, structure.__name__, record)
+        return items
+
+    def get_metadata(self, ids):
+        if self.metadata is None:
+            return {}
+        return self.metadata.get_many(ids)
+
+    def get_calendar_window(self):
+        """
+        Fetch the calendar once for the combined [today - missing_days, today + future_days] window. The decoded
+        items are shared by the Missing and Future jobs for calendar_ttl seconds.
+        """
+        start = str(date.today() - timedelta(days=self.server.missing_days))
+        end = str(date.today() + timedelta(days=self.server.future_days))
+        params = dict(self.spec.calendar_params or {}, start=start, end=end)
+        field = self.spec.calendar_field
+
+        with self.calendar_lock:
+            items = self.calendar_cache.get((start, end))
+            if items is not None:
+                return items
+
+            get = self.get('/calendar', params)
+            if get is False:
+                return
+
+            items = self.build(self.spec.calendar_structure, get)
+
+            if field and self.metadata is not None:
+                # Older versions embed the metadata regardless, so use it to warm the cache
+                self.metadata.update(getattr(item, field) for item in items if isinstance(getattr(item, field), dict))
+                metadata = self.metadata.get_many(getattr(item, self.spec.metadata_id) for item in items)
+                for item in items:
+                    setattr(item, field, metadata.get(getattr(item, self.spec.metadata_id)))
+
+            self.calendar_cache.set((start, end), items)
+            return items
+
+    def get_queue(self):
+        now = datetime.now(timezone.utc).astimezone().isoformat()
+        queue = {}
+
+        get = self.get_pages('/queue', self.spec.queue_params)
+        if get is False:
+            return
+
+        items = self.build(self.spec.queue_structure, get)
+        metadata = {}
+        if self.spec.queue_metadata:
+            metadata = self.get_metadata(getattr(item, self.spec.metadata_id) for item in items)
+
+        for item in items:
+            entry = self.queue_entry(item, metadata.get(getattr(item, self.spec.metadata_id, None)))
+            if entry is not None:
+                queue[(item.downloadId, getattr(item, self.spec.queue_item))] = entry
+
+        self.queue_model.replace(queue)
+        self.dbmanager.write_points(self._queue_points(len(items), queue.values(), now))
+        return True
+
+    def get_queue_incremental(self):
+        """
+        Keep the queue up to date from /history/since. A full get_queue snapshot is taken on the first run and
+        then every reconcile_run_seconds.
+        """
+        now = datetime.now(timezone.utc).astimezone().isoformat()
+
+        with self.queue_history.lock:
+            if self.queue_history.due(self.server.reconcile_run_seconds):
+                self.queue_history.reset()
+                if not self.get_queue():
+                    self.queue_history.last_full = None
+                return
+
+            records = self.queue_history.read(self.session, self.url('/history/since'), self.spec.history_params,
+                                              self.server.verify_ssl)
+            if records is False:
+                return
+
+            metadata = {}
+            if self.spec.queue_metadata:
+                metadata = self.get_metadata(record.get(self.spec.metadata_id) for record in records
+                                             if record.get('eventType') == 'grabbed')
+            for record in records:
+                download_id = record.get('downloadId')
+                if not download_id:
+                    continue
+                if record.get('eventType') == 'grabbed':
+                    entry = self.history_entry(record, metadata.get(record.get(self.spec.metadata_id)))
+                    if entry is not None:
+                        self.queue_model.upsert((download_id, record.get(self.spec.queue_item)), entry)
+                elif record.get('eventType') in HISTORY_DEQUEUE_EVENTS:
+                    self.queue_model.remove_download(download_id)
+
+        queue = self.queue_model.values()
+        self.logger.debug('Applied %s history events for %s. Tracking %s queue items', len(records), self.name,
+                          len(queue))
+        self.dbmanager.write_points(self._queue_points(len(queue), queue, now))
+
+    def ingest_webhook(self, data):
+        """Apply a webhook event to the in-memory queue and write the queue points if it changed"""
+        now = datetime.now(timezone.utc).astimezone().isoformat()
+        if not isinstance(data, dict):
+            return
+        event_type = data.get('eventType')
+        download_id = data.get('downloadId') or data.get('release', {}).get('releaseTitle')
+
+        if event_type == 'Grab' and download_id:
+            release = data.get('release', {})
+            protocol = str(release.get('protocol') or protocol_from_client(data.get('downloadClientType'))).upper()
+            for item_id, entry in self.webhook_entries(data, protocol):
+                self.queue_model.upsert((download_id, item_id), entry)
+        elif event_type in ('Download', 'Upgrade') and download_id:
+            if not self.queue_model.remove_download(download_id):
+                return
+        else:
+            self.logger.debug('Ignoring %s webhook event "%s" for %s', self.spec.measurement, event_type, self.name)
+            return
+
+        queue = self.queue_model.values()
+        self.logger.debug('%s webhook "%s" for %s. Tracking %s queue items', self.spec.measurement, event_type,
+                          self.name, len(queue))
+        self.dbmanager.write_points(self._queue_points(len(queue), queue, now))
+
+    @abstractmethod
+    def queue_entry(self, item, metadata):
+        """Map a queue structure to a (tags, hash_key) entry, or None to skip it"""
+
+    @abstractmethod
+    def history_entry(self, record, metadata):
+        """Map a grabbed history record to a (tags, hash_key) entry, or None to skip it"""
+
+    @abstractmethod
+    def webhook_entries(self, data, protocol):
+        """Yield (item id, entry) for every item in a Grab webhook"""
+
+    def _queue_points(self, count, queue, now):
+        influx_payload = [
+            {
+                "measurement": self.spec.measurement,
+                "tags": {
+                    "type": "Queue",
+                    "server": self.server.id
+                },
+                "time": now,
+                "fields": {
+                    "count": count
+                }
+            }
+        ]
+
+        for tags, hash_key in queue:
+            hash_id = hashit(f'{self.server.id}{hash_key}')
+            influx_payload.append(
+                {
+                    "measurement": self.spec.measurement,
+                    "tags": {
+                        "type": "Queue",
+                        "server": self.server.id,
+                        **tags
+                    },
+                    "time": now,
+                    "fields": {
+                        "hash": hash_id
+                    }
+                }
+            )
+
+        return influx_payload
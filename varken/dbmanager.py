@@ -4,7 +4,10 @@ from logging import getLogger
 from influxdb_client import InfluxDBClient, BucketRetentionRules
 from influxdb_client.client.write_api import SYNCHRONOUS
 from influxdb_client.client.exceptions import InfluxDBError
-from urllib3.exceptions import NewConnectionError
+from urllib3.exceptions import NewConnectionError, HTTPError
+
+from varken.helpers import CircuitBreaker
+from varken.varkenlogger import PointSummary, TRACE
 
 
 class DBManager(object):
@@ -13,6 +16,7 @@ class DBManager(object):
         self.logger = getLogger()
         self.bucket = "varken"
         self.prometheus_exporter = prometheus_exporter
+        self.breaker = CircuitBreaker.get('influxdb', kind='sink')
 
         if self.server.url == "influxdb.domain.tld":
             self.logger.critical("You have not configured your varken.ini. Please read Wiki page for configuration")
@@ -83,14 +87,22 @@ class DBManager(object):
 
     def write_points(self, data):
         d = data
-        self.logger.debug('Writing Data to InfluxDB %s', d)
+        self.logger.debug('Writing %s to InfluxDB', PointSummary(d))
+        self.logger.log(TRACE, 'Writing Data to InfluxDB %s', d)
         self._export_prometheus(d)
+        if not self.breaker.allow():
+            self.logger.debug('InfluxDB is unavailable. Dropping %s points', len(d))
+            return
         write_api = self.influx.write_api(write_options=SYNCHRONOUS)
+        success = False
         try:
             write_api.write(bucket=self.bucket, record=data)
-        except (InfluxDBError, NewConnectionError) as e:
+            success = True
+        except (InfluxDBError, HTTPError) as e:
             self.logger.error('Error writing data to influxdb. Dropping this set of data. '
                               'Check your database! Error: %s', e)
+        finally:
+            self.breaker.record(success)
 
     def _export_prometheus(self, data):
         if not self.prometheus_exporter:
@@ -1,10 +1,14 @@
 from hashlib import md5
-from datetime import date, timedelta
-from time import sleep
+from contextlib import nullcontext
+from datetime import date, datetime, timedelta, timezone
+from time import sleep, monotonic
+from random import uniform
 from logging import getLogger
+from threading import Lock, BoundedSemaphore, local, current_thread
+from requests import Request
+from concurrent.futures import ThreadPoolExecutor
 from ipaddress import IPv4Address
 from urllib.error import HTTPError, URLError
-from geoip2.database import Reader
 from tarfile import open as taropen
 from urllib3 import disable_warnings
 from os import stat, remove, makedirs
@@ -12,10 +16,13 @@ from urllib.request import urlretrieve
 from json.decoder import JSONDecodeError
 from os.path import abspath, join, basename, isdir
 from urllib3.exceptions import InsecureRequestWarning
-from requests.exceptions import InvalidSchema, SSLError, ConnectionError, ChunkedEncodingError
+from requests.exceptions import InvalidSchema, SSLError, ConnectionError, ChunkedEncodingError, Timeout
 
 logger = getLogger()
 
+# (connect, read) timeout in seconds for upstream requests
+REQUEST_TIMEOUT = (10, 120)
+
 
 class GeoIPHandler(object):
     def __init__(self, data_folder, maxmind_license_key):
@@ -29,6 +36,9 @@ class GeoIPHandler(object):
         self.logger.info('Opening persistent connection to the MaxMind DB...')
 
     def reader_manager(self, action=None):
+        # Imported here so geoip2 is only loaded when a Tautulli server needs it
+        from geoip2.database import Reader
+
         if action == 'open':
             try:
                 self.reader = Reader(self.dbfile)
@@ -132,6 +142,359 @@ class GeoIPHandler(object):
             self.logger.warning("Cannot remove MaxMind DB TAR file as it does not exist!")
 
 
+class QueueModel(object):
+    """
+    Thread safe in-memory download queue, keyed by (downloadId, item id)
+    """
+    def __init__(self):
+        self.items = {}
+        self.lock = Lock()
+
+    def replace(self, items):
+        with self.lock:
+            self.items = dict(items)
+
+    def upsert(self, key, item):
+        with self.lock:
+            self.items[key] = item
+
+    def remove_download(self, download_id):
+        with self.lock:
+            keys = [key for key in self.items if key[0] == download_id]
+            for key in keys:
+                del self.items[key]
+        return len(keys)
+
+    def values(self):
+        with self.lock:
+            return list(self.items.values())
+
+
+class TTLCache(object):
+    """
+    Thread safe key/value cache where every entry expires ttl seconds after it was set, or after the ttl given to set
+    """
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.items = {}
+        self.lock = Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                return default
+            if monotonic() > item[0]:
+                del self.items[key]
+                return default
+            return item[1]
+
+    def set(self, key, value, ttl=None):
+        with self.lock:
+            self.items[key] = (monotonic() + (self.ttl if ttl is None else ttl), value)
+
+    def clear(self):
+        with self.lock:
+            self.items = {}
+
+
+class MetadataCache(object):
+    """
+    Per-server cache of *arr series/movie/artist metadata keyed by id. Only unknown or expired ids are fetched,
+    one request per id on a bounded thread pool sharing session like fetch_pages. Entries expire at a random point
+    between ttl / 2 and ttl, so a cold start does not expire, and refetch, the whole library at once every ttl.
+    """
+    def __init__(self, session, url, verify, structure, ttl=3600, max_workers=4):
+        self.session = session
+        self.url = url
+        self.verify = verify
+        self.structure = structure
+        self.max_workers = max_workers
+        self.ttl = ttl
+        self.cache = TTLCache(ttl)
+
+    def get_many(self, ids):
+        ids = set(item_id for item_id in ids if item_id is not None)
+        missing = [item_id for item_id in ids if self.cache.get(item_id) is None]
+
+        if missing:
+            executor = ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(missing))),
+                                          thread_name_prefix=current_thread().name)
+            with executor:
+                for item in executor.map(self._get_one, missing):
+                    if item:
+                        self._set(item)
+
+        found = {item_id: self.cache.get(item_id) for item_id in ids}
+        return {item_id: item for item_id, item in found.items() if item is not None}
+
+    def update(self, items):
+        for item in items:
+            self._set(item)
+
+    def _get_one(self, item_id):
+        req = self.session.prepare_request(Request('GET', f'{self.url}/{item_id}'))
+        return connection_handler(self.session, req, self.verify)
+
+    def _set(self, item):
+        try:
+            self.cache.set(item['id'], self.structure(**item), ttl=uniform(self.ttl / 2, self.ttl))
+        except (KeyError, TypeError) as e:
+            logger.error('TypeError has occurred : %s while creating %s structure', e, self.structure.__name__)
+
+
+class HistoryCursor(object):
+    """
+    Per-server position in an *arr history feed. Tracks the date to read /history/since from, the highest
+    history id already applied, and when the last full snapshot was taken.
+    """
+    def __init__(self):
+        self.date = None
+        self.last_id = 0
+        self.last_full = None
+        self.lock = Lock()
+
+    def due(self, interval):
+        return self.last_full is None or monotonic() - self.last_full >= interval
+
+    def reset(self):
+        # Taken before the snapshot is fetched, so events that land during the fetch are read again afterwards
+        self.date = datetime.now(timezone.utc).isoformat()
+        self.last_full = monotonic()
+
+    def read(self, session, url, params, verify):
+        req = session.prepare_request(Request('GET', url, params=dict(params, date=self.date)))
+        get = connection_handler(session, req, verify)
+        if get is False:
+            return False
+
+        records = sorted((record for record in get if record.get('id', 0) > self.last_id), key=lambda r: r['id'])
+        if records:
+            self.last_id = records[-1]['id']
+            self.date = max(record['date'] for record in records)
+        return records
+
+
+class Governor(object):
+    """
+    Token bucket rate limit plus a cap on concurrent requests for one upstream (service + server id). A governor is
+    attached to the requests session of a collector and enforced by connection_handler
+    """
+    registry = {}
+    registry_lock = Lock()
+
+    def __init__(self, name, rate_limit=0, rate_burst=1, max_in_flight=0):
+        self.name = name
+        self.rate_limit = rate_limit
+        self.rate_burst = max(1, rate_burst)
+        self.tokens = self.rate_burst
+        self.updated = monotonic()
+        self.lock = Lock()
+        self.slots = BoundedSemaphore(max_in_flight) if max_in_flight else None
+        self.in_flight = 0
+        self.requests = 0
+        self.throttled = 0
+        self.wait_seconds = 0.0
+
+    @classmethod
+    def attach(cls, session, name, limits):
+        """Attach the governor for name to session. Sessions of the same upstream share one governor"""
+        if limits is None or not (limits.rate_limit or limits.max_in_flight):
+            return
+        with cls.registry_lock:
+            if name not in cls.registry:
+                cls.registry[name] = cls(name, limits.rate_limit, limits.rate_burst, limits.max_in_flight)
+                logger.debug('Limiting %s to %s requests/s (burst %s) and %s in flight', name, limits.rate_limit,
+                             limits.rate_burst, limits.max_in_flight or 'unlimited')
+            session.governor = cls.registry[name]
+        return session.governor
+
+    def _reserve(self):
+        """Take a token and return how long the caller has to wait for it"""
+        if not self.rate_limit:
+            return 0
+        with self.lock:
+            now = monotonic()
+            self.tokens = min(self.rate_burst, self.tokens + (now - self.updated) * self.rate_limit)
+            self.updated = now
+            self.tokens -= 1
+            return -self.tokens / self.rate_limit if self.tokens < 0 else 0
+
+    def __enter__(self):
+        start = monotonic()
+        if self.slots is not None:
+            self.slots.acquire()
+        wait = self._reserve()
+        if wait:
+            sleep(wait)
+        waited = monotonic() - start
+        with self.lock:
+            self.in_flight += 1
+            self.requests += 1
+            if waited > 0.001:
+                self.throttled += 1
+                self.wait_seconds += waited
+        return self
+
+    def __exit__(self, *exc):
+        with self.lock:
+            self.in_flight -= 1
+        if self.slots is not None:
+            self.slots.release()
+
+    @classmethod
+    def write_stats(cls, dbmanager):
+        """Write and reset the request and throttled wait counters of every governor"""
+        now = datetime.now(timezone.utc).astimezone().isoformat()
+        influx_payload = []
+        for governor in list(cls.registry.values()):
+            with governor.lock:
+                fields = {
+                    "requests": governor.requests,
+                    "throttled": governor.throttled,
+                    "wait_seconds": round(governor.wait_seconds, 3),
+                    "in_flight": governor.in_flight
+                }
+                governor.requests, governor.throttled, governor.wait_seconds = 0, 0, 0.0
+            influx_payload.append(
+                {
+                    "measurement": "Varken",
+                    "tags": {
+                        "type": "Governor",
+                        "upstream": governor.name
+                    },
+                    "time": now,
+                    "fields": fields
+                }
+            )
+        if influx_payload:
+            dbmanager.write_points(influx_payload)
+
+
+class CircuitBreaker(object):
+    """
+    Circuit breaker for one upstream or DB sink. After failure_threshold consecutive failures the circuit opens and
+    calls are rejected until an exponential, jittered backoff has passed. A single probe is then let through
+    (half-open): success closes the circuit, failure opens it again for twice as long
+    """
+    CLOSED, HALF_OPEN, OPEN = 0, 1, 2
+    states = {CLOSED: 'closed', HALF_OPEN: 'half-open', OPEN: 'open'}
+    failure_threshold = 3
+    min_backoff = 15
+    max_backoff = 600
+    registry = {}
+    registry_lock = Lock()
+    # Calls rejected on the current thread, so a job run can tell it was skipped
+    rejections = local()
+
+    def __init__(self, name, kind='upstream'):
+        self.name = name
+        self.kind = kind
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened = 0
+        self.retry_at = 0
+        self.rejected = 0
+        self.lock = Lock()
+
+    @classmethod
+    def get(cls, name, kind='upstream'):
+        with cls.registry_lock:
+            if name not in cls.registry:
+                cls.registry[name] = cls(name, kind)
+            return cls.registry[name]
+
+    @classmethod
+    def attach(cls, session, name):
+        """Attach the breaker for name to session. Sessions of the same upstream share one breaker"""
+        session.breaker = cls.get(name)
+        return session.breaker
+
+    def allow(self):
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and monotonic() >= self.retry_at:
+                # This caller is the probe, everyone else waits for its result
+                self.state = self.HALF_OPEN
+                return True
+            self.rejected += 1
+            CircuitBreaker.rejections.count = getattr(CircuitBreaker.rejections, 'count', 0) + 1
+            return False
+
+    def record(self, success):
+        with self.lock:
+            if success:
+                if self.state != self.CLOSED:
+                    logger.info('%s %s recovered. Resuming', self.kind.capitalize(), self.name)
+                self.state = self.CLOSED
+                self.failures = 0
+                self.opened = 0
+                return
+
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.opened += 1
+                backoff = min(self.max_backoff, self.min_backoff * 2 ** (self.opened - 1))
+                delay = uniform(backoff / 2, backoff)
+                self.retry_at = monotonic() + delay
+                self.state = self.OPEN
+                logger.warning('%s %s failed %s times in a row. Skipping it for %.0fs', self.kind.capitalize(),
+                               self.name, self.failures, delay)
+
+    @classmethod
+    def write_stats(cls, dbmanager):
+        """Write the state of every breaker and reset the rejected call counters"""
+        now = datetime.now(timezone.utc).astimezone().isoformat()
+        influx_payload = []
+        for breaker in list(cls.registry.values()):
+            with breaker.lock:
+                fields = {
+                    "state": breaker.state,
+                    "failures": breaker.failures,
+                    "opened": breaker.opened,
+                    "rejected": breaker.rejected
+                }
+                breaker.rejected = 0
+            influx_payload.append(
+                {
+                    "measurement": "Varken",
+                    "tags": {
+                        "type": "CircuitBreaker",
+                        "kind": breaker.kind,
+                        "name": breaker.name,
+                        "state": cls.states[fields['state']]
+                    },
+                    "time": now,
+                    "fields": fields
+                }
+            )
+        if influx_payload:
+            dbmanager.write_points(influx_payload)
+
+
+# History events that take a download out of the queue
+HISTORY_DEQUEUE_EVENTS = ['downloadFolderImported', 'downloadImported', 'downloadFailed', 'downloadIgnored']
+
+USENET_CLIENTS = ['sabnzbd', 'nzbget', 'nzbvortex', 'pneumatic', 'usenetblackhole', 'usenetdownloadstation']
+
+
+def protocol_from_client(download_client_type):
+    if str(download_client_type).replace(' ', '').lower() in USENET_CLIENTS:
+        return 'USENET'
+    return 'TORRENT'
+
+
+def protocol_from_history(data):
+    # History stores the protocol as its enum value (1 = usenet, 2 = torrent) on older versions
+    protocol = str(data.get('protocol', '')).lower()
+    if protocol in ('1', 'usenet'):
+        return 'USENET'
+    if protocol in ('2', 'torrent'):
+        return 'TORRENT'
+    return protocol_from_client(data.get('downloadClient') or data.get('downloadClientName'))
+
+
 def hashit(string):
     encoded = string.encode()
     hashed = md5(encoded).hexdigest()
@@ -151,11 +514,20 @@ def connection_handler(session, request, verify, as_is_reply=False):
     r = request
     v = verify
     return_json = False
+    breaker = getattr(s, 'breaker', None)
 
     disable_warnings(InsecureRequestWarning)
 
+    # Upstreams with an open circuit are skipped without a request or a log line
+    if breaker is not None and not breaker.allow():
+        return return_json
+
+    # Recorded in finally, so a half-open probe that raises anything still reports back and cannot wedge the breaker
+    success = False
     try:
-        get = s.send(r, verify=v)
+        with getattr(s, 'governor', None) or nullcontext():
+            get = s.send(r, verify=v, timeout=REQUEST_TIMEOUT)
+        success = get.status_code < 500
         if get.status_code == 401:
             if 'NoSiteContext' in str(get.content):
                 logger.info('Your Site is incorrect for %s', r.url)
@@ -174,16 +546,62 @@ def connection_handler(session, request, verify, as_is_reply=False):
             return get
     except InvalidSchema:
         logger.error("You added http(s):// in the config file. Don't do that.")
-    except SSLError as e:
-        logger.error('Either your host is unreachable or you have an SSL issue. : %s', e)
-    except ConnectionError as e:
-        logger.error('Cannot resolve the url/ip/port. Check connectivity. Error: %s', e)
-    except ChunkedEncodingError as e:
-        logger.error('Broken connection during request... oops? Error: %s', e)
+    except (SSLError, ConnectionError, ChunkedEncodingError, Timeout) as e:
+        if isinstance(e, SSLError):
+            logger.error('Either your host is unreachable or you have an SSL issue. : %s', e)
+        elif isinstance(e, ConnectionError):
+            logger.error('Cannot resolve the url/ip/port. Check connectivity. Error: %s', e)
+        elif isinstance(e, ChunkedEncodingError):
+            logger.error('Broken connection during request... oops? Error: %s', e)
+        else:
+            logger.error('Timed out waiting for %s. Error: %s', r.url, e)
+    finally:
+        if breaker is not None:
+            breaker.record(success)
 
     return return_json
 
 
+def fetch_pages(session, url, params, verify, page_size=250, max_workers=4):
+    """
+    Fetch every page of a paged *arr endpoint. The first page is fetched on its own to learn totalRecords,
+    the rest concurrently with at most max_workers requests in flight. Records are returned in page order,
+    or False if any page could not be fetched.
+
+    The workers share session. They only read its headers and settings, and everything they write to is locked:
+    urllib3's connection pool, the cookie jar, and the governor and breaker attached to it. Sharing also keeps
+    one pool of kept-alive connections per upstream instead of one per worker.
+    """
+    def get_page(page):
+        page_params = dict(params, page=page, pageSize=page_size)
+        req = session.prepare_request(Request('GET', url, params=page_params))
+        return connection_handler(session, req, verify)
+
+    first = get_page(1)
+    if first is False:
+        return False
+
+    records = list(first.get('records') or [])
+    total = int(first.get('totalRecords') or 0)
+    pages = range(2, (total + page_size - 1) // page_size + 1)
+    if not pages:
+        return records
+
+    executor = ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(pages))),
+                                  thread_name_prefix=current_thread().name)
+    try:
+        for page, result in zip(pages, executor.map(get_page, pages)):
+            if result is False:
+                logger.error('Could not fetch page %s of %s from %s. Discarding the partial result', page,
+                             pages[-1], url)
+                return False
+            records.extend(result.get('records') or [])
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    return records
+
+
 def mkdir_p(path):
     templogger = getLogger('temp')
     try:
@@ -4,12 +4,16 @@ import influxdb_client
 from influxdb_client import InfluxDBClient
 from influxdb_client.client.write_api import SYNCHRONOUS
 
+from varken.helpers import CircuitBreaker
+from varken.varkenlogger import PointSummary, TRACE
+
 
 class InfluxDB2Manager(object):
     def __init__(self, server, prometheus_exporter=None):
         self.server = server
         self.logger = getLogger()
         self.prometheus_exporter = prometheus_exporter
+        self.breaker = CircuitBreaker.get('influxdb2', kind='sink')
         if self.server.url == "influxdb2.domain.tld":
             self.logger.critical("You have not configured your varken.ini. Please read Wiki page for configuration")
             exit()
@@ -41,12 +45,18 @@ class InfluxDB2Manager(object):
 
     def write_points(self, data):
         d = data
-        self.logger.info('Writing Data to InfluxDBv2 %s', d)
+        self.logger.debug('Writing %s to InfluxDBv2', PointSummary(d))
+        self.logger.log(TRACE, 'Writing Data to InfluxDBv2 %s', d)
         self._export_prometheus(d)
+        if not self.breaker.allow():
+            self.logger.debug('InfluxDBv2 is unavailable. Dropping %s points', len(d))
+            return
 
         try:
             self.influx_write_api.write(bucket=self.server.bucket, record=d)
+            self.breaker.record(True)
         except Exception as e:
+            self.breaker.record(False)
             self.logger.error('Error writing data to influxdb2. Dropping this set of data. '
                               'Check your database! Error: %s', e)
 
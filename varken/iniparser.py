@@ -7,7 +7,7 @@ from re import match, compile, IGNORECASE
 from configparser import ConfigParser, NoOptionError, NoSectionError
 
 from varken.varkenlogger import BlacklistFilter
-from varken.structures import SickChillServer, UniFiServer
+from varken.structures import SickChillServer, UniFiServer, UpstreamLimits
 from varken.helpers import clean_sid_check, rfc1918_ip_check, boolcheck
 from varken.structures import (
     SonarrServer,
@@ -47,7 +47,12 @@ class INIParser(object):
         without_port = [string.split(':')[0] for string in filtered_strings if ':' in string]
         self.filtered_strings.extend(without_port)
 
-        for handler in self.logger.handlers:
+        # Redact in the handlers behind the log queue, so only records that are written pay for it
+        handlers = [target for handler in self.logger.handlers for target in getattr(handler, 'targets', [handler])]
+        for handler in handlers:
+            # Replace the filter of a previous parse when the config is reloaded
+            for old_filter in [f for f in handler.filters if isinstance(f, BlacklistFilter)]:
+                handler.removeFilter(old_filter)
             handler.addFilter(BlacklistFilter(set(self.filtered_strings)))
 
     def enable_check(self, server_type=None):
@@ -215,6 +220,21 @@ class INIParser(object):
             self.logger.error("Invalid configuration value in prometheus. Error: %s", e)
             exit(1)
 
+        try:
+            self.listener_enabled = boolcheck(env.get('VRKN_LISTENER_ENABLED',
+                                                      self.config.get('listener', 'enabled', fallback='false')))
+            self.listener_addr = env.get('VRKN_LISTENER_ADDR', self.config.get('listener', 'addr', fallback='0.0.0.0'))
+            self.listener_port = int(env.get('VRKN_LISTENER_PORT',
+                                             self.config.get('listener', 'port', fallback='9596')))
+            self.listener_token = env.get('VRKN_LISTENER_TOKEN', self.config.get('listener', 'token', fallback=''))
+        except (NoOptionError, NoSectionError) as e:
+            self.logger.error('Missing key in %s. Error: %s', "listener", e)
+            self.rectify_ini()
+            return
+        except ValueError as e:
+            self.logger.error("Invalid configuration value in listener. Error: %s", e)
+            exit(1)
+
         if not self.influx_enabled:
             self.influx_server = None
         elif self.influx2_enabled:
@@ -284,11 +304,26 @@ class INIParser(object):
                         if scheme != 'https://':
                             verify_ssl = False
 
+                        limits = UpstreamLimits(
+                            rate_limit=float(env.get(f'VRKN_{envsection}_RATE_LIMIT',
+                                                     self.config.getfloat(section, 'rate_limit', fallback=0))),
+                            rate_burst=int(env.get(f'VRKN_{envsection}_RATE_BURST',
+                                                   self.config.getint(section, 'rate_burst', fallback=5))),
+                            max_in_flight=int(env.get(f'VRKN_{envsection}_MAX_IN_FLIGHT',
+                                                      self.config.getint(section, 'max_in_flight', fallback=0))))
+
                         if service in ['sonarr', 'radarr', 'lidarr']:
                             queue = boolcheck(env.get(f'VRKN_{envsection}_QUEUE',
                                                       self.config.get(section, 'queue')))
                             queue_run_seconds = int(env.get(f'VRKN_{envsection}_QUEUE_RUN_SECONDS',
                                                     self.config.getint(section, 'queue_run_seconds')))
+                            page_concurrency = int(env.get(f'VRKN_{envsection}_PAGE_CONCURRENCY',
+                                                           self.config.getint(section, 'page_concurrency', fallback=4)))
+                            incremental = boolcheck(env.get(f'VRKN_{envsection}_INCREMENTAL',
+                                                            self.config.get(section, 'incremental', fallback='false')))
+                            reconcile_run_seconds = int(env.get(
+                                f'VRKN_{envsection}_RECONCILE_RUN_SECONDS',
+                                self.config.getint(section, 'reconcile_run_seconds', fallback=3600)))
 
                         if service in ['sonarr', 'lidarr']:
                             missing_days = int(env.get(f'VRKN_{envsection}_MISSING_DAYS',
@@ -308,7 +343,9 @@ class INIParser(object):
                                                   missing_days=missing_days, future_days=future_days,
                                                   missing_days_run_seconds=missing_days_run_seconds,
                                                   future_days_run_seconds=future_days_run_seconds,
-                                                  queue=queue, queue_run_seconds=queue_run_seconds)
+                                                  queue=queue, queue_run_seconds=queue_run_seconds,
+                                                  page_concurrency=page_concurrency, incremental=incremental,
+                                                  reconcile_run_seconds=reconcile_run_seconds)
 
                         if service == 'radarr':
                             get_missing = boolcheck(env.get(f'VRKN_{envsection}_GET_MISSING',
@@ -316,10 +353,16 @@ class INIParser(object):
                             get_missing_run_seconds = int(env.get(
                                 f'VRKN_{envsection}_GET_MISSING_RUN_SECONDS',
                                 self.config.getint(section, 'get_missing_run_seconds')))
+                            missing_full_library = boolcheck(env.get(
+                                f'VRKN_{envsection}_MISSING_FULL_LIBRARY',
+                                self.config.get(section, 'missing_full_library', fallback='false')))
 
                             server = RadarrServer(id=server_id, url=scheme + url, api_key=apikey, verify_ssl=verify_ssl,
                                                   queue_run_seconds=queue_run_seconds, get_missing=get_missing,
-                                                  queue=queue, get_missing_run_seconds=get_missing_run_seconds)
+                                                  queue=queue, get_missing_run_seconds=get_missing_run_seconds,
+                                                  missing_full_library=missing_full_library,
+                                                  page_concurrency=page_concurrency, incremental=incremental,
+                                                  reconcile_run_seconds=reconcile_run_seconds)
 
                         if service == 'tautulli':
                             fallback_ip = env.get(f'VRKN_{envsection}_FALLBACK_IP',
@@ -376,6 +419,8 @@ class INIParser(object):
                             request_total_run_seconds = int(env.get(
                                 f'VRKN_{envsection}_REQUEST_TOTAL_RUN_SECONDS',
                                 self.config.getint(section, 'request_total_run_seconds')))
+                            incremental = boolcheck(env.get(f'VRKN_{envsection}_INCREMENTAL',
+                                                            self.config.get(section, 'incremental', fallback='false')))
 
                             server = OmbiServer(id=server_id, url=scheme + url, api_key=apikey, verify_ssl=verify_ssl,
                                                 request_type_counts=request_type_counts,
@@ -383,7 +428,8 @@ class INIParser(object):
                                                 request_total_counts=request_total_counts,
                                                 request_total_run_seconds=request_total_run_seconds,
                                                 issue_status_counts=issue_status_counts,
-                                                issue_status_run_seconds=issue_status_run_seconds)
+                                                issue_status_run_seconds=issue_status_run_seconds,
+                                                incremental=incremental)
 
                         if service == 'overseerr':
                             get_request_total_counts = boolcheck(env.get(
@@ -425,11 +471,20 @@ class INIParser(object):
                             get_usg_stats_run_seconds = int(env.get(
                                 f'VRKN_{envsection}_GET_USG_STATS_RUN_SECONDS',
                                 self.config.getint(section, 'get_usg_stats_run_seconds')))
+                            get_site_stats = boolcheck(env.get(
+                                f'VRKN_{envsection}_GET_SITE_STATS',
+                                self.config.get(section, 'get_site_stats', fallback='false')))
+                            get_site_stats_run_seconds = int(env.get(
+                                f'VRKN_{envsection}_GET_SITE_STATS_RUN_SECONDS',
+                                self.config.getint(section, 'get_site_stats_run_seconds', fallback=300)))
 
                             server = UniFiServer(id=server_id, url=scheme + url, verify_ssl=verify_ssl, site=site,
                                                  username=username, password=password, usg_name=usg_name,
-                                                 get_usg_stats_run_seconds=get_usg_stats_run_seconds)
+                                                 get_usg_stats_run_seconds=get_usg_stats_run_seconds,
+                                                 get_site_stats=get_site_stats,
+                                                 get_site_stats_run_seconds=get_site_stats_run_seconds)
 
+                        server.limits = limits
                         getattr(self, f'{service}_servers').append(server)
                     except NoOptionError as e:
                         self.logger.error('Missing key in %s. Error: %s', section, e)
@@ -1,57 +1,52 @@
-from logging import getLogger
-from requests import Session, Request
-from datetime import datetime, timezone, date, timedelta
-
-from varken.structures import LidarrQueue, LidarrAlbum
-from varken.helpers import hashit, connection_handler
-
-
-class LidarrAPI(object):
-    def __init__(self, server, dbmanager):
-        self.dbmanager = dbmanager
-        self.server = server
-        # Create session to reduce server web thread load, and globally define pageSize for all requests
-        self.session = Session()
-        self.session.headers = {'X-Api-Key': self.server.api_key}
-        self.logger = getLogger()
-
-    def __repr__(self):
-        return f"<lidarr-{self.server.id}>"
+from datetime import datetime, timezone, date
+
+from varken.arr import ArrAPI, ArrSpec, protocol_id, local_date
+from varken.structures import LidarrQueue, LidarrAlbum, LidarrArtist
+from varken.helpers import hashit, protocol_from_history
+
+
+class LidarrAPI(ArrAPI):
+    spec = ArrSpec(
+        service='lidarr',
+        measurement='Lidarr',
+        api='/api/v1',
+        queue_structure=LidarrQueue,
+        queue_params={'includeUnknownArtistItems': False},
+        queue_item='albumId',
+        queue_metadata=False,
+        history_params={'includeArtist': False, 'includeAlbum': False},
+        metadata_endpoint='/artist',
+        metadata_structure=LidarrArtist,
+        metadata_id='artistId',
+        calendar_structure=LidarrAlbum,
+        calendar_params={'includeArtist': False},
+        calendar_field='artist'
+    )
 
     def get_calendar(self, query="Missing"):
-        endpoint = '/api/v1/calendar'
-        today = str(date.today())
-        last_days = str(date.today() - timedelta(days=self.server.missing_days))
-        future = str(date.today() + timedelta(days=self.server.future_days))
+        today = date.today()
         now = datetime.now(timezone.utc).astimezone().isoformat()
-        if query == "Missing":
-            params = {'start': last_days, 'end': today}
-        else:
-            params = {'start': today, 'end': future}
         influx_payload = []
         influx_albums = []
 
-        req = self.session.prepare_request(Request('GET', self.server.url + endpoint, params=params))
-        get = connection_handler(self.session, req, self.server.verify_ssl)
+        window = self.get_calendar_window()
 
-        if not get:
+        if not window:
             return
 
-        # Iteratively create a list of LidarrAlbum Objects from response json
-        albums = []
-        for album in get:
-            try:
-                albums.append(LidarrAlbum(**album))
-            except TypeError as e:
-                self.logger.error('TypeError has occurred : %s while creating LidarrAlbum structure for album. Data '
-                                  'attempted is: %s', e, album)
+        # Missing covers the days up to and including today, Future covers today onwards
+        if query == "Missing":
+            albums = [album for album in window if local_date(album.releaseDate) <= today]
+        else:
+            albums = [album for album in window if local_date(album.releaseDate) >= today]
 
         # Add Album to missing list if album is not complete
         for album in albums:
             percent_of_tracks = album.statistics.get('percentOfTracks', 0)
             if percent_of_tracks != 100:
                 influx_albums.append(
-                    (album.title, album.releaseDate, album.artist['artistName'], album.id, percent_of_tracks,
+                    (album.title, album.releaseDate, getattr(album.artist, 'artistName', None), album.id,
+                     percent_of_tracks,
                      f"{album.statistics.get('trackFileCount', 0)}/{album.statistics.get('trackCount', 0)}")
                 )
 
@@ -80,53 +75,31 @@ class LidarrAPI(object):
 
         self.dbmanager.write_points(influx_payload)
 
-    def get_queue(self):
-        endpoint = '/api/v1/queue'
-        now = datetime.now(timezone.utc).astimezone().isoformat()
-        influx_payload = []
-        params = {'pageSize': 1000}
-
-        req = self.session.prepare_request(Request('GET', self.server.url + endpoint, params=params))
-        get = connection_handler(self.session, req, self.server.verify_ssl)
-
-        if not get:
-            return
-
-        queue = []
-        for song in get['records']:
-            try:
-                queue.append(LidarrQueue(**song))
-            except TypeError as e:
-                self.logger.error('TypeError has occurred : %s while creating LidarrQueue structure for show. Data '
-                                  'attempted is: %s', e, song)
-
-        if not queue:
-            return
-
-        for song in queue:
-            if song.protocol.upper() == 'USENET':
-                protocol_id = 1
-            else:
-                protocol_id = 0
-            hash_id = hashit(f'{self.server.id}{song.title}{song.artistId}')
-            influx_payload.append(
-                {
-                    "measurement": "Lidarr",
-                    "tags": {
-                        "type": "Queue",
-                        "id": song.id,
-                        "server": self.server.id,
-                        "title": song.title,
-                        "quality": song.quality['quality']['name'],
-                        "protocol": song.protocol,
-                        "protocol_id": protocol_id,
-                        "indexer": song.indexer
-                    },
-                    "time": now,
-                    "fields": {
-                        "hash": hash_id
-                    }
-                }
-            )
-
-        self.dbmanager.write_points(influx_payload)
+    def queue_entry(self, item, metadata):
+        return self._entry(item.albumId, item.title, item.quality['quality']['name'], item.protocol, item.indexer,
+                           item.artistId)
+
+    def history_entry(self, record, metadata):
+        data = record.get('data') or {}
+        return self._entry(record.get('albumId'), record.get('sourceTitle'), record['quality']['quality']['name'],
+                           protocol_from_history(data).lower(), data.get('indexer'), record.get('artistId'))
+
+    def webhook_entries(self, data, protocol):
+        release = data.get('release', {})
+        artist = data.get('artist', {})
+        for album in data.get('albums', []):
+            yield album.get('id'), self._entry(album.get('id'), release.get('releaseTitle'), release.get('quality'),
+                                               protocol.lower(), release.get('indexer'), artist.get('id'))
+
+    @staticmethod
+    def _entry(album_id, title, quality, protocol, indexer, artist_id):
+        # The queue, history and webhook paths all tag the album id, the one id every path has
+        tags = {
+            "id": album_id,
+            "title": title,
+            "quality": quality,
+            "protocol": protocol,
+            "protocol_id": protocol_id(protocol),
+            "indexer": indexer
+        }
+        return tags, f'{title}{artist_id}'
@@ -0,0 +1,98 @@
+from hmac import compare_digest
+from json import dumps, loads
+from logging import getLogger
+from threading import Thread
+from urllib.parse import urlsplit, parse_qsl
+from json.decoder import JSONDecodeError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class HTTPListener(object):
+    """
+    Embedded HTTP listener used for push ingestion (webhooks)
+    """
+    def __init__(self, addr='0.0.0.0', port=9596, token=None):
+        self.logger = getLogger()
+        self.enabled = False
+        self.token = token or None
+        self.routes = {}
+        self.httpd = None
+
+        try:
+            self.httpd = ThreadingHTTPServer((addr, port), self._handler_class())
+        except OSError as e:
+            self.logger.error('Failed to start HTTP listener on %s:%s. Error: %s', addr, port, e)
+            return
+
+        self.httpd.daemon_threads = True
+        worker = Thread(target=self.httpd.serve_forever, name='varken-listener', daemon=True)
+        worker.start()
+
+        self.enabled = True
+        self.logger.info('HTTP listener enabled on %s:%s', addr, port)
+
+    def register(self, method, path, handler):
+        self.routes[(method.upper(), path.rstrip('/'))] = handler
+        self.logger.debug('Registered HTTP listener route %s %s', method.upper(), path)
+
+    def unregister(self, method, path):
+        self.routes.pop((method.upper(), path.rstrip('/')), None)
+
+    def dispatch(self, method, path, query, body):
+        if self.token and not compare_digest(str(query.get('token', '')).encode(), self.token.encode()):
+            return 401, None
+
+        handler = self.routes.get((method, path.rstrip('/')))
+        if handler is None:
+            return 404, None
+
+        if method == 'POST':
+            try:
+                data = loads(body) if body else {}
+            except (JSONDecodeError, UnicodeDecodeError) as e:
+                self.logger.warning('Discarding malformed webhook payload for %s. Error: %s', path, e)
+                return 400, None
+        else:
+            data = query
+
+        try:
+            return 200, handler(data)
+        except Exception as e:
+            self.logger.error('Error handling %s %s. Error: %s', method, path, e)
+            return 500, None
+
+    def _handler_class(self):
+        listener = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            def _respond(self, method):
+                url = urlsplit(self.path)
+                query = dict(parse_qsl(url.query))
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+
+                status, reply = listener.dispatch(method, url.path, query, body)
+                if reply is None:
+                    content_type, content = 'text/plain; charset=utf-8', b''
+                elif isinstance(reply, str):
+                    content_type, content = 'text/plain; charset=utf-8', reply.encode()
+                else:
+                    content_type, content = 'application/json', dumps(reply).encode()
+
+                self.send_response(204 if status == 200 and not content else status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                if content:
+                    self.wfile.write(content)
+
+            def do_GET(self):
+                self._respond('GET')
+
+            def do_POST(self):
+                self._respond('POST')
+
+            def log_message(self, format, *args):
+                listener.logger.debug('HTTP listener: ' + format, *args)
+
+        return _Handler
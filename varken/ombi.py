@@ -1,8 +1,10 @@
 from logging import getLogger
+from threading import current_thread
 from requests import Session, Request
 from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
 
-from varken.helpers import connection_handler, hashit
+from varken.helpers import connection_handler, hashit, Governor, CircuitBreaker
 from varken.structures import OmbiRequestCounts, OmbiIssuesCounts, OmbiMovieRequest, OmbiTVRequest
 
 
@@ -13,20 +15,54 @@ class OmbiAPI(object):
         # Create session to reduce server web thread load, and globally define pageSize for all requests
         self.session = Session()
         self.session.headers = {'Apikey': self.server.api_key}
+        Governor.attach(self.session, f'ombi-{self.server.id}', self.server.limits)
+        CircuitBreaker.attach(self.session, f'ombi-{self.server.id}')
         self.logger = getLogger()
+        self.watermarks = {0: 0, 1: 0}
+        self.statuses = {}
 
     def __repr__(self):
         return f"<ombi-{self.server.id}>"
 
+    def get_request_lists(self):
+        """Fetch the TV and movie request lists concurrently"""
+        tv_req = self.session.prepare_request(Request('GET', self.server.url + '/api/v1/Request/tv'))
+        movie_req = self.session.prepare_request(Request('GET', self.server.url + '/api/v1/Request/movie'))
+
+        with ThreadPoolExecutor(max_workers=2, thread_name_prefix=current_thread().name) as executor:
+            tv = executor.submit(connection_handler, self.session, tv_req, self.server.verify_ssl)
+            movie = executor.submit(connection_handler, self.session, movie_req, self.server.verify_ssl)
+            return tv.result() or [], movie.result() or []
+
+    @staticmethod
+    def request_status(request):
+        # Denied = 0, Approved = 1, Completed = 2, Pending = 3
+        if request.get('denied'):
+            return 0
+        elif request.get('approved') and request.get('available'):
+            return 2
+        elif request.get('approved'):
+            return 1
+        else:
+            return 3
+
+    def _changed(self, request_type, request_id, status):
+        """
+        Record the status of a request. Returns True if the request is above the id watermark or its status moved
+        since the last run
+        """
+        key = (request_type, request_id)
+        new = request_id > self.watermarks[request_type]
+        changed = new or self.statuses.get(key) != status
+        self.statuses[key] = status
+        if new:
+            self.watermarks[request_type] = request_id
+        return changed
+
     def get_all_requests(self):
         now = datetime.now(timezone.utc).astimezone().isoformat()
-        tv_endpoint = '/api/v1/Request/tv'
-        movie_endpoint = "/api/v1/Request/movie"
 
-        tv_req = self.session.prepare_request(Request('GET', self.server.url + tv_endpoint))
-        movie_req = self.session.prepare_request(Request('GET', self.server.url + movie_endpoint))
-        get_tv = connection_handler(self.session, tv_req, self.server.verify_ssl) or []
-        get_movie = connection_handler(self.session, movie_req, self.server.verify_ssl) or []
+        get_tv, get_movie = self.get_request_lists()
 
         if not any([get_tv, get_movie]):
             self.logger.error('No json replies. Discarding job')
@@ -42,6 +78,19 @@ class OmbiAPI(object):
         else:
             tv_request_count = 0
 
+        # In incremental mode only requests that are new or changed status are decoded and written
+        if self.server.incremental:
+            # Forget requests that were deleted in Ombi
+            present = set([(0, show.get('id', 0)) for show in get_tv] +
+                          [(1, movie.get('id', 0)) for movie in get_movie])
+            self.statuses = {key: status for key, status in self.statuses.items() if key in present}
+            get_tv = [show for show in get_tv if show.get('childRequests') and
+                      self._changed(0, show.get('id', 0), self.request_status(show['childRequests'][0]))]
+            get_movie = [movie for movie in get_movie if self._changed(1, movie.get('id', 0),
+                                                                       self.request_status(movie))]
+            self.logger.debug('%s new or changed TV and %s movie requests for ombi-%s', len(get_tv),
+                              len(get_movie), self.server.id)
+
         tv_show_requests = []
         for show in get_tv:
             try:
@@ -77,18 +126,7 @@ class OmbiAPI(object):
         for movie in movie_requests:
             hash_id = hashit(f'{movie.id}{movie.theMovieDbId}{movie.title}')
 
-            # Denied = 0, Approved = 1, Completed = 2, Pending = 3
-            if movie.denied:
-                status = 0
-
-            elif movie.approved and movie.available:
-                status = 2
-
-            elif movie.approved:
-                status = 1
-
-            else:
-                status = 3
+            status = self.request_status(vars(movie))
 
             influx_payload.append(
                 {
@@ -112,18 +150,7 @@ class OmbiAPI(object):
         for show in tv_show_requests:
             hash_id = hashit(f'{show.id}{show.tvDbId}{show.title}')
 
-            # Denied = 0, Approved = 1, Completed = 2, Pending = 3
-            if show.childRequests[0].get('denied'):
-                status = 0
-
-            elif show.childRequests[0].get('approved') and show.childRequests[0].get('available'):
-                status = 2
-
-            elif show.childRequests[0].get('approved'):
-                status = 1
-
-            else:
-                status = 3
+            status = self.request_status(show.childRequests[0])
 
             influx_payload.append(
                 {
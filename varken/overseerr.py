@@ -1,19 +1,27 @@
 from logging import getLogger
+from threading import current_thread
 from requests import Session, Request
 from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
 
-from varken.helpers import connection_handler, hashit
+from varken.helpers import connection_handler, hashit, TTLCache, Governor, CircuitBreaker
 from varken.structures import OverseerrRequestCounts
 
 
 class OverseerrAPI(object):
+    title_ttl = 86400
+    detail_concurrency = 4
+
     def __init__(self, server, dbmanager):
         self.dbmanager = dbmanager
         self.server = server
         # Create session to reduce server web thread load, and globally define pageSize for all requests
         self.session = Session()
         self.session.headers = {'X-Api-Key': self.server.api_key}
+        Governor.attach(self.session, f'overseerr-{self.server.id}', self.server.limits)
+        CircuitBreaker.attach(self.session, f'overseerr-{self.server.id}')
         self.logger = getLogger()
+        self.title_cache = TTLCache(self.title_ttl)
 
     def __repr__(self):
         return f"<overseerr-{self.server.id}>"
@@ -54,11 +62,26 @@ class OverseerrAPI(object):
         else:
             self.logger.warning("No data to send to influx for overseerr-request-counts instance, discarding.")
 
+    def get_title(self, media_type, tmdb_id):
+        title = self.title_cache.get((media_type, tmdb_id))
+        if title is not None:
+            return title
+
+        req = self.session.prepare_request(Request('GET', f'{self.server.url}/api/v1/{media_type}/{tmdb_id}'))
+        get = connection_handler(self.session, req, self.server.verify_ssl)
+
+        if not get:
+            return
+
+        # Movies carry a title, TV shows a name
+        title = get.get('title') if media_type == 'movie' else get.get('name')
+        if title is not None:
+            self.title_cache.set((media_type, tmdb_id), title)
+        return title
+
     def get_latest_requests(self):
         now = datetime.now(timezone.utc).astimezone().isoformat()
         endpoint = '/api/v1/request?take=' + str(self.server.num_latest_requests_to_fetch) + '&filter=all&sort=added'
-        movie_endpoint = '/api/v1/movie/'
-        tv_endpoint = '/api/v1/tv/'
 
         # GET THE LATEST n REQUESTS
         req = self.session.prepare_request(Request('GET', self.server.url + endpoint))
@@ -71,6 +94,7 @@ class OverseerrAPI(object):
 
         influx_payload = []
         results = get_latest_req.get('results', []) if get_latest_req else []
+        results = [result for result in results if result.get('type') in ('movie', 'tv') and result.get('media')]
 
         influx_payload.append(
             {
@@ -86,61 +110,41 @@ class OverseerrAPI(object):
             }
         )
 
+        # The request list embeds status, requester and date. Only titles need the detail endpoints
+        keys = set((result['type'], result['media']['tmdbId']) for result in results)
+        missing = [key for key in keys if self.title_cache.get(key) is None]
+        if missing:
+            with ThreadPoolExecutor(max_workers=min(self.detail_concurrency, len(missing)),
+                                    thread_name_prefix=current_thread().name) as executor:
+                list(executor.map(lambda key: self.get_title(*key), missing))
+
         # Request Type: Movie = 1, TV Show = 0
         for result in results:
-            if result['type'] == 'tv':
-                req = self.session.prepare_request(Request('GET',
-                                                           self.server.url +
-                                                           tv_endpoint +
-                                                           str(result['media']['tmdbId'])))
-                get_tv_req = connection_handler(self.session, req, self.server.verify_ssl)
-                hash_id = hashit(f'{get_tv_req["id"]}{get_tv_req["name"]}')
-
-                influx_payload.append(
-                    {
-                        "measurement": "Overseerr",
-                        "tags": {
-                            "type": "Requests",
-                            "server": self.server.id,
-                            "request_type": 0,
-                            "status": get_tv_req['mediaInfo']['status'],
-                            "title": get_tv_req['name'],
-                            "requested_user": get_tv_req['mediaInfo']['requests'][0]['requestedBy']['displayName'],
-                            "requested_date": get_tv_req['mediaInfo']['requests'][0]['createdAt']
-                        },
-                        "time": now,
-                        "fields": {
-                            "hash": hash_id
-                        }
+            tmdb_id = result['media']['tmdbId']
+            title = self.title_cache.get((result['type'], tmdb_id))
+            if title is None:
+                self.logger.error('Could not find title for overseerr %s %s. Skipping', result['type'], tmdb_id)
+                continue
+            hash_id = hashit(f'{tmdb_id}{title}')
+
+            influx_payload.append(
+                {
+                    "measurement": "Overseerr",
+                    "tags": {
+                        "type": "Requests",
+                        "server": self.server.id,
+                        "request_type": 1 if result['type'] == 'movie' else 0,
+                        "status": result['media'].get('status'),
+                        "title": title,
+                        "requested_user": (result.get('requestedBy') or {}).get('displayName'),
+                        "requested_date": result.get('createdAt')
+                    },
+                    "time": now,
+                    "fields": {
+                        "hash": hash_id
                     }
-                )
-
-            if result['type'] == 'movie':
-                req = self.session.prepare_request(Request('GET',
-                                                           self.server.url +
-                                                           movie_endpoint +
-                                                           str(result['media']['tmdbId'])))
-                get_movie_req = connection_handler(self.session, req, self.server.verify_ssl)
-                hash_id = hashit(f'{get_movie_req["id"]}{get_movie_req["title"]}')
-
-                influx_payload.append(
-                    {
-                        "measurement": "Overseerr",
-                        "tags": {
-                            "type": "Requests",
-                            "server": self.server.id,
-                            "request_type": 1,
-                            "status": get_movie_req['mediaInfo']['status'],
-                            "title": get_movie_req['title'],
-                            "requested_user": get_movie_req['mediaInfo']['requests'][0]['requestedBy']['displayName'],
-                            "requested_date": get_movie_req['mediaInfo']['requests'][0]['createdAt']
-                        },
-                        "time": now,
-                        "fields": {
-                            "hash": hash_id
-                        }
-                    }
-                )
+                }
+            )
 
         if influx_payload:
             self.dbmanager.write_points(influx_payload)
@@ -0,0 +1,158 @@
+from io import StringIO
+from time import strftime
+from logging import getLogger
+from threading import Lock
+from os import remove, rename
+from os.path import join, exists
+
+from varken.helpers import mkdir_p
+
+
+def rotate(path, max_files):
+    """Shift path to path.1, path.1 to path.2 and so on, keeping max_files old copies like RotatingFileHandler"""
+    for index in range(max_files - 1, 0, -1):
+        source, target = f'{path}.{index}', f'{path}.{index + 1}'
+        if exists(source):
+            if exists(target):
+                remove(target)
+            rename(source, target)
+    if exists(path):
+        if exists(f'{path}.1'):
+            remove(f'{path}.1')
+        rename(path, f'{path}.1')
+
+
+class JobProfiler(object):
+    """
+    Deterministic profiling of scheduled jobs. While active every job run is profiled in its own thread with
+    cProfile and aggregated per job tag, and tracemalloc traces allocations. write() dumps one pstats file per tag
+    and the top allocation growth since the previous write to DATA_FOLDER/profiles, rotating older dumps.
+    Nothing is imported or traced while inactive
+    """
+    folder = 'profiles'
+    max_files = 5
+    interval = 300
+    top = 25
+    frames = 10
+
+    def __init__(self, data_folder, active=False):
+        self.logger = getLogger()
+        self.path = join(data_folder, self.folder)
+        self.lock = Lock()
+        self.active = False
+        self.stats = {}
+        self.runs = {}
+        self.snapshot = None
+        self.tracing = False
+        if active:
+            self.start()
+
+    def start(self):
+        import tracemalloc
+        with self.lock:
+            if self.active:
+                return
+            mkdir_p(self.path)
+            # Leave tracing alone if someone else, e.g. PYTHONTRACEMALLOC, started it
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(self.frames)
+                self.tracing = True
+            self.snapshot = self._snapshot()
+            self.active = True
+        self.logger.info('Profiling scheduled jobs. Profiles are written to %s every %ss', self.path, self.interval)
+
+    def stop(self):
+        if not self.active:
+            return
+        self.write()
+        with self.lock:
+            self.active = False
+            if self.tracing:
+                import tracemalloc
+                tracemalloc.stop()
+                self.tracing = False
+            self.snapshot = None
+        self.logger.info('Stopped profiling scheduled jobs')
+
+    def run(self, tag, job, kwargs):
+        from cProfile import Profile
+        profile = Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Python 3.12+ allows a single active profiler per process. Overlapping runs go unprofiled
+            return job(**kwargs)
+        try:
+            return job(**kwargs)
+        finally:
+            profile.disable()
+            self._add(tag, profile)
+
+    def _add(self, tag, profile):
+        from pstats import Stats
+        with self.lock:
+            if tag in self.stats:
+                self.stats[tag].add(profile)
+            else:
+                self.stats[tag] = Stats(profile)
+            self.runs[tag] = self.runs.get(tag, 0) + 1
+
+    def _snapshot(self):
+        import tracemalloc
+        return tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>')
+        ])
+
+    def write(self):
+        """Dump and reset the profiles gathered since the last write"""
+        with self.lock:
+            stats, runs = self.stats, self.runs
+            self.stats, self.runs = {}, {}
+        if not stats and self.snapshot is None:
+            return
+
+        try:
+            for tag, tag_stats in stats.items():
+                path = join(self.path, f'{tag}.pstats')
+                rotate(path, self.max_files)
+                tag_stats.dump_stats(path)
+
+                summary = StringIO()
+                tag_stats.stream = summary
+                tag_stats.sort_stats('cumulative').print_stats(self.top)
+                path = join(self.path, f'{tag}.txt')
+                rotate(path, self.max_files)
+                with open(path, 'w') as summary_file:
+                    summary_file.write(f'{runs[tag]} runs up to {strftime("%Y-%m-%d %H:%M:%S")}\n')
+                    summary_file.write(summary.getvalue())
+
+            if self.active:
+                snapshot = self._snapshot()
+                path = join(self.path, 'tracemalloc.txt')
+                rotate(path, self.max_files)
+                with open(path, 'w') as diff_file:
+                    diff_file.write(f'Top {self.top} allocation changes up to {strftime("%Y-%m-%d %H:%M:%S")}\n')
+                    for diff in snapshot.compare_to(self.snapshot, 'lineno')[:self.top]:
+                        diff_file.write(f'{diff}\n')
+                self.snapshot = snapshot
+        except OSError as e:
+            self.logger.error('Could not write profiles to %s. Error: %s', self.path, e)
+            return
+
+        self.logger.debug('Wrote profiles of %s to %s', ', '.join(sorted(stats)) or 'no jobs', self.path)
+
+    def toggle(self, data):
+        """Listener handler for POST {"enabled": true|false}"""
+        if data.get('enabled') in (True, 'true', 'True', '1', 1):
+            self.start()
+        else:
+            self.stop()
+        return self.status()
+
+    def status(self, data=None):
+        """Listener handler reporting the profiler and the job runs profiled since the last write"""
+        with self.lock:
+            return {'enabled': self.active, 'path': self.path, 'interval': self.interval,
+                    'runs': dict(self.runs)}
@@ -1,31 +1,41 @@
-from logging import getLogger
-from requests import Session, Request
+from threading import Lock
 from datetime import datetime, timezone
 
-from varken.structures import QueuePages, RadarrMovie, RadarrQueue
-from varken.helpers import hashit, connection_handler
+from varken.arr import ArrAPI, ArrSpec, protocol_id
+from varken.structures import RadarrMovie, RadarrQueue
+from varken.helpers import protocol_from_history, HistoryCursor
+
+
+class RadarrAPI(ArrAPI):
+    spec = ArrSpec(
+        service='radarr',
+        measurement='Radarr',
+        api='/api/v3',
+        queue_structure=RadarrQueue,
+        queue_params={'includeMovie': False, 'includeUnknownMovieItems': False},
+        queue_item='movieId',
+        history_params={'includeMovie': False},
+        metadata_endpoint='/movie',
+        metadata_structure=RadarrMovie,
+        metadata_id='movieId'
+    )
 
-
-class RadarrAPI(object):
     def __init__(self, server, dbmanager):
-        self.dbmanager = dbmanager
-        self.server = server
-        # Create session to reduce server web thread load, and globally define pageSize for all requests
-        self.session = Session()
-        self.session.headers = {'X-Api-Key': self.server.api_key}
-        self.logger = getLogger()
-
-    def __repr__(self):
-        return f"<radarr-{self.server.id}>"
+        super().__init__(server, dbmanager)
+        self.missing_ids = set()
+        self.missing_lock = Lock()
+        self.missing_history = HistoryCursor()
 
     def get_missing(self):
-        endpoint = '/api/v3/movie'
         now = datetime.now(timezone.utc).astimezone().isoformat()
         influx_payload = []
         missing = []
 
-        req = self.session.prepare_request(Request('GET', self.server.url + endpoint))
-        get = connection_handler(self.session, req, self.server.verify_ssl)
+        if self.server.missing_full_library:
+            # Download the whole library and filter it here. Only needed for Radarr versions without wanted/missing
+            get = self.get('/movie')
+        else:
+            get = self.get_pages('/wanted/missing', {'monitored': True})
 
         if get is False:
             return
@@ -44,114 +54,90 @@ class RadarrAPI(object):
                     ma = 1
 
                 movie_name = f'{movie.title} ({movie.year})'
-                missing.append((movie_name, ma, movie.tmdbId, movie.titleSlug))
-
-        influx_payload.append(
-            {
-                "measurement": "Radarr",
-                "tags": {
-                    "type": "Missing",
-                    "server": self.server.id
-                },
-                "time": now,
-                "fields": {
-                    "count": len(missing),
-                    "movie_count": len(missing)
-                }
-            }
-        )
+                missing.append((movie_name, ma, movie.tmdbId, movie.titleSlug, movie.id))
+
+        with self.missing_lock:
+            self.missing_ids = set(movie_id for _, _, _, _, movie_id in missing)
+
+        influx_payload.append(self._missing_point(len(missing), now))
 
         if influx_payload:
             self.dbmanager.write_points(influx_payload)
+        return True
 
-    def get_queue(self):
-        endpoint = '/api/v3/queue'
+    def get_missing_incremental(self):
+        """
+        Keep the missing movie count up to date from /history/since. A full get_missing snapshot is taken on the
+        first run and then every reconcile_run_seconds.
+        """
         now = datetime.now(timezone.utc).astimezone().isoformat()
-        influx_payload = []
-        pageSize = 250
-        params = {'pageSize': pageSize, 'includeMovie': True, 'includeUnknownMovieItems': False}
-        queueResponse = []
-        queue = []
-
-        req = self.session.prepare_request(Request('GET', self.server.url + endpoint, params=params))
-        get = connection_handler(self.session, req, self.server.verify_ssl)
-
-        if get is False:
-            return
-
-        response = QueuePages(**get)
-        queueResponse.extend(response.records)
 
-        while response.totalRecords > response.page * response.pageSize:
-            page = response.page + 1
-            params = {'pageSize': pageSize, 'page': page, 'includeMovie': True, 'includeUnknownMovieItems': False}
-            req = self.session.prepare_request(Request('GET', self.server.url + endpoint, params=params))
-            get = connection_handler(self.session, req, self.server.verify_ssl)
-            if get is False:
+        with self.missing_history.lock:
+            if self.missing_history.due(self.server.reconcile_run_seconds):
+                self.missing_history.reset()
+                if not self.get_missing():
+                    self.missing_history.last_full = None
                 return
 
-            response = QueuePages(**get)
-            queueResponse.extend(response.records)
-
-        download_queue = []
-        for queueItem in queueResponse:
-            try:
-                download_queue.append(RadarrQueue(**queueItem))
-            except TypeError as e:
-                self.logger.warning('TypeError has occurred : %s while creating RadarrQueue structure', e)
+            records = self.missing_history.read(self.session, self.url('/history/since'), {'includeMovie': False},
+                                                self.server.verify_ssl)
+            if records is False:
                 return
-        influx_payload.append(
-            {
-                "measurement": "Radarr",
-                "tags": {
-                    "type": "Queue",
-                    "server": self.server.id
-                },
-                "time": now,
-                "fields": {
-                    "count": len(download_queue)
-                }
+
+            with self.missing_lock:
+                for record in records:
+                    if record.get('eventType') in ('downloadFolderImported', 'movieFolderImported'):
+                        self.missing_ids.discard(record.get('movieId'))
+                    elif (record.get('eventType') == 'movieFileDeleted'
+                          and (record.get('data') or {}).get('reason') != 'Upgrade'):
+                        # Monitored state is not in the history. The next full snapshot corrects unmonitored movies
+                        self.missing_ids.add(record.get('movieId'))
+                count = len(self.missing_ids)
+
+        self.dbmanager.write_points([self._missing_point(count, now)])
+
+    def _missing_point(self, count, now):
+        return {
+            "measurement": "Radarr",
+            "tags": {
+                "type": "Missing",
+                "server": self.server.id
+            },
+            "time": now,
+            "fields": {
+                "count": count,
+                "movie_count": count
             }
-        )
+        }
 
-        if not download_queue:
-            self.dbmanager.write_points(influx_payload)
+    def queue_entry(self, item, metadata):
+        if metadata is None:
+            self.logger.error('Could not find movie %s for queue item %s. Skipping', item.movieId, item.id)
             return
+        return self._entry(f'{metadata.title} ({metadata.year})', item.quality['quality']['name'],
+                           item.protocol.upper(), metadata.tmdbId, metadata.titleSlug)
 
-        for queue_item in download_queue:
-            movie = RadarrMovie(**queue_item.movie)
-
-            name = f'{movie.title} ({movie.year})'
-
-            if queue_item.protocol.upper() == 'USENET':
-                protocol_id = 1
-            else:
-                protocol_id = 0
-
-            queue.append((name, queue_item.quality['quality']['name'], queue_item.protocol.upper(),
-                          protocol_id, queue_item.id, movie.titleSlug))
-
-        for name, quality, protocol, protocol_id, qid, title_slug in queue:
-            hash_id = hashit(f'{self.server.id}{name}{quality}')
-            influx_payload.append(
-                {
-                    "measurement": "Radarr",
-                    "tags": {
-                        "type": "Queue",
-                        "tmdbId": qid,
-                        "server": self.server.id,
-                        "name": name,
-                        "quality": quality,
-                        "protocol": protocol,
-                        "protocol_id": protocol_id,
-                        "titleSlug": title_slug
-                    },
-                    "time": now,
-                    "fields": {
-                        "hash": hash_id
-                    }
-                }
-            )
-
-        if influx_payload:
-            self.dbmanager.write_points(influx_payload)
+    def history_entry(self, record, metadata):
+        if metadata is None:
+            return
+        return self._entry(f'{metadata.title} ({metadata.year})', record['quality']['quality']['name'],
+                           protocol_from_history(record.get('data') or {}), metadata.tmdbId, metadata.titleSlug)
+
+    def webhook_entries(self, data, protocol):
+        movie = data.get('movie', {})
+        yield movie.get('id'), self._entry(f"{movie.get('title')} ({movie.get('year')})",
+                                           data.get('release', {}).get('quality'), protocol, movie.get('tmdbId'),
+                                           movie.get('titleSlug'))
+
+    @staticmethod
+    def _entry(name, quality, protocol, tmdb_id, title_slug):
+        # The queue, history and webhook paths all tag the movie's TMDB id, the one id every path has
+        tags = {
+            "tmdbId": tmdb_id,
+            "name": name,
+            "quality": quality,
+            "protocol": protocol,
+            "protocol_id": protocol_id(protocol),
+            "titleSlug": title_slug
+        }
+        return tags, f'{name}{quality}'
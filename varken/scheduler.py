@@ -0,0 +1,340 @@
+import schedule
+from time import monotonic
+from datetime import datetime, timezone
+from importlib import import_module
+from threading import Thread, Lock, local
+from logging import getLogger, Handler, ERROR
+
+from varken.helpers import GeoIPHandler, Governor, CircuitBreaker
+
+# Server fields that are baked into a collector's session and caches. Changing one rebuilds the collector,
+# any other change only reschedules its jobs. Tautulli's GeoIP handler is only built with a collector that polls
+# activity, so get_activity counts as one
+CONNECTION_FIELDS = ['url', 'api_key', 'verify_ssl', 'username', 'password', 'site', 'usg_name', 'limits',
+                     'page_concurrency', 'fallback_ip', 'maxmind_license_key', 'get_activity']
+
+
+def thread(job, **kwargs):
+    # Job threads are named after their tag, so log records and their rate limit can tell the servers apart
+    worker = Thread(target=job, kwargs=dict(**kwargs), name=kwargs.get('tag'))
+    worker.start()
+
+
+def sonarr_jobs(server, api):
+    jobs = []
+    if server.queue:
+        jobs.append(('get_queue', server.queue_run_seconds,
+                     api.get_queue_incremental if server.incremental else api.get_queue, {}))
+    if server.missing_days > 0:
+        jobs.append(('get_missing', server.missing_days_run_seconds, api.get_calendar, {'query': 'Missing'}))
+    if server.future_days > 0:
+        jobs.append(('get_future', server.future_days_run_seconds, api.get_calendar, {'query': 'Future'}))
+    return jobs
+
+
+def radarr_jobs(server, api):
+    jobs = []
+    if server.get_missing:
+        jobs.append(('get_missing', server.get_missing_run_seconds,
+                     api.get_missing_incremental if server.incremental else api.get_missing, {}))
+    if server.queue:
+        jobs.append(('get_queue', server.queue_run_seconds,
+                     api.get_queue_incremental if server.incremental else api.get_queue, {}))
+    return jobs
+
+
+def tautulli_jobs(server, api):
+    jobs = []
+    if server.get_activity:
+        jobs.append(('get_activity', server.get_activity_run_seconds, api.get_activity, {}))
+    if server.get_stats:
+        jobs.append(('get_stats', server.get_stats_run_seconds, api.get_stats, {}))
+    return jobs
+
+
+def ombi_jobs(server, api):
+    jobs = []
+    if server.request_type_counts:
+        jobs.append(('get_request_counts', server.request_type_run_seconds, api.get_request_counts, {}))
+    if server.request_total_counts:
+        jobs.append(('get_all_requests', server.request_total_run_seconds, api.get_all_requests, {}))
+    if server.issue_status_counts:
+        jobs.append(('get_issue_counts', server.issue_status_run_seconds, api.get_issue_counts, {}))
+    return jobs
+
+
+def overseerr_jobs(server, api):
+    jobs = []
+    if server.get_request_total_counts:
+        jobs.append(('get_request_counts', server.request_total_run_seconds, api.get_request_counts, {}))
+    if server.num_latest_requests_to_fetch > 0:
+        jobs.append(('get_latest_requests', server.num_latest_requests_seconds, api.get_latest_requests, {}))
+    return jobs
+
+
+def sickchill_jobs(server, api):
+    jobs = []
+    if server.get_missing:
+        jobs.append(('get_missing', server.get_missing_run_seconds, api.get_missing, {}))
+    return jobs
+
+
+def unifi_jobs(server, api):
+    # The site collector writes the USG point as well
+    if server.get_site_stats:
+        return [('get_site_stats', server.get_site_stats_run_seconds, api.get_site_stats, {})]
+    return [('get_usg_stats', server.get_usg_stats_run_seconds, api.get_usg_stats, {})]
+
+
+# service: (collector entry point, jobs, accepts webhooks). Collector modules are only imported once a server of
+# their service is enabled
+SERVICES = {
+    'sonarr': ('varken.sonarr:SonarrAPI', sonarr_jobs, True),
+    'radarr': ('varken.radarr:RadarrAPI', radarr_jobs, True),
+    'lidarr': ('varken.lidarr:LidarrAPI', sonarr_jobs, True),
+    'tautulli': ('varken.tautulli:TautulliAPI', tautulli_jobs, True),
+    'ombi': ('varken.ombi:OmbiAPI', ombi_jobs, False),
+    'overseerr': ('varken.overseerr:OverseerrAPI', overseerr_jobs, False),
+    'sickchill': ('varken.sickchill:SickChillAPI', sickchill_jobs, False),
+    'unifi': ('varken.unifi:UniFiAPI', unifi_jobs, False)
+}
+
+
+class JobStatus(Handler):
+    """
+    Runtime state of every job run through JobManager.run_job. Collectors log failures instead of raising them, so
+    this is attached to the root logger and a run that logs an error counts as failed. A run that an open circuit
+    breaker turned away counts as skipped, and leaves the error streak as it was
+    """
+    # Writes nothing, so config_blacklist has no handlers to redact here
+    targets = []
+
+    def __init__(self):
+        super().__init__(ERROR)
+        self.run = local()
+        self.lock = Lock()
+        self.jobs = {}
+        self.writes_in_flight = 0
+        self.writes = 0
+
+    def emit(self, record):
+        current = getattr(self.run, 'current', None)
+        if current is not None:
+            current['errors'] += 1
+
+    def track(self, tag, target, kwargs):
+        current = {'errors': 0, 'points': 0}
+        self.run.current = current
+        CircuitBreaker.rejections.count = 0
+        with self.lock:
+            job = self.jobs.setdefault(tag, {'runs': 0, 'running': 0, 'last_start': None, 'last_duration_s': None,
+                                             'last_result': None, 'last_success': None, 'last_points': 0,
+                                             'points_total': 0, 'error_streak': 0})
+            job['runs'] += 1
+            job['running'] += 1
+            job['last_start'] = datetime.now(timezone.utc).astimezone().isoformat()
+        started = monotonic()
+        try:
+            target(**kwargs)
+        except Exception:
+            current['errors'] += 1
+            raise
+        finally:
+            self.run.current = None
+            with self.lock:
+                job['running'] -= 1
+                job['last_duration_s'] = round(monotonic() - started, 3)
+                job['last_points'] = current['points']
+                job['points_total'] += current['points']
+                if current['errors']:
+                    job['last_result'] = 'error'
+                    job['error_streak'] += 1
+                elif CircuitBreaker.rejections.count:
+                    job['last_result'] = 'skipped'
+                else:
+                    job['last_result'] = 'ok'
+                    job['last_success'] = job['last_start']
+                    job['error_streak'] = 0
+
+    def forget(self, group):
+        with self.lock:
+            for tag in [tag for tag in self.jobs if tag.startswith(f'{group}-')]:
+                del self.jobs[tag]
+
+
+class StatusDBManager(object):
+    """Hands writes to the DB manager, crediting their points to the job writing them"""
+    def __init__(self, dbmanager, status):
+        self.dbmanager = dbmanager
+        self.status = status
+
+    def write_points(self, data):
+        current = getattr(self.status.run, 'current', None)
+        if current is not None:
+            current['points'] += len(data) if isinstance(data, list) else 1
+        with self.status.lock:
+            self.status.writes_in_flight += 1
+        try:
+            self.dbmanager.write_points(data)
+        finally:
+            with self.status.lock:
+                self.status.writes_in_flight -= 1
+                self.status.writes += 1
+
+    def __getattr__(self, name):
+        return getattr(self.dbmanager, name)
+
+
+def load_entry_point(entry_point):
+    """Import 'package.module:attribute' and return the attribute"""
+    module, _, attribute = entry_point.partition(':')
+    return getattr(import_module(module), attribute)
+
+
+class JobManager(object):
+    """
+    Owns the collectors and their scheduled jobs. Every job of a server is tagged with the group {service}-{id} so
+    apply() can diff a freshly parsed configuration against the running one and only touch the servers that changed
+    """
+    def __init__(self, dbmanager, data_folder, listener=None, profiler=None):
+        self.status = JobStatus()
+        getLogger().addHandler(self.status)
+        self.dbmanager = StatusDBManager(dbmanager, self.status)
+        self.data_folder = data_folder
+        self.listener = listener
+        self.profiler = profiler
+        self.logger = getLogger()
+        self.servers = {}
+        self.collectors = {}
+        self.geoiphandler = None
+
+    def apply(self, config):
+        """Add, rebuild, reschedule or remove servers to match config. Returns the groups that were (re)scheduled"""
+        wanted = {}
+        for service in [service for service in config.services if service in SERVICES]:
+            if getattr(config, f'{service}_enabled', None):
+                for server in getattr(config, f'{service}_servers'):
+                    wanted[(service, server.id)] = server
+
+        changed = []
+        for key in list(self.servers):
+            if key not in wanted:
+                self.remove_server(*key)
+
+        for key, server in wanted.items():
+            current = self.servers.get(key)
+            if current is None:
+                self.add_server(key[0], server)
+            elif current == server:
+                continue
+            elif any(getattr(current, field, None) != getattr(server, field, None) for field in CONNECTION_FIELDS):
+                self.logger.info('Connection settings of %s-%s changed. Recreating its collector', *key)
+                self.remove_server(*key)
+                self.add_server(key[0], server)
+            else:
+                self.logger.info('Rescheduling %s-%s', *key)
+                self.collectors[key].server = server
+                self.servers[key] = server
+                self.schedule_server(key[0], server)
+            changed.append(f'{key[0]}-{key[1]}')
+
+        return changed
+
+    def add_server(self, service, server):
+        entry_point, _, webhooks = SERVICES[service]
+        collector_class = load_entry_point(entry_point)
+
+        if service == 'tautulli':
+            if self.geoiphandler is None and server.get_activity:
+                self.geoiphandler = GeoIPHandler(self.data_folder, server.maxmind_license_key)
+                schedule.every(12).to(24).hours.do(thread, self.geoiphandler.update).tag('varken-geoip')
+            collector = collector_class(server, self.dbmanager, self.geoiphandler)
+        elif service == 'unifi':
+            collector = collector_class(server, self.dbmanager, self.data_folder)
+        else:
+            collector = collector_class(server, self.dbmanager)
+
+        self.servers[(service, server.id)] = server
+        self.collectors[(service, server.id)] = collector
+        if webhooks and self.listener:
+            self.listener.register('POST', f'/webhook/{service}/{server.id}', collector.ingest_webhook)
+        self.schedule_server(service, server)
+        self.logger.info('Added %s-%s', service, server.id)
+
+    def remove_server(self, service, server_id):
+        group = f'{service}-{server_id}'
+        schedule.clear(group)
+        self.servers.pop((service, server_id), None)
+        collector = self.collectors.pop((service, server_id), None)
+        # Collectors holding state shared beyond themselves, like UniFi logins, release it here
+        if hasattr(collector, 'close'):
+            collector.close()
+        self.status.forget(group)
+        if self.listener:
+            self.listener.unregister('POST', f'/webhook/{service}/{server_id}')
+        # Limits may have changed, so the next collector for this upstream starts with fresh ones
+        Governor.registry.pop(group, None)
+        CircuitBreaker.registry.pop(group, None)
+        self.logger.info('Removed %s', group)
+
+    def schedule_server(self, service, server):
+        group = f'{service}-{server.id}'
+        schedule.clear(group)
+        _, jobs, _ = SERVICES[service]
+        for name, seconds, job, kwargs in jobs(server, self.collectors[(service, server.id)]):
+            schedule.every(seconds).seconds.do(thread, self.run_job, tag=f'{group}-{name}', target=job,
+                                               kwargs=kwargs).tag(f'{group}-{name}', group)
+
+    def run_job(self, tag, target, kwargs):
+        if self.profiler is not None and self.profiler.active:
+            self.status.track(tag, self.profiler.run, {'tag': tag, 'job': target, 'kwargs': kwargs})
+        else:
+            self.status.track(tag, target, kwargs)
+
+    def report(self, data=None):
+        """Listener handler with the state of every scheduled job and of the DB sink"""
+        with self.status.lock:
+            jobs = {tag: dict(job) for tag, job in self.status.jobs.items()}
+            sink = {'type': type(self.dbmanager.dbmanager).__name__, 'writes': self.status.writes,
+                    'queue_depth': self.status.writes_in_flight}
+
+        report = {}
+        for job in schedule.jobs:
+            tag = max(job.tags, key=len) if job.tags else str(job.job_func)
+            state = jobs.get(tag, {})
+            state['next_run'] = job.next_run.astimezone().isoformat() if job.next_run else None
+            state['interval_s'] = job.period.total_seconds() if job.period else None
+            breaker = CircuitBreaker.registry.get(tag.rsplit('-', 1)[0])
+            if breaker is not None:
+                state['upstream'] = CircuitBreaker.states[breaker.state]
+            report[tag] = state
+
+        breaker = getattr(self.dbmanager.dbmanager, 'breaker', None)
+        if breaker is not None:
+            sink['state'] = CircuitBreaker.states[breaker.state]
+        failing = sorted(tag for tag, state in report.items()
+                         if state.get('error_streak') or state.get('last_result') == 'skipped'
+                         or state.get('upstream') == 'open')
+        return {'status': 'degraded' if failing or sink.get('state') == 'open' else 'ok', 'failing': failing,
+                'jobs': report, 'sink': sink}
+
+    def report_text(self, data=None):
+        """Plain-text summary of report()"""
+        report = self.report()
+        sink = report['sink']
+        lines = [f'status: {report["status"]}',
+                 f'sink: {sink["type"]}, {sink.get("state", "no breaker")}, queue depth {sink["queue_depth"]}, '
+                 f'{sink["writes"]} writes']
+        for tag, state in sorted(report['jobs'].items()):
+            if 'runs' not in state:
+                lines.append(f'{tag}: next {state["next_run"]}')
+                continue
+            lines.append(f'{tag}: {state["last_result"] or "running"} at {state["last_start"]} '
+                         f'in {state["last_duration_s"]}s, {state["last_points"]} points, '
+                         f'error streak {state["error_streak"]}, next {state["next_run"]}')
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def run_group(group):
+        for job in [job for job in schedule.jobs if group in job.tags]:
+            job.run()
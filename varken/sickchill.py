@@ -3,7 +3,7 @@ from requests import Session, Request
 from datetime import datetime, timezone
 
 from varken.structures import SickChillTVShow
-from varken.helpers import hashit, connection_handler
+from varken.helpers import hashit, connection_handler, Governor, CircuitBreaker
 
 
 class SickChillAPI(object):
@@ -13,6 +13,8 @@ class SickChillAPI(object):
         # Create session to reduce server web thread load, and globally define pageSize for all requests
         self.session = Session()
         self.session.params = {'limit': 1000}
+        Governor.attach(self.session, f'sickchill-{self.server.id}', self.server.limits)
+        CircuitBreaker.attach(self.session, f'sickchill-{self.server.id}')
         self.endpoint = f"/api/{self.server.api_key}"
         self.logger = getLogger()
 
@@ -1,30 +1,33 @@
-from logging import getLogger
-from requests import Session, Request
-from datetime import datetime, timezone, date, timedelta
-
-from varken.structures import SonarrEpisode, SonarrTVShow, SonarrQueue, QueuePages
-from varken.helpers import hashit, connection_handler
-
-
-class SonarrAPI(object):
-    def __init__(self, server, dbmanager):
-        self.dbmanager = dbmanager
-        self.server = server
-        # Create session to reduce server web thread load, and globally define pageSize for all requests
-        self.session = Session()
-        self.session.headers = {'X-Api-Key': self.server.api_key}
-        self.session.params = {'pageSize': 1000}
-        self.logger = getLogger()
-
-    def __repr__(self):
-        return f"<sonarr-{self.server.id}>"
+from datetime import datetime, timezone, date
+
+from varken.arr import ArrAPI, ArrSpec, protocol_id, local_date
+from varken.structures import SonarrEpisode, SonarrTVShow, SonarrQueue
+from varken.helpers import hashit, protocol_from_history
+
+
+def _sxe(episode):
+    return f"S{episode.get('seasonNumber', 0):0>2}E{episode.get('episodeNumber', 0):0>2}"
+
+
+class SonarrAPI(ArrAPI):
+    spec = ArrSpec(
+        service='sonarr',
+        measurement='Sonarr',
+        api='/api/v3',
+        queue_structure=SonarrQueue,
+        queue_params={'includeSeries': False, 'includeEpisode': True, 'includeUnknownSeriesItems': False},
+        queue_item='episodeId',
+        history_params={'includeSeries': False, 'includeEpisode': True},
+        metadata_endpoint='/series',
+        metadata_structure=SonarrTVShow,
+        metadata_id='seriesId',
+        calendar_structure=SonarrEpisode,
+        calendar_params={'includeSeries': False},
+        calendar_field='series'
+    )
 
     def get_episode(self, id):
-        endpoint = '/api/v3/episode'
-        params = {'episodeIds': id}
-
-        req = self.session.prepare_request(Request('GET', self.server.url + endpoint, params=params))
-        get = connection_handler(self.session, req, self.server.verify_ssl)
+        get = self.get('/episode', {'episodeIds': id})
 
         if get is False:
             return
@@ -32,34 +35,24 @@ class SonarrAPI(object):
         return SonarrEpisode(**get[0])
 
     def get_calendar(self, query="Missing"):
-        endpoint = '/api/v3/calendar/'
-        today = str(date.today())
-        last_days = str(date.today() - timedelta(days=self.server.missing_days))
-        future = str(date.today() + timedelta(days=self.server.future_days))
+        today = date.today()
         now = datetime.now(timezone.utc).astimezone().isoformat()
-        if query == "Missing":
-            params = {'start': last_days, 'end': today, 'includeSeries': True}
-        else:
-            params = {'start': today, 'end': future, 'includeSeries': True}
         influx_payload = []
         air_days = []
         missing_episode_count = 0
         missing_show_ids = set()
         missing_seasons = set()
 
-        req = self.session.prepare_request(Request('GET', self.server.url + endpoint, params=params))
-        get = connection_handler(self.session, req, self.server.verify_ssl)
+        episodes = self.get_calendar_window()
 
-        if not get:
+        if not episodes:
             return
 
-        tv_shows = []
-        for show in get:
-            try:
-                tv_shows.append(SonarrEpisode(**show))
-            except TypeError as e:
-                self.logger.error('TypeError has occurred : %s while creating SonarrEpisode structure for show. Data '
-                                  'attempted is: %s', e, show)
+        # Missing covers the days up to and including today, Future covers today onwards
+        if query == "Missing":
+            tv_shows = [episode for episode in episodes if local_date(episode.airDateUtc) <= today]
+        else:
+            tv_shows = [episode for episode in episodes if local_date(episode.airDateUtc) >= today]
 
         for episode in tv_shows:
             tvShow = episode.series
@@ -70,12 +63,14 @@ class SonarrAPI(object):
             if query == "Missing":
                 if episode.monitored and not downloaded:
                     missing_episode_count += 1
-                    series_id = getattr(episode, 'seriesId', tvShow.get('id'))
+                    series_id = episode.seriesId
                     missing_show_ids.add(series_id)
                     missing_seasons.add((series_id, episode.seasonNumber))
+            elif tvShow is None:
+                self.logger.error('Could not find series %s for episode %s. Skipping', episode.seriesId, episode.id)
             else:
                 sxe = f'S{episode.seasonNumber:0>2}E{episode.episodeNumber:0>2}'
-                air_days.append((tvShow['title'], downloaded, sxe, episode.title, episode.airDateUtc, episode.seriesId))
+                air_days.append((tvShow.title, downloaded, sxe, episode.title, episode.airDateUtc, episode.seriesId))
 
         selected = missing_episode_count if query == "Missing" else len(air_days)
         influx_payload.append(
@@ -121,101 +116,44 @@ class SonarrAPI(object):
         if influx_payload:
             self.dbmanager.write_points(influx_payload)
 
-    def get_queue(self):
-        influx_payload = []
-        endpoint = '/api/v3/queue'
-        now = datetime.now(timezone.utc).astimezone().isoformat()
-        pageSize = 250
-        params = {'pageSize': pageSize, 'includeSeries': True, 'includeEpisode': True,
-                  'includeUnknownSeriesItems': False}
-        queueResponse = []
-        queue = []
-
-        req = self.session.prepare_request(Request('GET', self.server.url + endpoint, params=params))
-        get = connection_handler(self.session, req, self.server.verify_ssl)
-        if get is False:
+    def queue_entry(self, item, metadata):
+        if metadata is None:
+            self.logger.error('Could not find series %s for queue item %s. Skipping', item.seriesId, item.id)
             return
-
-        response = QueuePages(**get)
-        queueResponse.extend(response.records)
-
-        while response.totalRecords > response.page * response.pageSize:
-            page = response.page + 1
-            params = {'pageSize': pageSize, 'page': page, 'includeSeries': True, 'includeEpisode': True,
-                      'includeUnknownSeriesItems': False}
-            req = self.session.prepare_request(Request('GET', self.server.url + endpoint, params=params))
-            get = connection_handler(self.session, req, self.server.verify_ssl)
-            if get is False:
-                return
-
-            response = QueuePages(**get)
-            queueResponse.extend(response.records)
-
-        download_queue = []
-        for queueItem in queueResponse:
-            try:
-                download_queue.append(SonarrQueue(**queueItem))
-            except TypeError as e:
-                self.logger.error('TypeError has occurred : %s while creating Queue structure. Data attempted is: '
-                                  '%s', e, queueItem)
-        influx_payload.append(
-            {
-                "measurement": "Sonarr",
-                "tags": {
-                    "type": "Queue",
-                    "server": self.server.id
-                },
-                "time": now,
-                "fields": {
-                    "count": len(download_queue)
-                }
-            }
-        )
-
-        if not download_queue:
-            self.dbmanager.write_points(influx_payload)
+        try:
+            episode = SonarrEpisode(**item.episode)
+        except TypeError as e:
+            self.logger.error('TypeError has occurred : %s while processing the sonarr queue. \
+                              Remove invalid queue entry. Data attempted is: %s', e, item)
             return
 
-        for queueItem in download_queue:
-            tvShow = SonarrTVShow(**queueItem.series)
-            try:
-                episode = SonarrEpisode(**queueItem.episode)
-                sxe = f"S{episode.seasonNumber:0>2}E{episode.episodeNumber:0>2}"
-            except TypeError as e:
-                self.logger.error('TypeError has occurred : %s while processing the sonarr queue. \
-                                  Remove invalid queue entry. Data attempted is: %s', e, queueItem)
-                continue
-
-            if queueItem.protocol.upper() == 'USENET':
-                protocol_id = 1
-            else:
-                protocol_id = 0
-
-            queue.append((tvShow.title, episode.title, queueItem.protocol.upper(),
-                          protocol_id, sxe, queueItem.seriesId, queueItem.quality['quality']['name']))
-
-        for series_title, episode_title, protocol, protocol_id, sxe, sonarr_id, quality in queue:
-            hash_id = hashit(f'{self.server.id}{series_title}{sxe}')
-            influx_payload.append(
-                {
-                    "measurement": "Sonarr",
-                    "tags": {
-                        "type": "Queue",
-                        "sonarrId": sonarr_id,
-                        "server": self.server.id,
-                        "name": series_title,
-                        "epname": episode_title,
-                        "sxe": sxe,
-                        "protocol": protocol,
-                        "protocol_id": protocol_id,
-                        "quality": quality
-                    },
-                    "time": now,
-                    "fields": {
-                        "hash": hash_id
-                    }
-                }
-            )
+        sxe = f"S{episode.seasonNumber:0>2}E{episode.episodeNumber:0>2}"
+        return self._entry(metadata.title, episode.title, item.protocol.upper(), sxe, item.seriesId,
+                           item.quality['quality']['name'])
 
-        if influx_payload:
-            self.dbmanager.write_points(influx_payload)
+    def history_entry(self, record, metadata):
+        episode = record.get('episode')
+        if metadata is None or not episode:
+            return
+        return self._entry(metadata.title, episode.get('title'), protocol_from_history(record.get('data') or {}),
+                           _sxe(episode), record.get('seriesId'), record['quality']['quality']['name'])
+
+    def webhook_entries(self, data, protocol):
+        series = data.get('series', {})
+        quality = data.get('release', {}).get('quality')
+        for episode in data.get('episodes', []):
+            yield episode.get('id'), self._entry(series.get('title'), episode.get('title'), protocol, _sxe(episode),
+                                                 series.get('id'), quality)
+
+    @staticmethod
+    def _entry(series_title, episode_title, protocol, sxe, sonarr_id, quality):
+        tags = {
+            "sonarrId": sonarr_id,
+            "name": series_title,
+            "epname": episode_title,
+            "sxe": sxe,
+            "protocol": protocol,
+            "protocol_id": protocol_id(protocol),
+            "quality": quality
+        }
+        return tags, f'{series_title}{sxe}'
@@ -2,9 +2,9 @@ from sys import version_info
 from logging import getLogger
 
 logger = getLogger('temp')
-# Check for python3.6 or newer to resolve erroneous typing.NamedTuple issues
-if version_info < (3, 6, 2):
-    logger.error('Varken requires python3.6.2 or newer. You are on python%s.%s.%s - Exiting...',
+# Check for python3.9 or newer. The structures use builtin generic annotations and the queue pages cancel futures
+if version_info < (3, 9):
+    logger.error('Varken requires python3.9 or newer. You are on python%s.%s.%s - Exiting...',
                  version_info.major, version_info.minor, version_info.micro)
     exit(1)
 
@@ -29,8 +29,17 @@ class DynamicNamedTuple:
         fields = {key: getattr(self, key) for key in vars(self) if not key.startswith('_')}
         return f"{self.__class__.__name__}({fields})"
 
+    def __eq__(self, other):
+        return type(self) is type(other) and vars(self) == vars(other)
+
 
 # Server Structures
+class UpstreamLimits(DynamicNamedTuple):
+    rate_limit: float = 0
+    rate_burst: int = 1
+    max_in_flight: int = 0
+
+
 class InfluxServer(DynamicNamedTuple):
     password: str = 'root'
     port: int = 8086
@@ -56,10 +65,14 @@ class SonarrServer(DynamicNamedTuple):
     future_days: int = 0
     future_days_run_seconds: int = 30
     id: int = None
+    incremental: bool = False
+    limits: UpstreamLimits = None
     missing_days: int = 0
     missing_days_run_seconds: int = 30
+    page_concurrency: int = 4
     queue: bool = False
     queue_run_seconds: int = 30
+    reconcile_run_seconds: int = 3600
     url: str = None
     verify_ssl: bool = False
 
@@ -69,8 +82,13 @@ class RadarrServer(DynamicNamedTuple):
     get_missing: bool = False
     get_missing_run_seconds: int = 30
     id: int = None
+    incremental: bool = False
+    limits: UpstreamLimits = None
+    missing_full_library: bool = False
+    page_concurrency: int = 4
     queue: bool = False
     queue_run_seconds: int = 30
+    reconcile_run_seconds: int = 3600
     url: str = None
     verify_ssl: bool = False
 
@@ -78,8 +96,10 @@ class RadarrServer(DynamicNamedTuple):
 class OmbiServer(DynamicNamedTuple):
     api_key: str = None
     id: int = None
+    incremental: bool = False
     issue_status_counts: bool = False
     issue_status_run_seconds: int = 30
+    limits: UpstreamLimits = None
     request_total_counts: bool = False
     request_total_run_seconds: int = 30
     request_type_counts: bool = False
@@ -94,6 +114,7 @@ class OverseerrServer(DynamicNamedTuple):
     url: str = None
     verify_ssl: bool = False
     get_request_total_counts: bool = False
+    limits: UpstreamLimits = None
     request_total_run_seconds: int = 30
     num_latest_requests_to_fetch: int = 10
     num_latest_requests_seconds: int = 30
@@ -107,6 +128,7 @@ class TautulliServer(DynamicNamedTuple):
     get_stats: bool = False
     get_stats_run_seconds: int = 30
     id: int = None
+    limits: UpstreamLimits = None
     url: str = None
     verify_ssl: bool = None
     maxmind_license_key: str = None
@@ -117,13 +139,17 @@ class SickChillServer(DynamicNamedTuple):
     get_missing: bool = False
     get_missing_run_seconds: int = 30
     id: int = None
+    limits: UpstreamLimits = None
     url: str = None
     verify_ssl: bool = False
 
 
 class UniFiServer(DynamicNamedTuple):
+    get_site_stats: bool = False
+    get_site_stats_run_seconds: int = 30
     get_usg_stats_run_seconds: int = 30
     id: int = None
+    limits: UpstreamLimits = None
     password: str = 'ubnt'
     site: str = None
     url: str = 'unifi.domain.tld:8443'
@@ -893,6 +919,26 @@ class LidarrQueue(DynamicNamedTuple):
     estimatedCompletionTime: str = None
 
 
+class LidarrArtist(DynamicNamedTuple):
+    artistName: str = None
+    artistType: str = None
+    disambiguation: str = None
+    foreignArtistId: str = None
+    genres: list = None
+    id: int = None
+    images: list = None
+    links: list = None
+    monitored: bool = None
+    overview: str = None
+    path: str = None
+    qualityProfileId: int = None
+    metadataProfileId: int = None
+    sortName: str = None
+    statistics: dict = None
+    status: str = None
+    tags: list = None
+
+
 class LidarrAlbum(DynamicNamedTuple):
     title: str = None
     disambiguation: str = None
@@ -911,7 +957,7 @@ class LidarrAlbum(DynamicNamedTuple):
     releases: list = None
     genres: list = None
     media: list = None
-    artist: dict = None
+    artist: LidarrArtist = None
     images: list = None
     links: list = None
     statistics: dict = {}
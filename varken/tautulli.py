@@ -1,43 +1,58 @@
 from logging import getLogger
+from threading import Lock
 from requests import Session, Request
 from geoip2.errors import AddressNotFoundError
 from datetime import datetime, timezone, date, timedelta
-from influxdb_client.client.exceptions import InfluxDBError
 
 from varken.structures import TautulliStream
-from varken.helpers import hashit, connection_handler
+from varken.helpers import hashit, connection_handler, Governor, CircuitBreaker
+
+
+class _GeoFallback(object):
+    class location:
+        latitude = None
+        longitude = None
+
+    class city:
+        name = None
+
+    class subdivisions:
+        class most_specific:
+            iso_code = ''
+            name = ''
+
+
+def _int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
 
 
 class TautulliAPI(object):
+    # Notification agent actions that update a session, and the player state they imply
+    webhook_states = {'play': 'playing', 'resume': 'playing', 'pause': 'paused', 'buffer': 'buffering',
+                      'change': None, 'transcode': None}
+
     def __init__(self, server, dbmanager, geoiphandler):
         self.dbmanager = dbmanager
         self.server = server
         self.geoiphandler = geoiphandler
         self.session = Session()
         self.session.params = {'apikey': self.server.api_key}
+        Governor.attach(self.session, f'tautulli-{self.server.id}', self.server.limits)
+        CircuitBreaker.attach(self.session, f'tautulli-{self.server.id}')
         self.endpoint = '/api/v2'
         self.logger = getLogger()
         self.my_ip = None
+        self.sessions = {}
+        self.sessions_lock = Lock()
 
     def __repr__(self):
         return f"<tautulli-{self.server.id}>"
 
     def get_activity(self):
-        class _GeoFallback(object):
-            class location:
-                latitude = None
-                longitude = None
-
-            class city:
-                name = None
-
-            class subdivisions:
-                class most_specific:
-                    iso_code = ''
-                    name = ''
-
         now = datetime.now(timezone.utc).astimezone().isoformat()
-        influx_payload = []
         params = {'cmd': 'get_activity'}
 
         req = self.session.prepare_request(Request('GET', self.server.url + self.endpoint, params=params))
@@ -56,134 +71,11 @@ class TautulliAPI(object):
             self.logger.error('TypeError has occurred : %s while creating TautulliStream structure', e)
             return
 
-        geoip_available = bool(self.geoiphandler and getattr(self.geoiphandler, 'reader', None))
-
-        for session in sessions:
-            # Check to see if ip_address_public attribute exists as it was introduced in v2
-            try:
-                getattr(session, 'ip_address_public')
-            except AttributeError:
-                self.logger.error('Public IP attribute missing!!! Do you have an old version of Tautulli (v1)?')
-                exit(1)
-
-            if geoip_available:
-                try:
-                    geodata = self.geoiphandler.lookup(session.ip_address_public)
-                except (ValueError, AddressNotFoundError):
-                    self.logger.debug('Public IP missing for Tautulli session...')
-                    if not self.my_ip:
-                        # Try the fallback ip in the config file
-                        try:
-                            self.logger.debug('Attempting to use the fallback IP...')
-                            geodata = self.geoiphandler.lookup(self.server.fallback_ip)
-                        except AddressNotFoundError as e:
-                            self.logger.error('%s', e)
-
-                            self.my_ip = self.session.get('http://ip.42.pl/raw').text
-                            self.logger.debug('Looked the public IP and set it to %s', self.my_ip)
-
-                            geodata = self.geoiphandler.lookup(self.my_ip)
-
-                    else:
-                        geodata = self.geoiphandler.lookup(self.my_ip)
-            else:
-                geodata = _GeoFallback()
-
-            if not all([geodata.location.latitude, geodata.location.longitude]):
-                latitude = 37.234332396
-                longitude = -115.80666344
-            else:
-                latitude = geodata.location.latitude
-                longitude = geodata.location.longitude
-
-            if not geodata.city.name:
-                location = '👽'
-            else:
-                location = geodata.city.name
-
-            decision = session.transcode_decision
-            if decision == 'copy':
-                decision = 'direct stream'
-
-            video_decision = session.stream_video_decision
-            if video_decision == 'copy':
-                video_decision = 'direct stream'
-            elif video_decision == '':
-                video_decision = 'Music'
-
-            quality = session.stream_video_resolution
-            if not quality:
-                quality = session.container.upper()
-            elif quality in ('SD', 'sd', '4k'):
-                quality = session.stream_video_resolution.upper()
-            elif session.stream_video_full_resolution:
-                quality = session.stream_video_full_resolution
-            else:
-                quality = session.stream_video_resolution + 'p'
-
-            player_state = session.state.lower()
-            if player_state == 'playing':
-                player_state = 0
-            elif player_state == 'paused':
-                player_state = 1
-            elif player_state == 'buffering':
-                player_state = 3
-
-            # Platform Version Overrides
-            product_version = session.product_version
-            if session.platform in ('Roku', 'osx', 'windows'):
-                product_version = session.product_version.split('-')[0]
-
-            # Platform Overrides
-            platform_name = session.platform
-            if platform_name in 'osx':
-                platform_name = 'macOS'
-            if platform_name in 'windows':
-                platform_name = 'Windows'
-
-            hash_id = hashit(f'{session.session_id}{session.session_key}{session.username}{session.full_title}')
-            influx_payload.append(
-                {
-                    "measurement": "Tautulli",
-                    "tags": {
-                        "type": "Session",
-                        "session_id": session.session_id,
-                        "ip_address": session.ip_address,
-                        "friendly_name": session.friendly_name,
-                        "username": session.username,
-                        "title": session.full_title,
-                        "product": session.product,
-                        "platform": platform_name,
-                        "product_version": product_version,
-                        "quality": quality,
-                        "video_decision": video_decision.title(),
-                        "transcode_decision": decision.title(),
-                        "transcode_hw_decoding": session.transcode_hw_decoding,
-                        "transcode_hw_encoding": session.transcode_hw_encoding,
-                        "media_type": session.media_type.title(),
-                        "audio_codec": session.audio_codec.upper(),
-                        "audio_profile": session.audio_profile.upper(),
-                        "stream_audio_codec": session.stream_audio_codec.upper(),
-                        "quality_profile": session.quality_profile,
-                        "progress_percent": session.progress_percent,
-                        "region_code": geodata.subdivisions.most_specific.iso_code,
-                        "location": location,
-                        "full_location": f'{geodata.subdivisions.most_specific.name} - {geodata.city.name}',
-                        "latitude": latitude,
-                        "longitude": longitude,
-                        "player_state": player_state,
-                        "device_type": platform_name,
-                        "relayed": session.relayed,
-                        "secure": session.secure,
-                        "server": self.server.id
-                    },
-                    "time": now,
-                    "fields": {
-                        "hash": hash_id
-                    }
-                }
-            )
+        # Polling is authoritative. Replace whatever the webhooks have built up since the last run
+        with self.sessions_lock:
+            self.sessions = {session.session_key: session for session in sessions}
 
+        influx_payload = self._session_points(sessions, now)
         influx_payload.append(
             {
                 "measurement": "Tautulli",
@@ -206,6 +98,204 @@ class TautulliAPI(object):
 
         self.dbmanager.write_points(influx_payload)
 
+    def ingest_webhook(self, data):
+        """Apply a Tautulli notification agent webhook to the tracked sessions and write the activity points"""
+        now = datetime.now(timezone.utc).astimezone().isoformat()
+
+        if not isinstance(data, dict) or not data.get('session_key'):
+            self.logger.warning('Discarding Tautulli webhook without a session_key for tautulli-%s', self.server.id)
+            return
+
+        action = str(data.get('action', '')).lower()
+        session_key = str(data['session_key'])
+
+        with self.sessions_lock:
+            if action == 'stop':
+                self.sessions.pop(session_key, None)
+            elif action in self.webhook_states:
+                current = self.sessions.get(session_key)
+                fields = dict(vars(current)) if current else {}
+                fields.update({k: v for k, v in data.items() if k in TautulliStream._field_defaults})
+                fields['session_key'] = session_key
+                if self.webhook_states[action]:
+                    fields['state'] = self.webhook_states[action]
+                self.sessions[session_key] = TautulliStream(
+                    **{k: fields.get(k, v) for k, v in TautulliStream._field_defaults.items()}
+                )
+            else:
+                self.logger.debug('Ignoring Tautulli webhook action "%s" for tautulli-%s', action, self.server.id)
+                return
+            sessions = list(self.sessions.values())
+
+        self.logger.debug('Tautulli webhook "%s" for tautulli-%s. Tracking %s sessions',
+                          action, self.server.id, len(sessions))
+
+        influx_payload = self._session_points(sessions, now)
+        influx_payload.append(
+            {
+                "measurement": "Tautulli",
+                "tags": {
+                    "type": "current_stream_stats",
+                    "server": self.server.id
+                },
+                "time": now,
+                "fields": {
+                    "stream_count": len(sessions),
+                    "total_bandwidth": sum(_int(session.bandwidth) for session in sessions),
+                    "wan_bandwidth": sum(_int(session.bandwidth) for session in sessions
+                                         if session.location == 'wan'),
+                    "lan_bandwidth": sum(_int(session.bandwidth) for session in sessions
+                                         if session.location == 'lan'),
+                    "transcode_streams": len([s for s in sessions if s.transcode_decision == 'transcode']),
+                    "direct_play_streams": len([s for s in sessions if s.transcode_decision == 'direct play']),
+                    "direct_streams": len([s for s in sessions if s.transcode_decision == 'copy'])
+                }
+            }
+        )
+
+        self.dbmanager.write_points(influx_payload)
+
+    def _geodata(self, session):
+        if not (self.geoiphandler and getattr(self.geoiphandler, 'reader', None)):
+            return _GeoFallback()
+
+        try:
+            geodata = self.geoiphandler.lookup(session.ip_address_public or '')
+        except (ValueError, AddressNotFoundError):
+            self.logger.debug('Public IP missing for Tautulli session...')
+            if not self.my_ip:
+                # Try the fallback ip in the config file
+                try:
+                    self.logger.debug('Attempting to use the fallback IP...')
+                    geodata = self.geoiphandler.lookup(self.server.fallback_ip)
+                except AddressNotFoundError as e:
+                    self.logger.error('%s', e)
+
+                    self.my_ip = self.session.get('http://ip.42.pl/raw').text
+                    self.logger.debug('Looked the public IP and set it to %s', self.my_ip)
+
+                    geodata = self.geoiphandler.lookup(self.my_ip)
+
+            else:
+                geodata = self.geoiphandler.lookup(self.my_ip)
+
+        return geodata
+
+    def _session_points(self, sessions, now):
+        influx_payload = []
+        for session in sessions:
+            try:
+                influx_payload.append(self._session_point(session, now))
+            except (AttributeError, TypeError) as e:
+                self.logger.error('Incomplete Tautulli session %s for tautulli-%s. Skipping. Error: %s',
+                                  session.session_key, self.server.id, e)
+        return influx_payload
+
+    def _session_point(self, session, now):
+        # Check to see if ip_address_public attribute exists as it was introduced in v2
+        try:
+            getattr(session, 'ip_address_public')
+        except AttributeError:
+            self.logger.error('Public IP attribute missing!!! Do you have an old version of Tautulli (v1)?')
+            exit(1)
+
+        geodata = self._geodata(session)
+
+        if not all([geodata.location.latitude, geodata.location.longitude]):
+            latitude = 37.234332396
+            longitude = -115.80666344
+        else:
+            latitude = geodata.location.latitude
+            longitude = geodata.location.longitude
+
+        if not geodata.city.name:
+            location = '👽'
+        else:
+            location = geodata.city.name
+
+        # Webhook sessions only carry the fields the notification agent sends. Anything missing is written empty
+        decision = session.transcode_decision or ''
+        if decision == 'copy':
+            decision = 'direct stream'
+
+        video_decision = session.stream_video_decision
+        if video_decision == 'copy':
+            video_decision = 'direct stream'
+        elif video_decision == '':
+            video_decision = 'Music'
+        video_decision = video_decision or ''
+
+        quality = session.stream_video_resolution
+        if not quality:
+            quality = (session.container or '').upper()
+        elif quality in ('SD', 'sd', '4k'):
+            quality = session.stream_video_resolution.upper()
+        elif session.stream_video_full_resolution:
+            quality = session.stream_video_full_resolution
+        else:
+            quality = session.stream_video_resolution + 'p'
+
+        player_state = (session.state or '').lower()
+        if player_state == 'playing':
+            player_state = 0
+        elif player_state == 'paused':
+            player_state = 1
+        elif player_state == 'buffering':
+            player_state = 3
+
+        # Platform Version Overrides
+        product_version = session.product_version
+        if session.platform in ('Roku', 'osx', 'windows') and product_version:
+            product_version = product_version.split('-')[0]
+
+        # Platform Overrides
+        platform_name = session.platform
+        if platform_name and platform_name in 'osx':
+            platform_name = 'macOS'
+        if platform_name and platform_name in 'windows':
+            platform_name = 'Windows'
+
+        hash_id = hashit(f'{session.session_id}{session.session_key}{session.username}{session.full_title}')
+        return {
+            "measurement": "Tautulli",
+            "tags": {
+                "type": "Session",
+                "session_id": session.session_id,
+                "ip_address": session.ip_address,
+                "friendly_name": session.friendly_name,
+                "username": session.username,
+                "title": session.full_title,
+                "product": session.product,
+                "platform": platform_name,
+                "product_version": product_version,
+                "quality": quality,
+                "video_decision": video_decision.title(),
+                "transcode_decision": decision.title(),
+                "transcode_hw_decoding": session.transcode_hw_decoding,
+                "transcode_hw_encoding": session.transcode_hw_encoding,
+                "media_type": (session.media_type or '').title(),
+                "audio_codec": (session.audio_codec or '').upper(),
+                "audio_profile": (session.audio_profile or '').upper(),
+                "stream_audio_codec": (session.stream_audio_codec or '').upper(),
+                "quality_profile": session.quality_profile,
+                "progress_percent": session.progress_percent,
+                "region_code": geodata.subdivisions.most_specific.iso_code,
+                "location": location,
+                "full_location": f'{geodata.subdivisions.most_specific.name} - {geodata.city.name}',
+                "latitude": latitude,
+                "longitude": longitude,
+                "player_state": player_state,
+                "device_type": platform_name,
+                "relayed": session.relayed,
+                "secure": session.secure,
+                "server": self.server.id
+            },
+            "time": now,
+            "fields": {
+                "hash": hash_id
+            }
+        }
+
     def get_stats(self):
         now = datetime.now(timezone.utc).astimezone().isoformat()
         influx_payload = []
@@ -246,6 +336,9 @@ class TautulliAPI(object):
         self.dbmanager.write_points(influx_payload)
 
     def get_historical(self, days=30):
+        # Only the historical import talks to InfluxDB directly, so keep influxdb_client out of the collector
+        from influxdb_client.client.exceptions import InfluxDBError
+
         influx_payload = []
         start_date = date.today() - timedelta(days=days)
         params = {'cmd': 'get_history', 'grouping': 1, 'length': 1000000}
@@ -323,7 +416,7 @@ class TautulliAPI(object):
 
             quality = session.stream_video_resolution
             if not quality:
-                quality = session.container.upper()
+                quality = (session.container or '').upper()
             elif quality in ('SD', 'sd', '4k'):
                 quality = session.stream_video_resolution.upper()
             elif session.stream_video_full_resolution:
@@ -1,42 +1,171 @@
+from time import monotonic
+from json import load, dump
+from os import open as os_open, O_WRONLY, O_CREAT, O_TRUNC
+from os.path import join
 from logging import getLogger
+from threading import Lock, current_thread
+from collections import Counter
 from requests import Session, Request
 from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
 
-from varken.helpers import connection_handler
+from varken.helpers import connection_handler, hashit, Governor, CircuitBreaker
+
+
+class UniFiSession(object):
+    """
+    Login state for one controller, shared by every UniFi job that uses the same url and username. Cookies and the
+    CSRF token are persisted in the data folder so a restart can reuse them. Logins happen lazily, on the first
+    request or when the controller rejects the session, and back off exponentially after a failure
+    """
+    min_backoff = 30
+    max_backoff = 900
+    sessions = {}
+    sessions_lock = Lock()
+
+    def __init__(self, server, data_folder):
+        self.server = server
+        self.logger = getLogger()
+        self.session = Session()
+        Governor.attach(self.session, f'unifi-{server.id}', server.limits)
+        CircuitBreaker.attach(self.session, f'unifi-{server.id}')
+        self.lock = Lock()
+        self.authenticated = False
+        self.backoff = 0
+        self.retry_at = 0
+        self.path = join(data_folder, f'unifi-session-{hashit(server.url + server.username)}.json')
+        self.load()
+
+    @classmethod
+    def for_server(cls, server, data_folder):
+        with cls.sessions_lock:
+            key = (server.url, server.username)
+            if key not in cls.sessions:
+                cls.sessions[key] = cls(server, data_folder)
+            # The latest configuration wins, so a reloaded password is used on the next login
+            cls.sessions[key].server = server
+            return cls.sessions[key]
+
+    @classmethod
+    def release(cls, server):
+        """Forget the shared session of server, so a rebuilt collector gets fresh limits and breaker"""
+        with cls.sessions_lock:
+            cls.sessions.pop((server.url, server.username), None)
+
+    def load(self):
+        try:
+            with open(self.path) as session_file:
+                state = load(session_file)
+        except (OSError, ValueError):
+            return
+
+        self.session.cookies.update(state.get('cookies', {}))
+        if state.get('csrf_token'):
+            self.session.headers['X-CSRF-Token'] = state['csrf_token']
+        self.authenticated = bool(state.get('cookies'))
+        self.logger.debug('Reusing saved UniFi session for %s', self.server.url)
+
+    def save(self):
+        state = {'cookies': self.session.cookies.get_dict(), 'csrf_token': self.session.headers.get('X-CSRF-Token')}
+        try:
+            with open(os_open(self.path, O_WRONLY | O_CREAT | O_TRUNC, 0o600), 'w') as session_file:
+                dump(state, session_file)
+        except OSError as e:
+            self.logger.warning('Could not save UniFi session to %s. Error: %s', self.path, e)
+
+    def cookie(self):
+        return next((cookie.value for cookie in self.session.cookies if cookie.name == 'unifises'), None)
+
+    def login(self, rejected=None):
+        """
+        Log in unless another job already did so since the session was rejected. Returns False while backing off
+        """
+        with self.lock:
+            if self.authenticated:
+                if rejected is None or rejected != self.cookie():
+                    return True
+                self.authenticated = False
+            if monotonic() < self.retry_at:
+                self.logger.debug('Not logging in to %s for another %.0fs', self.server.url,
+                                  self.retry_at - monotonic())
+                return False
+
+            # The session stores the new cookie itself, drop the old ones so they cannot shadow it
+            self.session.cookies.clear()
+            endpoint = '/api/login'
+            pre_cookies = {'username': self.server.username, 'password': self.server.password, 'remember': True}
+            req = self.session.prepare_request(Request('POST', self.server.url + endpoint, json=pre_cookies))
+            post = connection_handler(self.session, req, self.server.verify_ssl, as_is_reply=True)
+
+            if not post or not post.cookies.get('unifises'):
+                self.authenticated = False
+                self.backoff = min(self.max_backoff, self.backoff * 2 or self.min_backoff)
+                self.retry_at = monotonic() + self.backoff
+                self.logger.error("Could not retrieve session cookie from UniFi Controller. Retrying in %ss",
+                                  self.backoff)
+                return False
+
+            if post.headers.get('X-CSRF-Token'):
+                self.session.headers['X-CSRF-Token'] = post.headers['X-CSRF-Token']
+            self.authenticated = True
+            self.backoff = 0
+            self.retry_at = 0
+            self.save()
+            return True
+
+    def get(self, endpoint):
+        """
+        GET endpoint and return the decoded json, logging in again once if the session was rejected. Returns False
+        on failure
+        """
+        for attempt in range(2):
+            cookie = self.cookie()
+            if not self.authenticated and not self.login():
+                return False
+
+            req = self.session.prepare_request(Request('GET', self.server.url + endpoint))
+            get = connection_handler(self.session, req, self.server.verify_ssl, as_is_reply=True)
+
+            if get is False:
+                return False
+            if get.status_code in (401, 403) and attempt == 0:
+                self.logger.info('UniFi session for %s was rejected. Logging in again', self.server.url)
+                if not self.login(rejected=cookie):
+                    return False
+                continue
+            if get.status_code != 200:
+                return False
+
+            try:
+                return get.json()
+            except ValueError:
+                return False
+
+        return False
 
 
 class UniFiAPI(object):
-    def __init__(self, server, dbmanager):
+    def __init__(self, server, dbmanager, data_folder):
         self.dbmanager = dbmanager
         self.server = server
-        self.site = self.server.site
-        # Create session to reduce server web thread load, and globally define pageSize for all requests
-        self.session = Session()
+        self.site = None
+        # Logins are shared by every job using the same controller and made on first use
+        self.controller = UniFiSession.for_server(server, data_folder)
         self.logger = getLogger()
-        self.get_retry = True
-        self.get_cookie()
-        self.get_site()
+        self.usg_mac = None
+        self.counters = {}
 
     def __repr__(self):
         return f"<unifi-{self.server.id}>"
 
-    def get_cookie(self):
-        endpoint = '/api/login'
-        pre_cookies = {'username': self.server.username, 'password': self.server.password, 'remember': True}
-        req = self.session.prepare_request(Request('POST', self.server.url + endpoint, json=pre_cookies))
-        post = connection_handler(self.session, req, self.server.verify_ssl, as_is_reply=True)
-
-        if not post or not post.cookies.get('unifises'):
-            self.logger.error("Could not retrieve session cookie from UniFi Controller")
-            return
-
-        cookies = {'unifises': post.cookies.get('unifises')}
-        self.session.cookies.update(cookies)
+    def close(self):
+        UniFiSession.release(self.server)
 
     def get_site(self):
-        endpoint = '/api/self/sites'
-        req = self.session.prepare_request(Request('GET', self.server.url + endpoint))
-        get = connection_handler(self.session, req, self.server.verify_ssl)
+        if self.site is not None:
+            return self.site
+
+        get = self.controller.get('/api/self/sites')
 
         if not get:
             self.logger.error("Could not get list of sites from UniFi Controller")
@@ -47,58 +176,218 @@ class UniFiAPI(object):
             self.site = site[0]
         else:
             self.logger.error(f"Could not map site {self.server.site} to a site id/alias")
+        return self.site
+
+    def resolve_usg(self):
+        """Look up the MAC of the USG named usg_name from the lightweight device listing"""
+        get = False
+        # Older controllers have no device-basic, so fall back to the full listing
+        for endpoint in (f'/api/s/{self.site}/stat/device-basic', f'/api/s/{self.site}/stat/device'):
+            get = self.controller.get(endpoint)
+            if get:
+                break
+        else:
+            return get
+
+        for device in get['data']:
+            if device.get('name') == self.server.usg_name:
+                self.usg_mac = device['mac']
+                self.logger.debug('Resolved USG %s to %s for unifi-%s', self.server.usg_name, self.usg_mac,
+                                  self.server.id)
+                return True
+
+        self.logger.error("Could not find a USG named %s from your UniFi Controller", self.server.usg_name)
+        return None
+
+    def get_usg_device(self):
+        """
+        Fetch the stats of the USG only. Returns False if the controller could not be reached and None if the USG
+        could not be found. The MAC is resolved again when the device behind it no longer matches usg_name
+        """
+        for _ in range(2):
+            if self.usg_mac is None:
+                resolved = self.resolve_usg()
+                if not resolved:
+                    return resolved
+
+            get = self.controller.get(f'/api/s/{self.site}/stat/device/{self.usg_mac}')
+
+            if not get:
+                # Controllers reject unknown MACs, so resolve again on the next run
+                self.usg_mac = None
+                return get
+
+            for device in get['data']:
+                if device.get('name') == self.server.usg_name:
+                    return device
+
+            self.logger.info('USG %s is no longer at %s for unifi-%s. Resolving it again', self.server.usg_name,
+                             self.usg_mac, self.server.id)
+            self.usg_mac = None
 
     def get_usg_stats(self):
         now = datetime.now(timezone.utc).astimezone().isoformat()
-        endpoint = f'/api/s/{self.site}/stat/device'
-        req = self.session.prepare_request(Request('GET', self.server.url + endpoint))
-        get = connection_handler(self.session, req, self.server.verify_ssl)
-
-        if not get:
-            if self.get_retry:
-                self.get_retry = False
-                self.logger.error("Attempting to reauthenticate for unifi-%s", self.server.id)
-                self.get_cookie()
-                self.get_usg_stats()
-            else:
-                self.get_retry = True
-                self.logger.error("Disregarding Job get_usg_stats for unifi-%s", self.server.id)
+        if not self.get_site():
             return
 
-        if not self.get_retry:
-            self.get_retry = True
+        device = self.get_usg_device()
 
-        devices = {device['name']: device for device in get['data'] if device.get('name')}
+        if device is False:
+            self.logger.error("Disregarding Job get_usg_stats for unifi-%s", self.server.id)
+            return
 
-        if devices.get(self.server.usg_name):
-            device = devices[self.server.usg_name]
-        else:
-            self.logger.error("Could not find a USG named %s from your UniFi Controller", self.server.usg_name)
+        if device is None:
             return
 
         try:
-            influx_payload = [
-                {
-                    "measurement": "UniFi",
-                    "tags": {
-                        "model": device['model'],
-                        "name": device['name']
-                    },
-                    "time": now,
-                    "fields": {
-                        "bytes_current": device['wan1']['bytes-r'],
-                        "rx_bytes_total": device['wan1']['rx_bytes'],
-                        "rx_bytes_current": device['wan1']['rx_bytes-r'],
-                        "tx_bytes_total": device['wan1']['tx_bytes'],
-                        "tx_bytes_current": device['wan1']['tx_bytes-r'],
-                        "cpu_loadavg_1": float(device['sys_stats']['loadavg_1']),
-                        "cpu_loadavg_5": float(device['sys_stats']['loadavg_5']),
-                        "cpu_loadavg_15": float(device['sys_stats']['loadavg_15']),
-                        "cpu_util": float(device['system-stats']['cpu']),
-                        "mem_util": float(device['system-stats']['mem']),
-                    }
-                }
-            ]
-            self.dbmanager.write_points(influx_payload)
+            self.dbmanager.write_points([self._usg_point(device, now)])
         except KeyError as e:
             self.logger.error('Error building payload for unifi. Discarding. Error: %s', e)
+
+    def get_site_stats(self):
+        """
+        Site wide telemetry from one stat/device and one stat/sta fetch: per device and per port throughput, AP
+        client counts and radio utilisation. The USG point is written as well, so get_usg_stats is not needed
+        """
+        now = datetime.now(timezone.utc).astimezone().isoformat()
+        timestamp = monotonic()
+        if not self.get_site():
+            return
+
+        # Log in before fanning out so both requests share one login
+        if not self.controller.authenticated and not self.controller.login():
+            return
+        with ThreadPoolExecutor(max_workers=2, thread_name_prefix=current_thread().name) as executor:
+            get_devices, get_clients = executor.map(self.controller.get, (f'/api/s/{self.site}/stat/device',
+                                                                          f'/api/s/{self.site}/stat/sta'))
+
+        if not get_devices or not get_clients:
+            self.logger.error("Disregarding Job get_site_stats for unifi-%s", self.server.id)
+            return
+
+        wireless_clients = Counter()
+        wired_clients = Counter()
+        for client in get_clients['data']:
+            if client.get('is_wired'):
+                wired_clients[client.get('sw_mac')] += 1
+            else:
+                wireless_clients[client.get('ap_mac')] += 1
+
+        influx_payload = [
+            {
+                "measurement": "UniFi",
+                "tags": {
+                    "type": "Site",
+                    "site": self.site,
+                    "server": self.server.id
+                },
+                "time": now,
+                "fields": {
+                    "devices": len(get_devices['data']),
+                    "clients": len(get_clients['data']),
+                    "wireless_clients": sum(wireless_clients.values()),
+                    "wired_clients": sum(wired_clients.values())
+                }
+            }
+        ]
+
+        seen = set()
+        for device in get_devices['data']:
+            mac = device.get('mac')
+            name = device.get('name') or mac
+            tags = {"site": self.site, "server": self.server.id, "name": name, "mac": mac,
+                    "model": device.get('model'), "device_type": device.get('type')}
+            system_stats = device.get('system-stats', {})
+
+            fields = {
+                "state": device.get('state'),
+                "uptime": device.get('uptime'),
+                "wireless_clients": wireless_clients[mac],
+                "wired_clients": wired_clients[mac],
+                "cpu_util": float(system_stats.get('cpu') or 0),
+                "mem_util": float(system_stats.get('mem') or 0)
+            }
+            fields.update(self._rates((mac,), device, timestamp, seen))
+            influx_payload.append({"measurement": "UniFi", "tags": dict(tags, type="Device"), "time": now,
+                                   "fields": fields})
+
+            for port in device.get('port_table', []):
+                if not port.get('up'):
+                    continue
+                fields = {"speed": port.get('speed'), "full_duplex": port.get('full_duplex')}
+                fields.update(self._rates((mac, port.get('port_idx')), port, timestamp, seen))
+                influx_payload.append(
+                    {
+                        "measurement": "UniFi",
+                        "tags": dict(tags, type="Port", port_idx=port.get('port_idx'), port_name=port.get('name')),
+                        "time": now,
+                        "fields": fields
+                    }
+                )
+
+            for radio in device.get('radio_table_stats', []):
+                influx_payload.append(
+                    {
+                        "measurement": "UniFi",
+                        "tags": dict(tags, type="Radio", radio=radio.get('radio'), channel=radio.get('channel')),
+                        "time": now,
+                        "fields": {
+                            "clients": radio.get('num_sta', 0),
+                            "cu_total": radio.get('cu_total', 0),
+                            "cu_self_rx": radio.get('cu_self_rx', 0),
+                            "cu_self_tx": radio.get('cu_self_tx', 0),
+                            "satisfaction": radio.get('satisfaction', 0)
+                        }
+                    }
+                )
+
+            if device.get('name') == self.server.usg_name:
+                try:
+                    influx_payload.append(self._usg_point(device, now))
+                except KeyError as e:
+                    self.logger.error('Error building payload for unifi. Discarding. Error: %s', e)
+
+        # Forget counters of devices and ports that went away
+        self.counters = {key: sample for key, sample in self.counters.items() if key[:-1] in seen}
+
+        self.dbmanager.write_points(influx_payload)
+
+    def _rates(self, key, stats, timestamp, seen):
+        """
+        Convert the rx_bytes/tx_bytes counters of a device or port into bytes per second since the previous poll.
+        Nothing is returned for the first sample or after a counter reset
+        """
+        seen.add(key)
+        rates = {}
+        for counter in ('rx_bytes', 'tx_bytes'):
+            value = stats.get(counter)
+            if value is None:
+                continue
+            previous = self.counters.get(key + (counter,))
+            self.counters[key + (counter,)] = (timestamp, value)
+            if previous and value >= previous[1] and timestamp > previous[0]:
+                rates[f'{counter}_rate'] = (value - previous[1]) / (timestamp - previous[0])
+        return rates
+
+    @staticmethod
+    def _usg_point(device, now):
+        return {
+            "measurement": "UniFi",
+            "tags": {
+                "model": device['model'],
+                "name": device['name']
+            },
+            "time": now,
+            "fields": {
+                "bytes_current": device['wan1']['bytes-r'],
+                "rx_bytes_total": device['wan1']['rx_bytes'],
+                "rx_bytes_current": device['wan1']['rx_bytes-r'],
+                "tx_bytes_total": device['wan1']['tx_bytes'],
+                "tx_bytes_current": device['wan1']['tx_bytes-r'],
+                "cpu_loadavg_1": float(device['sys_stats']['loadavg_1']),
+                "cpu_loadavg_5": float(device['sys_stats']['loadavg_5']),
+                "cpu_loadavg_15": float(device['sys_stats']['loadavg_15']),
+                "cpu_util": float(device['system-stats']['cpu']),
+                "mem_util": float(device['system-stats']['mem']),
+            }
+        }
@@ -1,44 +1,171 @@
-from logging.handlers import RotatingFileHandler
-from logging import Filter, DEBUG, INFO, getLogger, Formatter, StreamHandler
+import re
+import atexit
+from time import monotonic
+from queue import SimpleQueue
+from threading import Lock
+from os.path import basename
+from collections import Counter
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+from logging import Filter, DEBUG, INFO, WARNING, getLogger, Formatter, StreamHandler, addLevelName
 
 from varken.helpers import mkdir_p
 
+# Below DEBUG. Full payload dumps are only logged at this level
+TRACE = 5
+addLevelName(TRACE, 'TRACE')
+
 
 class BlacklistFilter(Filter):
     """
-    Log filter for blacklisted tokens and passwords
+    Log filter for blacklisted tokens and passwords. All strings are matched by one compiled pattern, longest first,
+    in a single pass over the formatted message
     """
     filename = "varken.log"
     max_size = 5000000  # 5 MB
     max_files = 5
     log_folder = 'logs'
 
-    blacklisted_strings = ['apikey',  'username',  'password', 'url']
+    blacklisted_strings = ['apikey',  'username',  'password', 'url', 'token']
 
     def __init__(self, filteredstrings):
         super().__init__()
         self.filtered_strings = filteredstrings
+        strings = sorted(filter(None, filteredstrings), key=len, reverse=True)
+        self.pattern = re.compile('|'.join(re.escape(string) for string in strings)) if strings else None
+
+    @staticmethod
+    def redact(match):
+        return 8 * '*' + match.group()[-5:]
 
     def filter(self, record):
-        for item in self.filtered_strings:
-            try:
-                if item in record.msg:
-                    record.msg = record.msg.replace(item, 8 * '*' + item[-5:])
-                if any(item in str(arg) for arg in record.args):
-                    record.args = tuple(arg.replace(item, 8 * '*' + item[-5:]) if isinstance(arg, str) else arg
-                                        for arg in record.args)
-            except TypeError:
-                pass
+        if self.pattern is None:
+            return True
+        # Handlers only filter records they emit, so the args are stringified once and only when written
+        try:
+            message = record.getMessage()
+        except Exception:
+            # The args do not fit the message. Redact both on their own so handleError never prints them raw
+            args = record.args if isinstance(record.args, tuple) else (record.args,)
+            message = f'{self._str(record.msg)} (args: {", ".join(self._str(arg) for arg in args)})'
+        record.msg = self.pattern.sub(self.redact, message)
+        record.args = ()
         return True
 
+    @staticmethod
+    def _str(arg):
+        try:
+            return str(arg)
+        except Exception:
+            return f'<unprintable {type(arg).__name__}>'
+
+
+class RateLimitFilter(Filter):
+    """
+    Rate limit for repeated warnings and errors. Every call site gets a token bucket per thread, so per job and
+    server, of burst records refilled by one every refill_seconds, and all threads logging from it share a bucket of
+    site_burst records refilled by one every site_refill_seconds. A record needs a token from both, so one failing
+    server cannot silence another and a storm of distinct messages from one line is still capped. Records beyond
+    them are dropped and counted, and summary() logs how often each call site was suppressed since the last summary.
+    Past max_buckets new threads share one bucket per call site. Records below WARNING are never limited, and the
+    args of a record are never formatted to decide
+    """
+    level = WARNING
+    burst = 5
+    refill_seconds = 60
+    site_burst = 20
+    site_refill_seconds = 15
+    interval = 300
+    max_buckets = 1000
+
+    def __init__(self):
+        super().__init__()
+        self.lock = Lock()
+        # (logger, level, file, line[, thread]): [tokens, updated, suppressed, message template, burst, refill_seconds]
+        self.buckets = {}
+
+    def bucket(self, key, burst, refill_seconds, now, record):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [burst, now, 0, str(record.msg)[:200], burst, refill_seconds]
+        bucket[0] = min(burst, bucket[0] + (now - bucket[1]) / refill_seconds)
+        bucket[1] = now
+        return bucket
+
+    def filter(self, record):
+        if record.levelno < self.level or getattr(record, 'summary', False):
+            return True
+        site = (record.name, record.levelno, record.pathname, record.lineno)
+        key = site + (record.threadName,)
+        now = monotonic()
+        with self.lock:
+            if key not in self.buckets and len(self.buckets) >= self.max_buckets:
+                key = site + (None,)
+            bucket = self.bucket(key, self.burst, self.refill_seconds, now, record)
+            shared = self.bucket(site, self.site_burst, self.site_refill_seconds, now, record)
+            if bucket[0] >= 1 and shared[0] >= 1:
+                bucket[0] -= 1
+                shared[0] -= 1
+                return True
+            # Counted where it was refused, so threads stopped by the shared bucket are summarised once
+            (bucket if bucket[0] < 1 else shared)[2] += 1
+            return False
+
+    def summary(self):
+        """Log the suppressed call sites and forget the ones that are quiet again"""
+        now = monotonic()
+        with self.lock:
+            suppressed = [(key, bucket[2], bucket[3]) for key, bucket in self.buckets.items() if bucket[2]]
+            for key, bucket in list(self.buckets.items()):
+                bucket[2] = 0
+                if bucket[0] + (now - bucket[1]) / bucket[5] >= bucket[4]:
+                    del self.buckets[key]
+
+        logger = getLogger()
+        for key, count, message in suppressed:
+            _, level, pathname, lineno = key[:4]
+            thread = key[4] if len(key) > 4 else 'all threads'
+            logger.warning('Suppressed %s repeats of "%s" (%s:%s in %s)', count, message, basename(pathname), lineno,
+                           thread or 'other threads', extra={'summary': True})
+
+
+class PointSummary(object):
+    """
+    Lazy log argument for a list of influx points. Renders as the point count per measurement, and only when the
+    record is actually written
+    """
+    def __init__(self, points):
+        self.points = points
+
+    def __str__(self):
+        points = self.points if isinstance(self.points, list) else [self.points]
+        measurements = Counter(point.get('measurement') if isinstance(point, dict) else type(point).__name__
+                               for point in points)
+        return f'{len(points)} points ({", ".join(f"{name}: {count}" for name, count in measurements.items())})'
+
+
+class VarkenQueueHandler(QueueHandler):
+    """
+    Hands records to the listener thread as they are, so formatting, redaction and file I/O happen off the logging
+    thread. targets are the handlers the listener writes to
+    """
+    def __init__(self, queue, targets):
+        super().__init__(queue)
+        self.targets = targets
+
+    def prepare(self, record):
+        return record
+
 
 class VarkenLogger(object):
-    def __init__(self, debug=None, data_folder=None):
+    def __init__(self, debug=None, data_folder=None, trace=False):
         self.data_folder = data_folder
         self.log_level = debug
 
         # Set log level
-        if self.log_level:
+        if trace:
+            self.log_level = TRACE
+
+        elif self.log_level:
             self.log_level = DEBUG
 
         else:
@@ -49,7 +176,7 @@ class VarkenLogger(object):
 
         # Create the Logger
         self.logger = getLogger()
-        self.logger.setLevel(DEBUG)
+        self.logger.setLevel(self.log_level)
 
         # Create a Formatter for formatting the log messages
         logger_formatter = Formatter('%(asctime)s : %(levelname)s : %(module)s : %(message)s', '%Y-%m-%d %H:%M:%S')
@@ -69,6 +196,17 @@ class VarkenLogger(object):
         console_logger.setFormatter(logger_formatter)
         console_logger.setLevel(self.log_level)
 
+        # Log through a queue so the threads logging never wait on the file and console. The listener thread is
+        # stopped, flushing the queue, at exit
+        log_queue = SimpleQueue()
+        queue_logger = VarkenQueueHandler(log_queue, [file_logger, console_logger])
+        queue_logger.setLevel(self.log_level)
+        # Repeated warnings and errors are dropped before they are queued, so a failing upstream cannot flood the log
+        self.rate_limit = RateLimitFilter()
+        queue_logger.addFilter(self.rate_limit)
+        self.listener = QueueListener(log_queue, file_logger, console_logger, respect_handler_level=True)
+        self.listener.start()
+        atexit.register(self.listener.stop)
+
         # Add the Handler to the Logger
-        self.logger.addHandler(file_logger)
-        self.logger.addHandler(console_logger)
+        self.logger.addHandler(queue_logger)